@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from subprocess import CalledProcessError
+
+import pytest
+
+from testing import Path
+from testing import requirements
+from testing import run
+from testing import venv_update
+
+
+def assert_out_of_sync(reason):
+    with pytest.raises(CalledProcessError) as excinfo:
+        venv_update('--check')
+    assert excinfo.value.returncode == 5
+    out, err = excinfo.value.result
+    assert err == ''
+    assert out == 'virtualenv_run is out of sync: %s.\n' % reason
+
+
+def assert_in_sync():
+    out, err = venv_update('--check')
+    assert err == ''
+    assert out == 'virtualenv_run is in sync.\n'
+
+
+def test_check(tmpdir):
+    tmpdir.chdir()
+    requirements('mccabe==0.3\n')
+    assert_out_of_sync('it does not exist')
+
+    venv_update()
+    assert_in_sync()
+
+    run('virtualenv_run/bin/pip', 'install', 'pep8==1.5.7')
+    assert_out_of_sync('its installed packages have changed')
+    venv_update()
+    assert_in_sync()
+
+    requirements('mccabe==0.2.1\n')
+    assert_out_of_sync('its requirements have changed')
+    venv_update()
+    assert_in_sync()
+
+    # how the last update went about it doesn't matter, only what it installed
+    venv_update('--jobs=2')
+    assert_in_sync()
+
+    # nothing is changed, or marked invalid
+    mtime = Path('virtualenv_run').mtime()
+    requirements('mccabe==0.3\n')
+    assert_out_of_sync('its requirements have changed')
+    assert Path('virtualenv_run').mtime() == mtime
+
+
+def test_check_editable(tmpdir):
+    tmpdir.chdir()
+    Path('proj/setup.py').ensure().write('from setuptools import setup\nsetup(name="proj")\n')
+    requirements('-e proj\n')
+    venv_update()
+    assert_in_sync()
+
+    Path('proj/setup.py').write('from setuptools import setup\nsetup(name="proj", version="2")\n')
+    assert_out_of_sync('an editable requirement has changed')
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+
+from testing import Path
+from testing import requirements
+from testing import run
+from testing import venv_update
+
+
+def pip_freeze():
+    out, err = run('virtualenv_run/bin/pip', 'freeze', '--local')
+    assert err == ''
+    return out
+
+
+def test_dry_run(tmpdir):
+    tmpdir.chdir()
+    requirements('mccabe==0.3\n')
+
+    out, err = venv_update('--dry-run')
+    assert err == ''
+    assert 'virtualenv_run would be built from scratch.\n' in out
+    assert 'Predicted time: 0.0s\n' in out
+    assert not Path('virtualenv_run').exists()
+
+    venv_update()
+    costs = json.loads(Path('.pip/costs.json').read())
+    assert 'install' in costs['mccabe']
+
+    out, err = venv_update('--dry-run')
+    assert err == ''
+    assert 'Plan for virtualenv_run:\nPredicted time: 0.0s\n' in out
+
+
+def test_dry_run_plan(tmpdir):
+    tmpdir.chdir()
+    requirements('mccabe==0.2.1\npep8==1.5.7\n')
+    venv_update()
+    frozen = pip_freeze()
+
+    requirements('mccabe==0.3\npep8==1.5.6\npyflakes==0.8.1\n')
+    out, err = venv_update('--dry-run')
+    assert err == ''
+    assert '  upgrade   mccabe 0.2.1 -> 0.3 (' in out
+    assert '  downgrade pep8 1.5.7 -> 1.5.6 (' in out
+    assert '  install   pyflakes 0.8.1 (network, build) no history\n' in out
+    assert pip_freeze() == frozen
+
+    venv_update()
+    requirements('mccabe==0.3\n')
+    out, err = venv_update('--dry-run')
+    assert err == ''
+    assert '  remove    pep8 1.5.6\n' in out
+    assert '  remove    pyflakes 0.8.1\n' in out
+    assert 'mccabe' not in out.split('Plan for virtualenv_run:')[1]
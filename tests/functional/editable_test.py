@@ -0,0 +1,40 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import testing as T
+
+
+def make_project(version):
+    T.Path('proj').ensure_dir()
+    T.Path('proj/setup.py').write('''\
+from setuptools import setup
+setup(name='proj', version=%r, py_modules=['proj'], install_requires=['mccabe'])
+''' % version)
+    T.Path('proj/proj.py').write('')
+
+
+def test_unchanged_editable_is_not_reinstalled(tmpdir):
+    tmpdir.chdir()
+    make_project('1.0')
+    T.requirements('-e ./proj')
+
+    out, err = T.venv_update()
+    assert err == ''
+    assert 'Editable requirement is unchanged' not in out
+    assert 'Running setup.py develop for proj' in out
+
+    out, err = T.venv_update()
+    assert err == ''
+    assert 'Editable requirement is unchanged: proj\n' in out
+    assert 'Running setup.py develop for proj' not in out
+    # its dependencies are still kept around
+    out, err = T.run('./virtualenv_run/bin/pip', 'freeze', '--local')
+    assert 'mccabe==' in out
+    assert 'proj' in out
+
+    make_project('2.0')
+    out, err = T.venv_update()
+    assert err == ''
+    assert 'Editable requirement is unchanged' not in out
+    assert 'Running setup.py develop for proj' in out
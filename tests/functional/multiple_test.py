@@ -0,0 +1,50 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import testing as T
+
+
+def pip_freeze(venv):
+    out, err = T.run('%s/bin/pip' % venv, 'freeze', '--local')
+    assert err == ''
+    return out
+
+
+def test_update_several_venvs(tmpdir):
+    tmpdir.chdir()
+    T.Path('reqs1.txt').write('mccabe==0.3')
+    T.Path('reqs2.txt').write('pep8==1.5.7')
+    T.Path('reqs3.txt').write('mccabe==0.3\npyflakes==0.8.1')
+
+    out, err = T.venv_update('--jobs=2', 'venv1:reqs1.txt', 'venv2:reqs2.txt,reqs3.txt')
+    assert err == ''
+    out = T.uncolor(out)
+
+    # the union of the requirements was built once
+    assert out.count('\n> pip wheel ') == 1
+    assert 'venv-update venv1: done\n' in out
+    assert 'venv-update venv2: done\n' in out
+
+    assert 'mccabe==0.3\n' in pip_freeze('venv1')
+    assert 'pep8' not in pip_freeze('venv1')
+    freeze2 = pip_freeze('venv2')
+    assert 'mccabe==0.3\n' in freeze2
+    assert 'pep8==1.5.7\n' in freeze2
+    assert 'pyflakes==0.8.1\n' in freeze2
+
+
+def test_union_of_conflicting_pins(tmpdir):
+    tmpdir.chdir()
+    T.Path('reqs1.txt').write('mccabe==0.3')
+    T.Path('reqs2.txt').write('mccabe==0.2.1')
+
+    out, err = T.venv_update('venv1:reqs1.txt', 'venv2:reqs2.txt')
+    assert err == ''
+    out = T.uncolor(out)
+
+    # both versions were built by the union, a round each: the virtualenvs themselves built nothing
+    assert out.count('\n> pip wheel ') == 2
+    assert out.count('All requirements are already in the wheelhouse.') == 2
+    assert 'mccabe==0.3\n' in pip_freeze('venv1')
+    assert 'mccabe==0.2.1\n' in pip_freeze('venv2')
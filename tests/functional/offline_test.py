@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from subprocess import CalledProcessError
+
+import pytest
+import testing as T
+
+
+def test_offline_preflight_lists_all_misses(tmpdir):
+    tmpdir.chdir()
+    T.requirements('')
+    T.venv_update()
+
+    # arbitrary small packages, which have never been seen by this $HOME
+    T.requirements('''\
+mccabe==0.3
+pep8
+''')
+    with pytest.raises(CalledProcessError) as excinfo:
+        T.venv_update('--offline')
+    assert excinfo.value.returncode == 1
+    out, err = excinfo.value.result
+
+    out = T.uncolor(out)
+    assert 'Error: not available offline: mccabe==0.3 (from -r requirements.txt (line 1))\n' in out
+    assert 'Error: not available offline: pep8 (from -r requirements.txt (line 2))\n' in out
+    # we failed before trying to build anything
+    assert '> pip wheel' not in out
+
+
+def test_offline_from_warm_cache(tmpdir):
+    tmpdir.chdir()
+    T.requirements('mccabe==0.3')
+    T.venv_update()
+    T.run('rm', '-rf', 'virtualenv_run')
+
+    # these are localhost addresses with arbitrary invalid ports
+    out, err = T.venv_update(
+        '--offline',
+        http_proxy='http://127.0.0.1:111111',
+        https_proxy='https://127.0.0.1:222222',
+    )
+    assert err == ''
+    out, err = T.run('./virtualenv_run/bin/pip', 'freeze', '--local')
+    assert 'mccabe==0.3\n' in out
+
+
+def test_offline_miss_keeps_the_old_virtualenv(tmpdir):
+    tmpdir.chdir()
+    T.requirements('')
+    T.venv_update()
+    state = T.Path('virtualenv_run/.venv-update.state').read()
+
+    # the virtualenv must be rebuilt, but its requirements can't be had offline
+    T.requirements('mccabe==0.3')
+    with pytest.raises(CalledProcessError) as excinfo:
+        T.venv_update('--offline', '--system-site-packages')
+    out, err = excinfo.value.result
+
+    out = T.uncolor(out)
+    assert 'Error: not available offline: mccabe==0.3 (from -r requirements.txt (line 1))\n' in out
+    assert 'Removing invalidated virtualenv.' not in out
+    assert T.Path('virtualenv_run/.venv-update.state').read() == state
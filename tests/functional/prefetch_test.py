@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from glob import glob
+from sys import executable
+
+from testing import Path
+from testing import run
+from testing import uncolor
+from testing import venv_update
+
+
+def test_prefetch(tmpdir):
+    tmpdir.chdir()
+    Path('project1-requirements.txt').write('mccabe==0.3\n')
+    Path('project2-requirements.txt').write('pep8==1.5.7\n')
+
+    out, err = venv_update('--prefetch=' + executable, 'project1-requirements.txt', 'project2-requirements.txt')
+    assert err == ''
+    assert 'venv-update --prefetch %s: done\n' % executable in uncolor(out)
+    assert glob('.pip/wheelhouse/*/mccabe-0.3-*.whl')
+    assert glob('.pip/wheelhouse/*/pep8-1.5.7-*.whl')
+    # no virtualenv was made, or left behind
+    assert not Path('virtualenv_run').exists()
+    assert [path for path in Path('.pip/prefetch').listdir() if not path.basename.startswith('.venv-update-trash-')] == []
+
+    # from here on, there's nothing to build
+    Path('requirements.txt').write('-r project1-requirements.txt\n-r project2-requirements.txt\n')
+    out, err = venv_update()
+    assert err == ''
+    out = uncolor(out)
+    assert '\n> pip wheel ' not in out
+    assert 'All requirements are already in the wheelhouse.\n' in out
+    out, err = run('virtualenv_run/bin/pip', 'freeze', '--local')
+    assert 'mccabe==0.3\n' in out
+    assert 'pep8==1.5.7\n' in out
+
+
+def test_bundle(tmpdir):
+    tmpdir.chdir()
+    requirements_txt = 'mccabe==0.3\npep8==1.5.7\n'
+    Path('requirements.txt').write(requirements_txt)
+    out, err = venv_update('--prefetch', '--export-bundle=wheels.bundle')
+    assert err == ''
+    assert Path('wheels.bundle').check(file=True)
+    assert not glob('wheels.bundle.*')
+
+    # a fresh machine, with nothing cached, and no network
+    fresh = tmpdir.join('fresh').ensure_dir()
+    fresh.chdir()
+    Path('requirements.txt').write(requirements_txt)
+    out, err = venv_update('--offline', '--import-bundle=../wheels.bundle')
+    assert err == ''
+    assert 'Importing ' in out
+    out, err = run('virtualenv_run/bin/pip', 'freeze', '--local')
+    assert 'mccabe==0.3\n' in out
+    assert 'pep8==1.5.7\n' in out
@@ -44,7 +44,7 @@ def test_python_versions(tmpdir):
 
 
 def test_virtualenv_moved(tmpdir):
-    """if you move the virtualenv and venv-update again, the old will be blown away, and things will work"""
+    """if you move the virtualenv and venv-update again, it will be relocated, and things will work"""
     original_path = 'original'
     new_path = 'new_dir'
 
@@ -58,6 +58,91 @@ def test_virtualenv_moved(tmpdir):
     tmpdir.chdir()
     Path(original_path).rename(new_path)
     tmpdir.join(new_path).chdir()
-    venv_update()
+    out, err = venv_update()
+    assert err == ''
+    assert 'Relocating virtualenv, which was moved from ' in out
+    assert 'Removing invalidated virtualenv.' not in out
     run('virtualenv_run/bin/flake8', 'run.py')
     run('virtualenv_run/bin/python', 'virtualenv_run/bin/flake8', 'run.py')
+    run('sh', '-c', '. virtualenv_run/bin/activate && flake8 run.py')
+
+
+def test_snapshots(tmpdir):
+    tmpdir.chdir()
+    requirements('flake8==2.4.0\n')
+    Path('run.py').write('')
+    snapshots = '--snapshots=' + str(tmpdir.join('snapshots'))
+
+    out, err = venv_update(snapshots)
+    assert err == ''
+    assert 'Saving snapshot of virtualenv: ' in out
+    snapshot, = tmpdir.join('snapshots').listdir()
+
+    # a virtualenv anywhere else, with the same requirements, is restored rather than built
+    out, err = venv_update(snapshots, 'elsewhere')
+    assert err == ''
+    assert 'Restoring virtualenv from snapshot: ' in out
+    assert 'Saving snapshot of virtualenv: ' not in out
+    run('elsewhere/bin/flake8', 'run.py')
+    run('sh', '-c', '. elsewhere/bin/activate && flake8 run.py')
+    assert tmpdir.join('snapshots').listdir() == [snapshot]
+
+    # different requirements need a different snapshot
+    requirements('flake8==2.3.0\n')
+    out, err = venv_update(snapshots, 'another')
+    assert err == ''
+    assert 'Restoring virtualenv from snapshot: ' not in out
+    assert len(tmpdir.join('snapshots').listdir()) == 2
+
+
+def test_pool(tmpdir):
+    tmpdir.chdir()
+    Path('run.py').write('')
+
+    def branch(reqs):
+        requirements(reqs)
+        out, err = venv_update('--pool=2')
+        assert err == ''
+        run('virtualenv_run/bin/flake8', 'run.py')
+        run('sh', '-c', '. virtualenv_run/bin/activate && flake8 run.py')
+        return out
+
+    out = branch('flake8==2.4.0\n')
+    assert Path('virtualenv_run').islink()
+    first = Path('virtualenv_run').realpath()
+
+    out = branch('flake8==2.3.0\n')
+    assert 'Cloning the nearest pooled virtualenv: %s\n' % first.basename in out
+    assert Path('virtualenv_run').realpath() != first
+
+    # switching back is just a matter of a symlink
+    out = branch('flake8==2.4.0\n')
+    assert 'Using pooled virtualenv: %s\n' % first.basename in out
+    assert 'Cloning' not in out
+    assert Path('virtualenv_run').realpath() == first
+
+    out = branch('flake8==2.2.0\n')
+    assert 'Removing least-recently used virtualenv from the pool: ' in out
+    assert len([path for path in first.dirpath().listdir() if path.isdir()]) == 2
+
+
+def test_python_patched(tmpdir):
+    """A patch-level update of python updates the virtualenv in place, rather than rebuilding it."""
+    import json
+    tmpdir.chdir()
+    requirements('flake8==2.4.0\n')
+    Path('run.py').write('')
+    venv_update()
+
+    # pretend that the virtualenv was made with an older patch-level of this python
+    state_file = Path('virtualenv_run/.venv-update.state')
+    state = json.loads(state_file.read())
+    major, minor, rest = state['validation'][0].split('.', 2)
+    state['validation'][0] = '.'.join((major, minor, '0' + rest))
+    state_file.write(json.dumps(state))
+
+    out, err = venv_update()
+    assert err == ''
+    assert 'Python was patched; updating the virtualenv in place.\n' in out
+    assert 'Removing invalidated virtualenv.' not in out
+    run('virtualenv_run/bin/flake8', 'run.py')
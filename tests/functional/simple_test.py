@@ -453,57 +453,84 @@ def test_downgrade(tmpdir):
     flake8_older()
 
 
-def test_remove_stale_cache_values(tmpdir):
-    """Tests that we remove stale (older than a week) cached packages
-    and wheels, while still keeping everything created within the past week.
+def wheelhouse_wheels(pip_path):
+    from glob import glob
+    return sorted(path.rsplit('/', 1)[-1] for path in glob(pip_path + '/wheelhouse/*/*.whl'))
+
+
+def test_remove_unreachable_cache_values(tmpdir):
+    """We keep the cached packages and wheels that some project still needs, however long ago they were used,
+    and remove what no project needs any more, however recently it was used.
     """
     import os
-    import time
 
     tmpdir.chdir()
-    home_path = str(Path('.').realpath())
-
-    pip_path = home_path + '/.pip'
-    cache_path = pip_path + '/cache'
-    wheelhouse_path = pip_path + '/wheelhouse'
+    pip_path = str(Path('.').realpath()) + '/.pip'
+    Path('other').mkdir()
+    Path('other/requirements.txt').write('pep8==1.5.7\n')
+    venv_update('other/virtualenv_run', 'other/requirements.txt')
+
+    stray = pip_path + '/wheelhouse/stray'
+    open(stray, 'w').close()
+    unreachable_download = pip_path + '/cache/https%3A%2F%2Fpypi.python.org%2Fpackages%2Fsource%2Fu%2Funused%2Funused-1.0.tar.gz'
+    open(unreachable_download, 'w').close()
+    open(unreachable_download + '.content-type', 'w').close()
+
+    requirements('mccabe==0.3\n')
+    venv_update()
+    wheels = wheelhouse_wheels(pip_path)
+    assert [wheel for wheel in wheels if wheel.startswith(('mccabe-', 'pep8-'))] == [
+        'mccabe-0.3-py2.py3-none-any.whl', 'pep8-1.5.7-py2.py3-none-any.whl',
+    ]
+    assert not os.access(stray, os.F_OK)
+    assert not os.access(unreachable_download, os.F_OK)
+    assert not os.access(unreachable_download + '.content-type', os.F_OK)
+
+    # The other project is gone, and nothing else needs pep8.
+    Path('other/requirements.txt').remove()
+    out, err = venv_update('--gc')
+    assert err == ''
+    assert 'Garbage collection: ' in out
+    wheels = wheelhouse_wheels(pip_path)
+    assert 'mccabe-0.3-py2.py3-none-any.whl' in wheels
+    assert 'pep8-1.5.7-py2.py3-none-any.whl' not in wheels
 
-    stale_cached_package = cache_path + '/stale_package'
-    fresh_cached_package = cache_path + '/new_package'
 
-    stale_cached_wheel = wheelhouse_path + '/stale_wheel'
-    fresh_cached_wheel = wheelhouse_path + '/new_wheel'
+def test_unpinned_requirements_are_kept(tmpdir):
+    """The wheels of an unpinned requirement (and its dependencies) are reachable, just as a pinned one's are."""
+    tmpdir.chdir()
+    pip_path = str(Path('.').realpath()) + '/.pip'
+    # flake8 depends on (unpinned) pyflakes, pep8 and mccabe
+    requirements('flake8\n')
+    venv_update()
+    built = wheelhouse_wheels(pip_path)
+    assert [wheel for wheel in built if wheel.startswith('flake8-')]
 
-    # Creates a cached package and wheel in their respective
-    # .pip/cache/ and .pip/wheelhouse directories.
-    os.makedirs(stale_cached_package)
-    os.makedirs(fresh_cached_package)
-    os.makedirs(stale_cached_wheel)
-    os.makedirs(fresh_cached_wheel)
+    out, err = venv_update()
+    assert err == ''
+    assert 'Garbage collection: ' in out
+    assert wheelhouse_wheels(pip_path) == built
 
-    # Create some rough times for testing. These represent, in
-    # seconds since epoch, a time from today, this week, and last month
-    seconds_in_day = 86400
-    today_time = int(time.time())
-    this_week_time = int(time.time()) - seconds_in_day * 3
-    last_month_time = int(time.time()) - seconds_in_day * 40
 
-    # Set access times of stale package/wheel to be older than a week.
-    os.utime(stale_cached_package, (0, 0))  # Jan 1, 1970
-    os.utime(stale_cached_wheel, (last_month_time, last_month_time))
+def test_cache_cleanup_waits_for_other_users(tmpdir):
+    """Unreachable cache values are kept while another venv-update is using the cache."""
+    import os
+    from fcntl import flock, LOCK_SH
 
-    # Set access times of fresh package/wheel to be within the past week.
-    os.utime(fresh_cached_package, (today_time, today_time))
-    os.utime(fresh_cached_wheel, (this_week_time, this_week_time))
+    tmpdir.chdir()
+    pip_path = str(Path('.').realpath()) + '/.pip'
+    stale_cached_wheel = pip_path + '/wheelhouse/py2.py3-none-any/stale-1.0-py2.py3-none-any.whl'
+    os.makedirs(os.path.dirname(stale_cached_wheel))
+    open(stale_cached_wheel, 'w').close()
+    os.utime(stale_cached_wheel, (0, 0))
 
     requirements('')
-    venv_update()
+    with open(pip_path + '/.venv-update.lock', 'a') as lock:
+        flock(lock.fileno(), LOCK_SH)
+        out, err = venv_update()
+    assert err == ''
+    assert 'The cache is in use by another venv-update; skipping cleanup.\n' in out
+    assert os.access(stale_cached_wheel, os.F_OK)
 
-    # Assert that we can no longer access the stale package/wheel
-    # that have been removed.
-    assert not os.access(stale_cached_package, os.F_OK)
+    venv_update()
     assert not os.access(stale_cached_wheel, os.F_OK)
-
-    # Assert that we can still access the fresh package/wheel,
-    # they should not have been removed.
-    assert os.access(fresh_cached_package, os.F_OK)
-    assert os.access(fresh_cached_wheel, os.F_OK)
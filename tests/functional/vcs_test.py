@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import testing as T
+
+
+GIT_ENV = dict(
+    GIT_AUTHOR_NAME='venv-update tests',
+    GIT_AUTHOR_EMAIL='venv-update@example.com',
+    GIT_COMMITTER_NAME='venv-update tests',
+    GIT_COMMITTER_EMAIL='venv-update@example.com',
+)
+
+
+def make_repo(version):
+    T.run('git', 'init', '--quiet', 'repo')
+    T.Path('repo/setup.py').write('''\
+from setuptools import setup
+setup(name='vcs-project', version=%r, py_modules=['vcs_project'])
+''' % version)
+    T.Path('repo/vcs_project.py').write('')
+    T.run('git', '--git-dir=repo/.git', '--work-tree=repo', 'add', '--all')
+    T.run('git', '--git-dir=repo/.git', '--work-tree=repo', 'commit', '--quiet', '-m', version, **GIT_ENV)
+
+
+def test_vcs_wheel_is_cached_by_commit(tmpdir):
+    tmpdir.chdir()
+    make_repo('1.0')
+    T.requirements('git+file://%s/repo#egg=vcs-project' % tmpdir.strpath)
+
+    out, err = T.venv_update()
+    assert err == ''
+    out = T.uncolor(out)
+    assert '> git clone --quiet --mirror ' in out
+    assert 'vcs-project==1.0' in T.run('./virtualenv_run/bin/pip', 'freeze', '--local')[0]
+
+    # unchanged: no clone, no build
+    out, err = T.venv_update()
+    assert err == ''
+    out = T.uncolor(out)
+    assert '> git clone' not in out
+    assert 'Building file://' not in out
+    assert 'vcs-project==1.0' in T.run('./virtualenv_run/bin/pip', 'freeze', '--local')[0]
+
+    # a new commit is fetched incrementally, and rebuilt
+    T.Path('repo/setup.py').write(T.Path('repo/setup.py').read().replace("'1.0'", "'2.0'"))
+    T.run('git', '--git-dir=repo/.git', '--work-tree=repo', 'commit', '--quiet', '-am', '2.0', **GIT_ENV)
+    out, err = T.venv_update()
+    assert err == ''
+    out = T.uncolor(out)
+    assert '> git clone --quiet --mirror ' not in out
+    assert ' fetch --quiet --prune origin' in out
+    assert 'vcs-project==2.0' in T.run('./virtualenv_run/bin/pip', 'freeze', '--local')[0]
@@ -0,0 +1,176 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from glob import glob
+
+import testing as T
+
+
+def test_pip_wheel_is_skipped_when_wheelhouse_covers_everything(tmpdir):
+    tmpdir.chdir()
+    # flake8 depends on (unpinned) pyflakes, pep8 and mccabe
+    T.requirements('flake8==2.2.5')
+
+    out, err = T.venv_update()
+    assert err == ''
+    out = T.uncolor(out)
+    assert '\n> pip wheel ' in out
+
+    out, err = T.venv_update()
+    assert err == ''
+    out = T.uncolor(out)
+    assert '\n> pip wheel ' not in out
+    assert 'All requirements are already in the wheelhouse.\n' in out
+
+
+def test_pip_wheel_builds_only_what_is_missing(tmpdir):
+    tmpdir.chdir()
+    T.requirements('flake8==2.2.5')
+    T.venv_update()
+
+    T.requirements('flake8==2.2.5\nsix==1.8.0')
+    out, err = T.venv_update()
+    assert err == ''
+    out = T.uncolor(out)
+    wheel_line, = [line for line in out.splitlines() if line.startswith('> pip wheel ')]
+    assert wheel_line.endswith(' six==1.8.0')
+    assert 'flake8' not in wheel_line
+
+
+def test_wheels_are_installed_concurrently(tmpdir):
+    tmpdir.chdir()
+    T.requirements('flake8==2.2.5')
+    T.venv_update()
+    T.run('rm', '-rf', 'virtualenv_run')
+
+    out, err = T.venv_update()
+    assert err == ''
+    out = T.uncolor(out)
+    assert '\nInstalling 4 wheels, ' in out
+
+    # they're installed just as pip would have: with scripts, and a RECORD
+    assert tmpdir.join('virtualenv_run', 'bin', 'flake8').check(file=True)
+    assert len(glob('virtualenv_run/lib/python*/site-packages/flake8-2.2.5.dist-info/RECORD')) == 1
+    out, err = T.run('virtualenv_run/bin/flake8', '--version')
+    assert out.startswith('2.2.5')
+
+
+def make_wheel(path):
+    """A wheel of a project named "dummy", version 1.0: one module, and one script."""
+    from zipfile import ZipFile
+    files = (
+        ('dummy.py', 'def main():\n    print("dummy 1.0")\n'),
+        ('dummy-1.0.dist-info/METADATA', 'Metadata-Version: 2.0\nName: dummy\nVersion: 1.0\n'),
+        ('dummy-1.0.dist-info/WHEEL', 'Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py2-none-any\nTag: py3-none-any\n'),
+        ('dummy-1.0.dist-info/entry_points.txt', '[console_scripts]\ndummy = dummy:main\n'),
+    )
+    wheel = ZipFile(path, 'w')
+    for name, content in files:
+        wheel.writestr(name, content)
+    wheel.writestr('dummy-1.0.dist-info/RECORD', ''.join('%s,,\n' % name for name, _ in files) + 'dummy-1.0.dist-info/RECORD,,\n')
+    wheel.close()
+
+
+def test_install_wheel(tmpdir):
+    tmpdir.chdir()
+    T.run('virtualenv', 'myvenv')
+    make_wheel('dummy-1.0-py2.py3-none-any.whl')
+
+    out, err = T.venv_update_script('''\
+import venv_update
+name, seconds = venv_update.install_wheel('dummy-1.0-py2.py3-none-any.whl')
+print(name)
+''', venv='myvenv')
+    assert err == ''
+    assert out == 'dummy\n'
+
+    # just as pip install would have: with its script, and a RECORD pip can uninstall
+    out, err = T.run('myvenv/bin/dummy')
+    assert out == 'dummy 1.0\n'
+    out, err = T.run('myvenv/bin/pip', 'freeze')
+    assert 'dummy==1.0\n' in out
+    T.run('myvenv/bin/pip', 'uninstall', '--yes', 'dummy')
+    assert not tmpdir.join('myvenv', 'bin', 'dummy').check()
+
+
+def test_shared_wheelhouse(tmpdir):
+    tmpdir.chdir()
+    T.requirements('flake8==2.2.5')
+    shared = tmpdir.join('shared')
+
+    # the first host builds, and publishes its wheels
+    out, err = T.venv_update('--cache-dir=host1', '--shared-wheelhouse=' + shared.strpath)
+    assert err == ''
+    assert '\n> pip wheel ' in T.uncolor(out)
+    assert glob(shared.strpath + '/*/flake8-2.2.5-*.whl')
+
+    # the second host fetches them, rather than building them again
+    T.run('rm', '-rf', 'virtualenv_run')
+    out, err = T.venv_update('--cache-dir=host2', '--shared-wheelhouse=' + shared.strpath)
+    assert err == ''
+    out = T.uncolor(out)
+    assert '\nFetching flake8-2.2.5-' in out
+    assert '\n> pip wheel ' not in out
+    assert glob('host2/wheelhouse/*/flake8-2.2.5-*.whl')
+    # and all of our other state lives in the cache dir too
+    assert T.Path('host2/costs.json').check()
+    assert T.Path('host2/hashes.json').check()
+
+
+def make_sdist(dist_dir, setup_py):
+    """An sdist of a project named "broken", version 1.0, in dist_dir."""
+    import tarfile
+    T.Path('broken-1.0').ensure_dir()
+    T.Path('broken-1.0/setup.py').write(setup_py)
+    T.Path('broken-1.0/PKG-INFO').write('Metadata-Version: 1.0\nName: broken\nVersion: 1.0\n')
+    T.Path(dist_dir).ensure_dir()
+    sdist = tarfile.open(dist_dir + '/broken-1.0.tar.gz', 'w:gz')
+    sdist.add('broken-1.0')
+    sdist.close()
+    T.run('rm', '-rf', 'broken-1.0')
+
+
+def test_failed_wheel_builds_are_remembered(tmpdir):
+    tmpdir.chdir()
+    # it can be installed, but not built as a wheel
+    make_sdist('dist', '''\
+from setuptools import setup
+from setuptools import Command
+
+
+class bdist_wheel(Command):
+    user_options = [('dist-dir=', 'd', '')]
+
+    def initialize_options(self):
+        self.dist_dir = None
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        raise SystemExit('no wheels for you')
+
+setup(name='broken', version='1.0', cmdclass={'bdist_wheel': bdist_wheel})
+''')
+    T.requirements('--find-links=dist\nbroken==1.0\n')
+
+    out, err = T.venv_update()
+    out = T.uncolor(out)
+    assert 'no wheels for you' in out
+    assert 'failed before' not in out
+    assert len(tmpdir.join('.pip/wheelhouse/.failures').listdir()) == 1
+    assert 'broken==1.0' in T.run('virtualenv_run/bin/pip', 'freeze')[0].split()
+
+    # the next time, it isn't built again: we're shown the log from last time
+    out, err = T.venv_update()
+    out = T.uncolor(out)
+    assert 'no wheels for you' in out
+    assert (
+        'Building a wheel for broken failed before, as above, and its inputs are unchanged: not trying again.\n'
+    ) in out
+
+    # it's built again once its inputs change
+    out, err = T.venv_update(CFLAGS='-O1')
+    assert 'failed before' not in T.uncolor(out)
+    assert len(tmpdir.join('.pip/wheelhouse/.failures').listdir()) == 2
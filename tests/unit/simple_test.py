@@ -58,6 +58,77 @@ pep8''')
     ]
 
 
+def test_parse_requirements_tree(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('wheels').ensure_dir()
+    tmpdir.join('reqs.txt').write('''\
+-r sub/reqs2.txt
+# a comment here
+mccabe  # and another
+-i https://pypi.example.com/simple
+--find-links wheels
+
+-e .
+pep8==1.0
+''')
+    tmpdir.join('sub/reqs2.txt').ensure().write('''\
+--no-index
+-f ../wheels
+--extra-index-url=https://other.example.com/simple
+pep8
+--editable=git+git://github.com/bukzor/cov-core.git@master#egg=cov-core
+''')
+
+    tree = venv_update.parse_requirements_tree(('reqs.txt',))
+    assert tree == dict(
+        files=[
+            ('reqs.txt', tmpdir.join('reqs.txt').computehash('sha1')),
+            ('sub/reqs2.txt', tmpdir.join('sub/reqs2.txt').computehash('sha1')),
+        ],
+        options=[
+            '--no-index',
+            '--find-links=sub/../wheels',
+            '--extra-index-url=https://other.example.com/simple',
+            '--index-url=https://pypi.example.com/simple',
+            '--find-links=wheels',
+        ],
+        requirements=[
+            (False, 'pep8', '-r sub/reqs2.txt (line 4)'),
+            (True, 'git+git://github.com/bukzor/cov-core.git@master#egg=cov-core', '-r sub/reqs2.txt (line 5)'),
+            (False, 'mccabe', '-r reqs.txt (line 3)'),
+            (True, '.', '-r reqs.txt (line 7)'),
+            (False, 'pep8==1.0', '-r reqs.txt (line 8)'),
+        ],
+    )
+    assert venv_update.requirements_tree_is_current(tree)
+
+    tmpdir.join('sub/reqs2.txt').write('pep8\n')
+    assert not venv_update.requirements_tree_is_current(tree)
+
+
+def test_cached_requirements_tree(tmpdir):
+    tmpdir.chdir()
+    reqs = tmpdir.join('reqs.txt')
+    reqs.write('-r reqs2.txt\nmccabe\n')
+    tmpdir.join('reqs2.txt').write('pep8\n')
+    cache = tmpdir.join('cache')
+
+    tree = venv_update.cached_requirements_tree(('reqs.txt',), cache.strpath)
+    assert [line for _, line, _ in tree['requirements']] == ['pep8', 'mccabe']
+    cached, = cache.listdir()
+
+    # the cached tree is used, as long as the files are unchanged
+    cached.write(cached.read().replace('mccabe', 'pyflakes'))
+    tree = venv_update.cached_requirements_tree(('reqs.txt',), cache.strpath)
+    assert [line for _, line, _ in tree['requirements']] == ['pep8', 'pyflakes']
+
+    # a change to any file in the tree causes a re-parse
+    tmpdir.join('reqs2.txt').write('pep8==1.0\n')
+    tree = venv_update.cached_requirements_tree(('reqs.txt',), cache.strpath)
+    assert [line for _, line, _ in tree['requirements']] == ['pep8==1.0', 'mccabe']
+    assert cache.listdir() == [cached]
+
+
 def test_pip_get_installed():
     installed = venv_update.pip_get_installed()
     installed = venv_update.reqnames(installed)
@@ -134,6 +205,60 @@ def test_parseargs(args, expected):
     assert venv_update.parseargs(args) == expected
 
 
+@pytest.mark.parametrize('args,expected', [
+    (
+        (),
+        ({}, ()),
+    ), (
+        ('a', 'b'),
+        ({}, ('a', 'b')),
+    ), (
+        ('--offline', 'a', 'b'),
+        ({'offline': True}, ('a', 'b')),
+    ), (
+        ('a', '--system-site-packages', '--offline', 'b'),
+        ({'offline': True}, ('a', '--system-site-packages', 'b')),
+    ), (
+        ('--stage2', '--offline=', 'a'),
+        ({'offline': True}, ('--stage2', 'a')),
+    ),
+])
+def test_parseopts(args, expected):
+    assert venv_update.parseopts(args) == expected
+
+
+@pytest.mark.parametrize('args,expected', [
+    (
+        ('venv', 'requirements.txt'),
+        (),
+    ), (
+        ('--system-site-packages', 'venv1:reqs1.txt,reqs2.txt', 'venv2:reqs3.txt'),
+        (('venv1', ('reqs1.txt', 'reqs2.txt')), ('venv2', ('reqs3.txt',))),
+    ), (
+        ('venv1:reqs1.txt', 'venv2', 'venv3:'),
+        (('venv1', ('reqs1.txt',)), ('venv2', ('requirements.txt',)), ('venv3', ('requirements.txt',))),
+    ), (
+        # requirements files given by url
+        ('venv', 'http://host/reqs.txt', 'file:reqs2.txt', 'file:///tmp/reqs3.txt'),
+        (),
+    ), (
+        ('venv1:http://host/reqs.txt,reqs2.txt', 'venv2:file:reqs3.txt'),
+        (('venv1', ('http://host/reqs.txt', 'reqs2.txt')), ('venv2', ('file:reqs3.txt',))),
+    ),
+])
+def test_parse_targets(args, expected):
+    assert venv_update.parse_targets(args) == expected
+
+
+@pytest.mark.parametrize('options,expected', [
+    ({}, ()),
+    ({'offline': True}, ('--offline',)),
+    ({'offline': True, 'some_opt': 'val'}, ('--offline', '--some-opt=val')),
+])
+def test_unparseopts(options, expected):
+    assert venv_update.unparseopts(options) == expected
+
+
 @pytest.mark.parametrize('args', [
     ('-h',),
     ('a', '-h',),
@@ -223,10 +348,823 @@ def test_req_is_absolute(req, expected):
     assert venv_update.req_is_absolute(req) is expected
 
 
+@pytest.mark.parametrize('rev,expected', [
+    (None, False),
+    ('master', False),
+    ('58c66aa', False),
+    ('58c66aa083777059a2e6b46f6a0545a2f4977097', True),
+    ('58C66AA083777059A2E6B46F6A0545A2F4977097', False),
+])
+def test_vcs_commit_id(rev, expected):
+    assert venv_update.vcs_commit_id(rev) is expected
+
+
+@pytest.mark.parametrize('url,expected', [
+    (
+        'git+git://github.com/bukzor/cov-core.git@master#egg=cov-core',
+        ('git', 'git://github.com/bukzor/cov-core.git', 'master'),
+    ), (
+        'git+ssh://git@github.com/Yelp/venv-update.git',
+        ('git', 'ssh://git@github.com/Yelp/venv-update.git', None),
+    ), (
+        'git+git@github.com:Yelp/venv-update.git@v1.0',
+        ('git', 'git@github.com:Yelp/venv-update.git', 'v1.0'),
+    ), (
+        'git+file:///my/random/project@feature/branch#egg=project',
+        ('git', 'file:///my/random/project', 'feature/branch'),
+    ), (
+        # pip's InstallRequirement.from_line drops the empty host
+        'git+file:/my/random/project@v1.0#egg=project',
+        ('git', 'file:///my/random/project', 'v1.0'),
+    ),
+])
+def test_vcs_url_parts(url, expected):
+    assert venv_update.vcs_url_parts(url) == expected
+
+
 def test_req_is_absolute_null():
     assert venv_update.req_is_absolute(None) is False
 
 
+def test_editable_target():
+    installs = {'/repo': '1.egg-link', '/repo/sub/src': '2.egg-link', '/other': '3.egg-link'}
+    assert venv_update.editable_target('/repo', installs) == '/repo'
+    assert venv_update.editable_target('/repo/sub', installs) == '/repo/sub/src'
+    assert venv_update.editable_target('/elsewhere', installs) is None
+
+
+def test_editable_fingerprint(tmpdir):
+    src = tmpdir.join('proj').ensure_dir()
+    egg_link = tmpdir.join('proj.egg-link')
+    installs = {src.strpath: egg_link.strpath}
+    assert venv_update.editable_fingerprint(src.strpath, {}) is None
+
+    src.join('setup.py').write('setup()')
+    egg_link.write(src.strpath + '\n.')
+    pkg_info = src.join('proj.egg-info', 'PKG-INFO').ensure()
+    fingerprint = venv_update.editable_fingerprint(src.strpath, installs)
+    assert fingerprint == venv_update.editable_fingerprint(src.strpath, installs)
+
+    # unrelated changes don't matter
+    src.join('proj.py').write('print("hello")')
+    assert fingerprint == venv_update.editable_fingerprint(src.strpath, installs)
+
+    for changed in (src.join('setup.py'), src.join('setup.cfg'), pkg_info, egg_link):
+        changed.write('changed', mode='a')
+        assert fingerprint != venv_update.editable_fingerprint(src.strpath, installs)
+        fingerprint = venv_update.editable_fingerprint(src.strpath, installs)
+
+
+def test_file_lock(tmpdir):
+    lock = tmpdir.join('dir', 'lock').strpath
+    with venv_update.file_lock(lock) as locked:
+        assert locked is True
+        with venv_update.file_lock(lock, shared=True, blocking=False) as locked:
+            assert locked is False
+
+    with venv_update.file_lock(lock, shared=True) as locked:
+        assert locked is True
+        with venv_update.file_lock(lock, shared=True, blocking=False) as locked:
+            assert locked is True
+        with venv_update.file_lock(lock, blocking=False) as locked:
+            assert locked is False
+
+
+def test_file_lock_is_not_inherited(tmpdir):
+    from subprocess import Popen
+    lock = tmpdir.join('lock').strpath
+    with venv_update.file_lock(lock):
+        # e.g. a background delete, which outlives the lock
+        sleeper = Popen(('sleep', '10'), close_fds=False)
+    try:
+        with venv_update.file_lock(lock, blocking=False) as locked:
+            assert locked is True
+    finally:
+        sleeper.kill()
+        sleeper.wait()
+
+
+def test_atomic_file(tmpdir):
+    path = tmpdir.join('file')
+    path.write('old')
+    with venv_update.atomic_file(path.strpath) as atomic:
+        atomic.write('new')
+        assert path.read() == 'old'
+    assert path.read() == 'new'
+
+    with pytest.raises(ZeroDivisionError):
+        with venv_update.atomic_file(path.strpath) as atomic:
+            atomic.write('partial')
+            1 / 0  # pylint:disable=pointless-statement
+    assert path.read() == 'new'
+    assert tmpdir.listdir() == [path]
+
+    # a bare filename is in the current directory
+    tmpdir.chdir()
+    with venv_update.atomic_file('bare') as atomic:
+        atomic.write('bare')
+    assert tmpdir.join('bare').read() == 'bare'
+
+
+def test_venv_just_updated(tmpdir, monkeypatch):
+    import json
+    monkeypatch.setattr(venv_update, 'venv_validation', lambda venv_path, venv_args: ['validation', venv_args])
+    tmpdir.chdir()
+    venv = tmpdir.join('venv').ensure_dir().strpath
+    Path('requirements.txt').write('foo==1.0\n')
+
+    def just_updated():
+        return venv_update.venv_just_updated(venv, ('requirements.txt',), ['--venv-arg'], {})
+
+    assert not just_updated()
+    Path(venv).join('.venv-update.state').write(json.dumps({'validation': ['validation', ['--venv-arg']]}))
+    assert not just_updated()
+
+    venv_update.write_json_atomic(
+        venv_update.venv_applied_path(venv),
+        dict(inputs=venv_update.venv_inputs(venv, ('requirements.txt',), {}), installed=[]),
+    )
+    assert just_updated()
+
+    # a different venv_validation, different wheelhouses, or changed requirements: that's not what was just applied
+    assert not venv_update.venv_just_updated(venv, ('requirements.txt',), [], {})
+    assert not venv_update.venv_just_updated(venv, ('requirements.txt',), ['--venv-arg'], {'remote_wheelhouse': 'x'})
+    # but options which don't change what's installed don't matter
+    assert venv_update.venv_just_updated(venv, ('requirements.txt',), ['--venv-arg'], {
+        'offline': True, 'jobs': '4', 'check': True, 'build_forkserver': True, 'cache_dir': 'cache',
+    })
+    Path('requirements.txt').write('foo==2.0\n')
+    assert not just_updated()
+    Path('requirements.txt').write('foo==1.0\n')
+    assert just_updated()
+
+    venv_update.forget_venv_inputs(venv)
+    assert not just_updated()
+
+
+def test_relocate_venv(tmpdir):
+    import os
+    venv = tmpdir.join('new')
+    script = venv.join('bin', 'script').ensure()
+    script.write('#!/old/bin/python\nimport sys\n')
+    script.chmod(0o755)
+    venv.join('bin', 'python').write_binary(b'\0/old/bin/python')
+    pth = venv.join('lib', 'site-packages', 'easy-install.pth').ensure()
+    pth.write('/old/src/project\n/older/src\n')
+    venv.join('lib', 'unrelated.txt').write('/old/')
+    os.symlink('/old/bin', venv.join('local-bin').strpath)
+    os.symlink('/usr/include', venv.join('include').strpath)
+
+    venv_update.relocate_venv(venv.strpath, '/old', '/new')
+
+    assert script.read() == '#!/new/bin/python\nimport sys\n'
+    assert script.stat().mode & 0o777 == 0o755
+    assert venv.join('bin', 'python').read_binary() == b'\0/old/bin/python'
+    assert pth.read() == '/new/src/project\n/older/src\n'
+    assert venv.join('lib', 'unrelated.txt').read() == '/old/'
+    assert os.readlink(venv.join('local-bin').strpath) == '/new/bin'
+    assert os.readlink(venv.join('include').strpath) == '/usr/include'
+
+
+def test_pool(tmpdir):
+    import json
+    import os
+    pool = tmpdir.strpath
+    validation = ['python', 'virtualenv', [], '/venv']
+
+    def pooled(key, requirements, mtime, validation=validation):
+        tmpdir.join(key).ensure_dir()
+        metadata = tmpdir.join(key + '.json')
+        metadata.write(json.dumps(dict(validation=validation[:-1], requirements=requirements)))
+        os.utime(metadata.strpath, (mtime, mtime))
+
+    assert venv_update.pool_nearest(pool, validation, ['a==1']) is None
+    pooled('old', ['a==1', 'b==1'], 1000)
+    pooled('recent', ['c==1'], 3000)
+    pooled('other-python', ['a==1', 'b==1'], 4000, validation=['pypy', 'virtualenv', [], '/venv'])
+    assert venv_update.pool_nearest(pool, validation, ['a==1', 'b==2']) == 'old'
+    assert venv_update.pool_nearest(pool, validation, ['d==1']) == 'recent'
+
+    assert [key for key, _ in venv_update.pool_entries(pool)] == ['other-python', 'recent', 'old']
+    venv_update.pool_evict(pool, 2, keep='old')
+    # the evicted virtualenv is deleted in the background
+    assert sorted(
+        path.basename for path in tmpdir.listdir() if not path.basename.startswith(venv_update.TRASH_PREFIX)
+    ) == ['old', 'old.json', 'other-python', 'other-python.json']
+
+
+@pytest.mark.parametrize('previous,current,patched', [
+    ('2.7.6 (default, Mar 22 2014, 22:59:56) \n[GCC 4.8.2]', '2.7.9 (default, Apr  2 2015, 15:33:21) \n[GCC 4.9.2]', True),
+    ('2.7.9 (default, Apr  2 2015, 15:33:21) \n[GCC 4.9.2]', '3.4.3 (default, Mar 26 2015, 22:03:40) \n[GCC 4.9.2]', False),
+    ('2.7.8 (f5dcc2477b97, Sep 18 2014, 11:33:30)\n[PyPy 2.4.0 with GCC 4.6.3]',
+     '2.7.8 (10f1b29a2bd2, Feb 02 2015, 21:22:43)\n[PyPy 2.5.0 with GCC 4.6.3]', False),
+    ('2.7.8 (f5dcc2477b97, Sep 18 2014, 11:33:30)\n[PyPy 2.4.0 with GCC 4.6.3]',
+     '2.7.8 (a980ebb26592, Oct 02 2014, 11:33:30)\n[PyPy 2.4.1 with GCC 4.6.3]', True),
+])
+def test_python_patched(previous, current, patched):
+    validation = [current, '1.11.6', [], '/venv']
+    assert venv_update.python_patched([previous] + validation[1:], validation) is patched
+    assert not venv_update.python_patched([previous, '12.0', [], '/venv'], validation)
+    assert not venv_update.python_patched(validation, validation)
+    assert not venv_update.python_patched(None, validation)
+
+
+def test_abi_specific_dists(tmpdir):
+    site_packages = tmpdir.join('lib', 'python2.7', 'site-packages')
+    site_packages.join('pure-1.0.dist-info', 'WHEEL').ensure().write('Wheel-Version: 1.0\nTag: py2.py3-none-any\n')
+    site_packages.join('compiled-1.0.dist-info', 'WHEEL').ensure().write('Wheel-Version: 1.0\nTag: cp27-none-linux_x86_64\n')
+    site_packages.join('pure_sdist-1.0-py2.7.egg-info', 'installed-files.txt').ensure().write('../pure_sdist.py\n')
+    site_packages.join('ext_sdist-1.0-py2.7.egg-info', 'installed-files.txt').ensure().write('../ext_sdist/_speedups.so\n')
+    assert venv_update.abi_specific_dists(tmpdir.strpath) == ['compiled', 'ext_sdist']
+
+
+@pytest.mark.parametrize('line,name', [
+    ('PyYAML==3.11', 'pyyaml'),
+    ('simple_json >= 3', 'simple-json'),
+    ('lxml[html]', 'lxml'),
+    ('zope.interface', 'zope.interface'),
+    ('git+https://github.com/Yelp/venv-update.git#egg=venv-update', None),
+    ('./src/project', None),
+])
+def test_requirement_line_name(line, name):
+    assert venv_update.requirement_line_name(line) == name
+
+
+def test_costs(tmpdir):
+    pipdir = tmpdir.join('.pip').strpath
+    assert venv_update.costs_load(pipdir) == {}
+
+    venv_update.costs_record([('lxml', 'build', 40.0), ('lxml', 'install', 1.0), ('six', 'install', 0.5)], pipdir)
+    venv_update.costs_record([('lxml', 'build', 20.0)], pipdir)
+    costs = venv_update.costs_load(pipdir)
+    assert costs == {'lxml': {'build': 30.0, 'install': 1.0}, 'six': {'install': 0.5}}
+    assert venv_update.costs_predict(costs, 'lxml', ('download', 'build', 'install')) == 31.0
+    assert venv_update.costs_predict(costs, 'six', ('download', 'build')) == 0
+    assert venv_update.costs_predict(costs, 'pyyaml', ('install',)) is None
+
+    tmpdir.chdir()
+    Path('requirements.txt').write('lxml==3.4.0\nsix\npyyaml\n')
+    assert venv_update.requirements_cost(costs, ('requirements.txt',)) == 31.5
+    tmpdir.join('wheelhouse', 'cp27-none-linux_x86_64', 'lxml-3.4.0-cp27-none-linux_x86_64.whl').ensure()
+    assert venv_update.requirements_cost(costs, ('requirements.txt',), tmpdir.join('wheelhouse').strpath) == 1.5
+
+
+def test_verified_hashes(tmpdir, monkeypatch):
+    from hashlib import sha256
+    pipdir = tmpdir.join('.pip').strpath
+    wheels = [tmpdir.join('wheelhouse', 'a.whl'), tmpdir.join('wheelhouse', 'b.whl')]
+    for wheel in wheels:
+        wheel.ensure().write(wheel.basename)
+    paths = [wheel.strpath for wheel in wheels]
+    expected = dict((wheel.strpath, sha256(wheel.basename.encode('UTF-8')).hexdigest()) for wheel in wheels)
+    assert venv_update.verified_hashes(paths, pipdir) == expected
+    # what's remembered must compare equal to a fresh stat, after the round-trip through json
+    assert venv_update.hashes_load(pipdir)[paths[0]][:3] == venv_update.file_identity(paths[0])
+    assert not isinstance(venv_update.file_identity(paths[0])[1], float)
+
+    # once seen, an unchanged file isn't read again
+    def unexpected(path):
+        raise AssertionError('hashed %s again' % path)
+    monkeypatch.setattr(venv_update, 'file_sha256', unexpected)
+    assert venv_update.verified_hashes(paths, pipdir) == expected
+
+    monkeypatch.undo()
+    wheels[0].write('changed!')
+    expected[paths[0]] = sha256(b'changed!').hexdigest()
+    assert venv_update.verified_hashes(paths, pipdir) == expected
+
+    wheels[1].remove()
+    venv_update.verified_hashes(paths[:1] + [tmpdir.join('wheelhouse', 'c.whl').ensure().strpath], pipdir)
+    assert sorted(venv_update.hashes_load(pipdir)) == [paths[0], tmpdir.join('wheelhouse', 'c.whl').strpath]
+
+
+def test_format_seconds():
+    assert venv_update.format_seconds(0) == '0.0s'
+    assert venv_update.format_seconds(12.34) == '12.3s'
+    assert venv_update.format_seconds(754.2) == '12m34s'
+
+
+@pytest.mark.parametrize('installed,version,action', [
+    (None, '1.0', 'install'),
+    ('1.0', '1.0', None),
+    ('1.0', None, None),
+    ('1.0', '1.10', 'upgrade'),
+    ('1.10', '1.9', 'downgrade'),
+])
+def test_dry_run_action(installed, version, action):
+    assert venv_update.dry_run_action(installed, version) == action
+
+
+def test_download_cache_index(tmpdir):
+    assert venv_update.download_cache_index(tmpdir.join('nonexistent').strpath) == set()
+    for url in (
+            'https://pypi.python.org/packages/source/p/python-dateutil/python-dateutil-2.2.tar.gz',
+            'https://pypi.python.org/packages/source/P/PyYAML/PyYAML-3.11.zip',
+    ):
+        tmpdir.join(url.replace(':', '%3A').replace('/', '%2F')).write('')
+        tmpdir.join(url.replace(':', '%3A').replace('/', '%2F') + '.content-type').write('application/x-tar')
+    assert venv_update.download_cache_index(tmpdir.strpath) == set([('python-dateutil', '2.2'), ('pyyaml', '3.11')])
+
+
+def test_console_scripts():
+    entry_points = b'''\
+[console_scripts]
+foo = foo:main
+foo-admin=foo.admin:main
+
+[foo.plugins]
+bar = foo.bar
+
+[gui_scripts]
+foo-gui = foo.gui:main
+'''
+    assert list(venv_update.console_scripts(entry_points)) == ['foo', 'foo-admin', 'foo-gui']
+
+
+def make_wheel(path, members):
+    from zipfile import ZipFile
+    archive = ZipFile(path.strpath, 'w')
+    for member, content in members.items():
+        archive.writestr(member, content)
+    archive.close()
+    return path.strpath
+
+
+def test_wheel_collisions(tmpdir):
+    foo = make_wheel(tmpdir.join('foo-1.0-py2.py3-none-any.whl'), {
+        'foo/__init__.py': '',
+        'foo-1.0.dist-info/RECORD': '',
+        'foo-1.0.dist-info/entry_points.txt': '[console_scripts]\nfoo = foo:main\n',
+        'foo-1.0.data/purelib/shared/__init__.py': '',
+    })
+    bar = make_wheel(tmpdir.join('bar-1.0-py2.py3-none-any.whl'), {
+        'bar.py': '',
+        'bar-1.0.dist-info/RECORD': '',
+        'bar-1.0.data/scripts/bar': '',
+    })
+    assert venv_update.wheel_collisions([foo, bar]) == {}
+    assert sorted(venv_update.wheel_destinations(foo)) == [
+        'lib/foo-1.0.dist-info/RECORD',
+        'lib/foo-1.0.dist-info/entry_points.txt',
+        'lib/foo/__init__.py',
+        'lib/shared/__init__.py',
+        'scripts/foo',
+    ]
+
+    shared = make_wheel(tmpdir.join('shared-1.0-py2.py3-none-any.whl'), {
+        'shared/__init__.py': '',
+        'shared-1.0.data/scripts/foo': '',
+    })
+    assert venv_update.wheel_collisions([foo, bar, shared]) == {
+        'lib/shared/__init__.py': [foo, shared],
+        'scripts/foo': [foo, shared],
+    }
+
+
+def test_unzip_file(tmpdir):
+    from hashlib import sha256
+    from os import umask
+    from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+    stored = b'stored\n' * 1000
+    deflated = b'deflated\n' * 1000
+
+    def record(foo_hash):
+        return 'foo/stored.py,%s,\nfoo/deflated.py,%s,\nfoo-1.0.dist-info/RECORD,,\n' % (
+            foo_hash,
+            venv_update.record_hash(sha256(deflated)),
+        )
+
+    def make(name, record):
+        path = tmpdir.join(name).strpath
+        archive = ZipFile(path, 'w')
+        info = ZipInfo('foo/stored.py')
+        info.external_attr = 0o100755 << 16
+        archive.writestr(info, stored)
+        info = ZipInfo('foo/deflated.py')
+        info.compress_type = ZIP_DEFLATED
+        archive.writestr(info, deflated)
+        archive.writestr('foo-1.0.dist-info/RECORD', record)
+        archive.close()
+        return path
+
+    wheel = make('good.whl', record(venv_update.record_hash(sha256(stored))))
+    old_umask = umask(0o027)
+    try:
+        venv_update.unzip_file(wheel, tmpdir.join('good').strpath, flatten=False)
+    finally:
+        umask(old_umask)
+    assert tmpdir.join('good', 'foo', 'stored.py').read_binary() == stored
+    assert tmpdir.join('good', 'foo', 'deflated.py').read_binary() == deflated
+    # executable, within the umask
+    assert tmpdir.join('good', 'foo', 'stored.py').stat().mode & 0o777 == 0o751
+
+    wheel = make('bad.whl', record(venv_update.record_hash(sha256(b'tampered'))))
+    with pytest.raises(Exception) as excinfo:
+        venv_update.unzip_file(wheel, tmpdir.join('bad').strpath, flatten=False)
+    assert 'foo/stored.py does not match the hash in its RECORD' in str(excinfo.value)
+
+
+def test_trash_directory(tmpdir):
+    from time import sleep
+    tmpdir.join('venv', 'bin', 'python').ensure()
+    tmpdir.join('other-venv').ensure_dir()
+    # left behind by a crash
+    tmpdir.join(venv_update.TRASH_PREFIX + 'crashed', 'venv', 'bin', 'python').ensure()
+
+    venv_update.trash_directory(tmpdir.join('venv').strpath)
+    assert not tmpdir.join('venv').exists()
+
+    for _ in range(100):
+        if [path.basename for path in tmpdir.listdir()] == ['other-venv']:
+            break
+        sleep(.05)
+    assert [path.basename for path in tmpdir.listdir()] == ['other-venv']
+
+
+def test_wheel_tag():
+    assert venv_update.wheel_tag('six-1.9.0-py2.py3-none-any.whl') == 'py2.py3-none-any'
+    assert venv_update.wheel_tag('lxml-3.4.0-1-cp27-none-linux_x86_64.whl') == 'cp27-none-linux_x86_64'
+
+
+def test_wheelhouse_partitions(tmpdir, monkeypatch):
+    monkeypatch.setattr(venv_update, 'supported_tags', lambda: frozenset([
+        ('cp27', 'none', 'linux_x86_64'),
+        ('py2', 'none', 'any'),
+    ]))
+    wheelhouse = tmpdir.join('wheelhouse')
+    assert venv_update.wheelhouse_partitions(wheelhouse.strpath) == []
+
+    # an unpartitioned wheelhouse, as left by earlier versions
+    for wheel in (
+            'six-1.9.0-py2.py3-none-any.whl',
+            'lxml-3.4.0-cp27-none-linux_x86_64.whl',
+            'lxml-3.4.0-cp34-cp34m-linux_x86_64.whl',
+    ):
+        wheelhouse.join(wheel).ensure()
+    wheelhouse.join('.locks').ensure_dir()
+    venv_update.wheelhouse_migrate(wheelhouse.strpath)
+
+    assert sorted(path.basename for path in wheelhouse.listdir()) == [
+        '.locks', 'cp27-none-linux_x86_64', 'cp34-cp34m-linux_x86_64', 'py2.py3-none-any',
+    ]
+    assert wheelhouse.join('py2.py3-none-any', 'six-1.9.0-py2.py3-none-any.whl').check(file=True)
+    usable = [wheelhouse.join('cp27-none-linux_x86_64').strpath, wheelhouse.join('py2.py3-none-any').strpath]
+    assert venv_update.wheelhouse_partitions(wheelhouse.strpath) == usable
+    assert venv_update.wheelhouse_find_links(['file://' + wheelhouse.strpath, 'https://example.com/wheels']) == [
+        'file://' + wheelhouse.strpath,
+        'file://' + usable[0],
+        'file://' + usable[1],
+        'https://example.com/wheels',
+    ]
+
+
+def test_wheel_dist(tmpdir):
+    from zipfile import ZipFile
+    wheel = tmpdir.join('proj-1.0-py2.py3-none-any.whl').strpath
+    archive = ZipFile(wheel, 'w')
+    archive.writestr('proj-1.0.dist-info/METADATA', (
+        'Metadata-Version: 2.0\nName: proj\nVersion: 1.0\nAuthor: Ren\u00e9\nRequires-Dist: six (>=1.8)\n'
+    ).encode('UTF-8'))
+    archive.close()
+
+    dist = venv_update.wheel_dist(wheel)
+    assert (dist.key, dist.version) == ('proj', '1.0')
+    assert [str(req) for req in dist.requires()] == ['six>=1.8']
+
+
+def test_wheelhouse_misses(monkeypatch):
+    from collections import namedtuple
+    from pkg_resources import Requirement
+    Req = namedtuple('Req', 'req url')
+
+    def wheelhouse_resolve(plan, wheelhouse, union):
+        return [(arg, Req(Requirement.parse(arg), None), None) for arg in plan]
+    monkeypatch.setattr(venv_update, 'wheelhouse_resolve', wheelhouse_resolve)
+
+    assert venv_update.wheelhouse_misses(['mccabe==0.3', 'pep8'], 'wheelhouse') == [['mccabe==0.3', 'pep8']]
+    # in a union, pip wheel is given one requirement of each project at a time
+    assert venv_update.wheelhouse_misses(['mccabe==0.3', 'pep8', 'mccabe==0.2.1', 'mccabe'], 'wheelhouse', union=True) == [
+        ['mccabe==0.3', 'pep8'], ['mccabe==0.2.1'], ['mccabe'],
+    ]
+
+
+def test_wheelhouse_tiers():
+    assert venv_update.wheelhouse_tiers({}) == []
+    options = {'shared_wheelhouse': '/nfs/wheelhouse', 'remote_wheelhouse': 'http://wheels.example.com/'}
+    assert venv_update.wheelhouse_tiers(options) == ['/nfs/wheelhouse', 'http://wheels.example.com']
+    options['offline'] = True
+    assert venv_update.wheelhouse_tiers(options) == ['/nfs/wheelhouse']
+
+
+@pytest.fixture
+def wheel_server(tmpdir):
+    """A local HTTP server, of the kind --remote-wheelhouse expects: directory listings, and PUT."""
+    import os
+    from threading import Thread
+    try:
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+    except ImportError:  # python2
+        from BaseHTTPServer import HTTPServer
+        from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_PUT(self):
+            path = self.translate_path(self.path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as put:
+                put.write(self.rfile.read(int(self.headers['Content-Length'])))
+            self.send_response(201)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    root = tmpdir.join('server').ensure_dir()
+    with root.as_cwd():
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            yield 'http://127.0.0.1:%i' % server.server_address[1], root
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+def test_tier_publish(tmpdir, wheel_server):
+    url, root = wheel_server
+    wheel = tmpdir.join('foo_bar-1.0+local-py2.py3-none-any.whl')
+    wheel.write('wheel!')
+
+    shared = tmpdir.join('shared').strpath
+    venv_update.wheelhouse_publish([wheel.strpath], [shared, url])
+    published = tmpdir.join('shared', 'py2.py3-none-any', wheel.basename)
+    assert published.read() == 'wheel!'
+    assert published.stat().mode & 0o777 == 0o644
+    assert root.join('py2.py3-none-any', wheel.basename).read() == 'wheel!'
+
+    assert 'py2.py3-none-any/' in venv_update.http_links(url)
+    assert venv_update.http_links(url + '/py2.py3-none-any') == [wheel.basename]
+
+    # a tier we can't publish to is skipped
+    venv_update.wheelhouse_publish([wheel.strpath], [url + '/nonexistent/../../..'])
+
+
+def test_bundles(tmpdir, monkeypatch):
+    from hashlib import sha256
+    from io import BytesIO
+
+    def bundle(name, wheels, content=lambda wheel: wheel):
+        index = [
+            dict(
+                path=venv_update.wheel_tag(wheel) + '/' + wheel, name=wheel.split('-')[0], version=wheel.split('-')[1],
+                size=len(wheel), sha256=sha256(content(wheel).encode('UTF-8')).hexdigest(),
+            )
+            for wheel in wheels
+        ]
+        path = tmpdir.join(name).strpath
+        venv_update.bundle_write(path, index, lambda entry: BytesIO(entry['path'].split('/')[1].encode('UTF-8')))
+        return path
+
+    py2 = bundle('py2.bundle', ['six-1.9.0-py2.py3-none-any.whl', 'lxml-3.4.0-cp27-none-linux_x86_64.whl'])
+    py3 = bundle('py3.bundle', ['six-1.9.0-py2.py3-none-any.whl', 'lxml-3.4.0-cp34-cp34m-linux_x86_64.whl'])
+    venv_update.bundle_merge([py2, py3], tmpdir.join('all.bundle').strpath)
+
+    wheelhouse = tmpdir.join('wheelhouse')
+    wheelhouse.join('py2.py3-none-any', 'six-1.9.0-py2.py3-none-any.whl').ensure().write('already here')
+    venv_update.bundle_import(tmpdir.join('all.bundle').strpath, wheelhouse.strpath, tmpdir.strpath)
+    assert sorted(path.relto(wheelhouse) for path in wheelhouse.visit('*.whl')) == [
+        'cp27-none-linux_x86_64/lxml-3.4.0-cp27-none-linux_x86_64.whl',
+        'cp34-cp34m-linux_x86_64/lxml-3.4.0-cp34-cp34m-linux_x86_64.whl',
+        'py2.py3-none-any/six-1.9.0-py2.py3-none-any.whl',
+    ]
+    lxml = wheelhouse.join('cp34-cp34m-linux_x86_64', 'lxml-3.4.0-cp34-cp34m-linux_x86_64.whl')
+    assert lxml.read() == lxml.basename
+    assert wheelhouse.join('py2.py3-none-any', 'six-1.9.0-py2.py3-none-any.whl').read() == 'already here'
+    assert [path.basename for path in wheelhouse.listdir() if path.basename.startswith('.')] == []
+
+    # a corrupt bundle is refused
+    corrupt = bundle('corrupt.bundle', [lxml.basename], content=lambda wheel: 'something else')
+    lxml.remove()
+    with pytest.raises(SystemExit):
+        venv_update.bundle_import(corrupt, wheelhouse.strpath, tmpdir.strpath)
+    assert not lxml.exists()
+
+
+def test_cached_download_name_version():
+    name_version = venv_update.cached_download_name_version
+    assert name_version('https%3A%2F%2Fpypi.python.org%2Fpackages%2Fsource%2Fp%2Fpep8%2Fpep8-1.5.7.tar.gz') == (
+        'pep8', '1.5.7',
+    )
+    assert name_version('https%3A%2F%2Fexample.com%2FZope.Interface-4.1.2.zip%23md5%3Dabc') == ('zope.interface', '4.1.2')
+    assert name_version('https%3A%2F%2Fexample.com%2Fpy_yaml-3.11-cp27-none-linux_x86_64.whl') == ('py-yaml', '3.11')
+
+
+def test_vcs_wheel_is_per_interpreter(tmpdir, monkeypatch):
+    from hashlib import sha1
+    monkeypatch.setattr(venv_update, 'supported_tags', lambda: frozenset([('py2', 'none', 'any'), ('cp27', 'none', 'any')]))
+    monkeypatch.setattr(venv_update, 'vcs_resolve', lambda vcs, repo, rev, mirror, offline: 'abc123')
+    monkeypatch.setattr(venv_update, 'info', lambda msg: None)
+    builds = []
+
+    def vcs_build_wheel(vcs, repo, commit, mirror, wheel_dir, pip_opts, pipdir):
+        builds.append(commit)
+        tmpdir.join('vcs', 'wheels', key, 'proj-1.0-py2-none-any.whl').ensure()
+    monkeypatch.setattr(venv_update, 'vcs_build_wheel', vcs_build_wheel)
+
+    key = sha1(b'https://example.com/proj.git@abc123').hexdigest()
+    # another interpreter's wheel of the same commit
+    tmpdir.join('vcs', 'wheels', key, 'proj-1.0-py3-none-any.whl').ensure()
+    url = 'git+https://example.com/proj.git@master#egg=proj'
+    wheel = venv_update.vcs_wheel(url, tmpdir.strpath, (), offline=False)
+    assert wheel == tmpdir.join('vcs', 'wheels', key, 'proj-1.0-py2-none-any.whl').strpath
+    assert builds == ['abc123']
+
+    # and it's cached
+    assert venv_update.vcs_wheel(url, tmpdir.strpath, (), offline=False) == wheel
+    assert builds == ['abc123']
+
+
+def test_collect_garbage(tmpdir):
+    from collections import namedtuple
+    from pkg_resources import Requirement
+    Req = namedtuple('Req', 'req')
+    Dist = namedtuple('Dist', 'key version location')
+
+    pipdir = tmpdir.join('.pip')
+    venv_update.gc_registry(pipdir.strpath)
+    wheelhouse = pipdir.join('wheelhouse', 'py2.py3-none-any')
+    vcs_wheel = pipdir.join('vcs', 'wheels', 'abc123', 'project-1.0-py2.py3-none-any.whl').ensure()
+    pipdir.join('vcs', 'wheels', 'def456', 'project-0.9-py2.py3-none-any.whl').ensure()
+    pipdir.join('cache', 'https%3A%2F%2Fexample.com%2Fsix-1.9.0.tar.gz').ensure()
+    pipdir.join('cache', 'https%3A%2F%2Fexample.com%2Fsix-1.8.0.tar.gz').ensure()
+    pipdir.join('cache', 'https%3A%2F%2Fexample.com%2Fsix-1.8.0.tar.gz.content-type').ensure()
+    pipdir.join('cache', 'https%3A%2F%2Fexample.com%2Fpep8-1.5.7.tar.gz').ensure()
+    for wheel in ('six-1.9.0-py2.py3-none-any.whl', 'six-1.8.0-py2.py3-none-any.whl', 'mccabe-0.3-py2.py3-none-any.whl'):
+        wheelhouse.join(wheel).ensure()
+    pipdir.join('wheelhouse', '.build-crashed').ensure_dir()
+    pipdir.join('wheelhouse', '.failures', 'a.json').write('{"name": "Six", "url": null, "log": ""}', ensure=True)
+    pipdir.join('wheelhouse', '.failures', 'b.json').write('{"name": "unused", "url": null, "log": ""}')
+
+    six = wheelhouse.join('six-1.9.0-py2.py3-none-any.whl').strpath
+    mccabe = wheelhouse.join('mccabe-0.3-py2.py3-none-any.whl').strpath
+    one = tmpdir.join('one', 'requirements.txt').ensure()
+    venv_update.gc_register(pipdir.strpath, [one.strpath], [
+        ('six==1.9.0', Req(Requirement.parse('six==1.9.0')), Dist('six', '1.9.0', six)),
+        ('pep8', Req(Requirement.parse('pep8')), None),
+        (vcs_wheel.strpath, Req(Requirement.parse('project==1.0')), None),
+    ])
+    two = tmpdir.join('two', 'requirements.txt').ensure()
+    venv_update.gc_register(pipdir.strpath, [two.strpath], [
+        ('mccabe', Req(Requirement.parse('mccabe')), Dist('mccabe', '0.3', mccabe)),
+    ])
+    assert len(pipdir.join('roots').listdir('*.json')) == 2
+
+    def remaining():
+        # (the trash is reaped in the background)
+        return sorted(
+            path.relto(pipdir) for path in pipdir.visit(rec=lambda path: not path.basename.startswith(venv_update.TRASH_PREFIX))
+            if path.check(file=True) and not path.relto(pipdir).startswith(('roots', venv_update.TRASH_PREFIX))
+        )
+
+    venv_update.collect_garbage(pipdir.strpath)
+    assert remaining() == [
+        'cache/https%3A%2F%2Fexample.com%2Fpep8-1.5.7.tar.gz',
+        'cache/https%3A%2F%2Fexample.com%2Fsix-1.9.0.tar.gz',
+        'vcs/wheels/abc123/project-1.0-py2.py3-none-any.whl',
+        'wheelhouse/.failures/a.json',
+        'wheelhouse/py2.py3-none-any/mccabe-0.3-py2.py3-none-any.whl',
+        'wheelhouse/py2.py3-none-any/six-1.9.0-py2.py3-none-any.whl',
+    ]
+
+    # The first project is gone: its root is dead.
+    one.remove()
+    venv_update.collect_garbage(pipdir.strpath)
+    assert len(pipdir.join('roots').listdir('*.json')) == 1
+    assert remaining() == ['wheelhouse/py2.py3-none-any/mccabe-0.3-py2.py3-none-any.whl']
+
+
+def test_gc_leaves_the_trash_alone(tmpdir):
+    vcs_wheels = tmpdir.join('vcs', 'wheels')
+    trash = vcs_wheels.join(venv_update.TRASH_PREFIX + 'abc123-x', 'project-1.0-py2.py3-none-any.whl').ensure()
+    assert venv_update.gc_sweep_vcs_wheels(vcs_wheels.strpath, frozenset(), legacy=0) == 0
+    assert trash.check()
+    # what's been reaped meanwhile isn't an error
+    assert venv_update.gc_remove(vcs_wheels.join('gone').strpath, legacy=0) is False
+
+
+def test_dry_run_never_marks_the_venv_invalid(monkeypatch):
+    import sys
+    from subprocess import CalledProcessError
+
+    def fails(venv_path, reqs, options):
+        raise CalledProcessError(1, ('pip',))
+
+    monkeypatch.setattr(sys, 'argv', ['venv-update', '--dry-run', '--stage2', 'venv', 'requirements.txt'])
+    monkeypatch.setattr(sys, 'path', list(sys.path))  # (main drops the script's directory)
+    monkeypatch.setattr(venv_update, 'stage2', fails)
+    monkeypatch.setattr(venv_update, 'mark_venv_invalid', lambda venv_path, reqs: pytest.fail('marked invalid'))
+    with pytest.raises(CalledProcessError):
+        venv_update.main()
+
+
+def test_rebuild_preflight(tmpdir, monkeypatch):
+    tmpdir.chdir()
+    tmpdir.join('requirements.txt').write('mccabe==0.3\n')
+    venv = tmpdir.join('venv')
+    venv.join('bin', 'python').ensure()
+    validation = ['2.7.9', '1.11.6', [], venv.strpath]
+    runs = []
+    monkeypatch.setattr(venv_update, 'run', runs.append)
+
+    venv_update.rebuild_preflight(venv.strpath, validation, ('requirements.txt',), {})
+    assert runs == []
+    venv_update.rebuild_preflight(venv.strpath, validation, ('requirements.txt',), {'offline': True})
+    assert runs == [venv_update.stage2_command(
+        venv.strpath, ('requirements.txt',), {'offline': True, 'preflight': True},
+    )]
+
+    # what's restored from a snapshot needs nothing from the wheelhouse
+    snapshots = tmpdir.join('snapshots').strpath
+    Path(venv_update.snapshot_path(snapshots, validation, ('requirements.txt',))).ensure()
+    venv_update.rebuild_preflight(venv.strpath, validation, ('requirements.txt',), {'offline': True, 'snapshots': snapshots})
+    assert len(runs) == 1
+
+
+def test_build_failure_key(tmpdir, monkeypatch):
+    monkeypatch.setattr(venv_update, 'supported_tags', lambda: frozenset([('py2', 'none', 'any')]))
+    pipdir = tmpdir.join('.pip').strpath
+    monkeypatch.setenv('PIP_DOWNLOAD_CACHE', tmpdir.join('cache').strpath)
+    monkeypatch.delenv('CFLAGS', raising=False)
+    sdist = tmpdir.join('dist', 'broken-1.0.tar.gz').ensure()
+    sdist.write('one')
+
+    local = 'file://' + sdist.strpath
+    key = venv_update.build_failure_key(local, pipdir)
+    assert key is not None
+    assert venv_update.build_failure_key(local, pipdir) == key
+    # a download, from the download cache
+    tmpdir.join('cache', 'https%3A%2F%2Fexample.com%2Fbroken-1.0.tar.gz').write('one', ensure=True)
+    assert venv_update.build_failure_key('https://example.com/broken-1.0.tar.gz#md5=abc', pipdir) == key
+    # not an sdist we can hash
+    assert venv_update.build_failure_key('https://example.com/missing-1.0.tar.gz', pipdir) is None
+    assert venv_update.build_failure_key(None, pipdir) is None
+
+    # each input changes it
+    monkeypatch.setenv('CFLAGS', '-O1')
+    assert venv_update.build_failure_key(local, pipdir) not in (None, key)
+    monkeypatch.delenv('CFLAGS')
+    sdist.write('two')
+    assert venv_update.build_failure_key(local, pipdir) not in (None, key)
+
+
+def test_build_forkserver(tmpdir):
+    from subprocess import PIPE, Popen
+    from sys import executable
+    from time import sleep
+    tmpdir.join('project').ensure_dir()
+    path = tmpdir.join('socket').strpath
+    script = venv_update.dotpy(venv_update.__file__)
+
+    def client():
+        client = Popen(
+            (executable, script, '--forkserver-client', path, '-c', '''\
+from __future__ import print_function
+import os, sys
+import setuptools
+print(os.getcwd(), sys.argv, os.environ.get('FORKSERVER_TEST'), __name__)
+sys.stdout.flush()
+sys.stderr.write('to stderr\\n')
+sys.exit(3)
+''', 'egg_info', '--egg-base=x'),
+            cwd=tmpdir.join('project').strpath,
+            env={'FORKSERVER_TEST': 'yes', 'PATH': '/bin:/usr/bin'},
+            stdout=PIPE, stderr=PIPE,
+        )
+        out, err = client.communicate()
+        return client.returncode, out.decode('UTF-8'), err.decode('UTF-8')
+
+    out = "%s ['-c', 'egg_info', '--egg-base=x'] yes __main__\n" % tmpdir.join('project')
+    # without a forkserver, the client runs it itself
+    assert client() == (3, out, 'to stderr\n')
+
+    server = Popen((executable, script, '--forkserver', path))
+    try:
+        for _ in range(200):
+            if tmpdir.join('socket').check():
+                break
+            sleep(.05)
+        # the forkserver relays both outputs on the one stream, as pip would have had them
+        assert client() == (3, out + 'to stderr\n', '')
+        assert client() == (3, out + 'to stderr\n', '')
+        assert server.poll() is None
+    finally:
+        server.terminate()
+        server.wait()
+
+
 def test_wait_for_all_subprocesses(monkeypatch):
     class _nonlocal(object):
         wait = 10
@@ -1,7 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 '''\
-usage: venv-update [-h] [virtualenv_dir] [requirements [requirements ...]]
+usage: venv-update [-h] [--offline] [--check] [--dry-run] [--jobs=N] [--snapshots=DIR] [--pool[=N]]
+                   [--cache-dir=DIR] [--shared-wheelhouse=DIR] [--remote-wheelhouse=URL] [--build-forkserver]
+                   [virtualenv_dir] [requirements [requirements ...]]
+       venv-update [-h] [--offline] [--check] [--dry-run] [--jobs=N] [--snapshots=DIR]
+                   [--cache-dir=DIR] [--shared-wheelhouse=DIR] [--remote-wheelhouse=URL] [--build-forkserver]
+                   virtualenv_dir:requirements[,requirements ...] ...
+       venv-update --prefetch[=PYTHON[,PYTHON ...]] [--offline] [--cache-dir=DIR]
+                   [--export-bundle=FILE] [--import-bundle=FILE] [requirements ...]
+       venv-update --gc [--cache-dir=DIR]
 
 Update a (possibly non-existant) virtualenv directory using a requirements.txt listing
 When this script completes, the virtualenv should have the same packages as if it were
@@ -14,8 +22,49 @@ positional arguments:
   virtualenv_dir  Destination virtualenv directory (default: virtualenv_run)
   requirements    Requirements files. (default: requirements.txt)
 
+  Several virtualenvs can be updated at once, each given as virtualenv_dir:requirements.
+  Their requirements are resolved and built into wheels together, once per interpreter,
+  then installed into each virtualenv concurrently.
+
 optional arguments:
   -h, --help      show this help message and exit
+  --offline       Never touch the network. Fail up-front, listing every requirement
+                  that can't be satisfied from the wheelhouse or the installed set.
+  --check         Change nothing: only check whether the virtualenv is exactly in sync
+                  with its requirements. Exits with status 5 if it isn't.
+  --dry-run       Change nothing: only show what the update would install, upgrade, downgrade and
+                  remove, whether each wheel is already in the wheelhouse or must be downloaded and
+                  built, and how long it should take, given each package's recorded timings.
+  --jobs=N        Update at most N virtualenvs concurrently. (default: the number of CPUs)
+  --snapshots=DIR Keep snapshots of updated virtualenvs in DIR, by requirements and validation.
+                  A virtualenv that must be built is restored from a matching snapshot instead.
+  --pool[=N]      Keep up to N virtualenvs for virtualenv_dir, one per set of requirements, and make
+                  virtualenv_dir a symlink to the matching one. Switching between (e.g.) branches'
+                  requirements is then nearly instant. (default: 4)
+  --cache-dir=DIR Keep the download cache and wheelhouse in DIR: ideally, on fast local disk.
+                  (default: ~/.pip)
+  --shared-wheelhouse=DIR
+                  A wheelhouse shared with others (e.g. a team's, on NFS). Wheels missing locally
+                  are copied from here, and wheels we build are published here.
+  --remote-wheelhouse=URL
+                  As --shared-wheelhouse, over HTTP: wheels are fetched with GET, and published with
+                  PUT, to URL/<tag>/<wheel>. Tried after --shared-wheelhouse.
+  --prefetch[=PYTHON[,PYTHON ...]]
+                  Touch no virtualenv: only download and build wheels for the requirements files, for
+                  each of these interpreters, in parallel. (default: this python) This is for baking
+                  images: venv-update from there on has nothing to download or build.
+  --export-bundle=FILE
+                  Also write exactly the wheels the requirements need into FILE: one archive, with
+                  an index of its contents, to ship to a fresh machine.
+  --import-bundle=FILE
+                  Add the wheels of an --export-bundle FILE to the wheelhouse, before anything else.
+  --build-forkserver
+                  Import setuptools once, in a server, and run each sdist build and setup.py (egg_info,
+                  bdist_wheel, develop, install) in a fork of it, rather than in a fresh python.
+  --gc            Touch no virtualenv: only remove whatever in the caches no project needs any more.
+                  (This is also done after each update, when no other venv-update is using the caches.)
+
+Any other --options are passed along to virtualenv.
 
 Version control at: https://github.com/yelp/venv-update
 '''
@@ -65,6 +114,85 @@ def parseargs(args):
     return stage, virtualenv_dir, tuple(requirements), tuple(remaining)
 
 
+# these --options belong to venv-update; any others are passed through to virtualenv
+OPTIONS = (
+    '--offline',
+    '--jobs',
+    '--snapshots',
+    '--pool',
+    '--check',
+    '--dry-run',
+    '--cache-dir',
+    '--shared-wheelhouse',
+    '--remote-wheelhouse',
+    '--prefetch',
+    '--gc',
+    '--export-bundle',
+    '--import-bundle',
+    '--build-forkserver',
+    '--wheels-only',  # internal: stage2 should only fill the wheelhouse
+    '--preflight',  # internal: stage2 should only check that --offline can rebuild the virtualenv
+)
+
+
+# the options which can change what an update installs (the rest only change how it goes about it): see venv_inputs
+INSTALL_OPTIONS = ('shared_wheelhouse', 'remote_wheelhouse')
+
+# the default number of virtualenvs kept by --pool, per virtualenv_dir
+POOL_SIZE = 4
+
+# the exit code of --check, for a virtualenv which isn't in sync
+OUT_OF_SYNC = 5
+
+
+def parseopts(args):
+    """Separate venv-update's own --options from the rest of the arguments.
+
+    Returns a dict of our options (without the leading dashes) and the remaining arguments.
+    """
+    options = {}
+    remaining = []
+    for arg in args:
+        name, _, value = arg.partition('=')
+        if name in OPTIONS:
+            options[name[2:].replace('-', '_')] = value or True
+        else:
+            remaining.append(arg)
+    return options, tuple(remaining)
+
+
+def arg_is_url(arg):
+    """Is this argument a url (e.g. a requirements file at http://host/reqs.txt, or file:reqs.txt)?"""
+    from re import match
+    return bool(match(r'[A-Za-z][A-Za-z0-9+.-]*://', arg)) or arg.startswith('file:')
+
+
+def parse_targets(args):
+    """Parse virtualenv_dir:requirements[,requirements ...] arguments, for updating several virtualenvs at once.
+    Returns an empty tuple unless at least one such argument is given. A url (see arg_is_url) isn't one.
+    """
+    positional = [arg for arg in args if not arg.startswith('-')]
+    if not any(':' in arg and not arg_is_url(arg) for arg in positional):
+        return ()
+
+    targets = []
+    for arg in positional:
+        virtualenv_dir, _, requirements = arg.partition(':')
+        targets.append((virtualenv_dir, tuple(requirements.split(',')) if requirements else ('requirements.txt',)))
+    return tuple(targets)
+
+
+def unparseopts(options):
+    """The inverse of parseopts: turn our options back into command-line arguments."""
+    result = []
+    for name, value in sorted(options.items()):
+        arg = '--' + name.replace('_', '-')
+        if value is not True:
+            arg += '=' + value
+        result.append(arg)
+    return tuple(result)
+
+
 def timid_relpath(arg):
     from os.path import isabs, relpath
     if isabs(arg):
@@ -91,10 +219,52 @@ def colorize(cmd):
     return template.format(shellescape(cmd))
 
 
-def run(cmd):
+def run(cmd, cwd=None):
     from subprocess import check_call
     check_call(('echo', colorize(cmd)))
-    check_call(cmd)
+    check_call(cmd, cwd=cwd)
+
+
+def mkdirp(pth):
+    """like `mkdir -p`: create a directory, and its parents, unless it already exists"""
+    from os import makedirs
+    from os.path import isdir
+    if not isdir(pth):
+        makedirs(pth)
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True, waiting=None, inheritable=False):
+    """Hold an flock(2) on path (created if need be) for the duration of the block.
+
+    The block is given whether the lock was acquired: without blocking, it may not be.
+    If we have to wait for the lock, the `waiting` message is shown first.
+    An inheritable lock is kept across exec_ (and by any subprocess that doesn't close_fds).
+    """
+    from fcntl import fcntl, flock, FD_CLOEXEC, F_GETFD, F_SETFD, LOCK_EX, LOCK_NB, LOCK_SH
+    from os.path import dirname
+
+    mkdirp(dirname(path))
+    mode = LOCK_SH if shared else LOCK_EX
+    with open(path, 'a') as lockfile:
+        if inheritable:
+            fcntl(lockfile.fileno(), F_SETFD, fcntl(lockfile.fileno(), F_GETFD) & ~FD_CLOEXEC)
+        else:
+            fcntl(lockfile.fileno(), F_SETFD, fcntl(lockfile.fileno(), F_GETFD) | FD_CLOEXEC)
+        try:
+            flock(lockfile.fileno(), mode | LOCK_NB)
+            acquired = True
+        except IOError:
+            acquired = False
+
+        if not acquired and blocking:
+            if waiting:
+                info(waiting)
+            flock(lockfile.fileno(), mode)
+            acquired = True
+
+        # closing the file releases the lock
+        yield acquired
 
 
 def info(msg):
@@ -142,16 +312,22 @@ def faster_find_requirement(self, req, upgrade):
             for link in glob(join(findlink, reqname + '-*.whl')):
                 link = Link('file://' + link)
                 wheel = Wheel(link.filename)
-                if wheel.version in req.req and wheel.supported():
+                if wheel.version in req.req and tag_supported(wheel_tag(link.filename)):
                     return link
 
     # otherwise, do the full network search
     return self.unpatched['find_requirement'](self, req, upgrade)
 
 
+def partitioned_packagefinder_init(self, find_links, *args, **kwargs):
+    """see faster_pip_packagefinder"""
+    self.unpatched['__init__'](self, wheelhouse_find_links(find_links), *args, **kwargs)
+
+
 @contextmanager
 def faster_pip_packagefinder():
     """Provide a short-circuited search when the requirement is pinned and appears on disk.
+    Also, pip is shown only the partitions of the wheelhouse that this interpreter can use (see wheelhouse_partitions).
 
     Suggested upstream at: https://github.com/pypa/pip/pull/2114
     """
@@ -161,15 +337,286 @@ def faster_pip_packagefinder():
 
     PackageFinder.unpatched = vars(PackageFinder).copy()
     PackageFinder.find_requirement = faster_find_requirement
+    PackageFinder.__init__ = partitioned_packagefinder_init
     try:
         yield
     finally:
         PackageFinder.find_requirement = PackageFinder.unpatched['find_requirement']
+        PackageFinder.__init__ = PackageFinder.unpatched['__init__']
         del PackageFinder.unpatched
 
 
-def pip(args):
-    """Run pip, in-process."""
+def atomic_cache_download(pipdir, target_file, temp_location, content_type):
+    """see atomic_pip_download_cache"""
+    from shutil import copyfileobj
+    from pip.log import logger
+    logger.notify('Storing download in cache at %s' % timid_relpath(target_file))
+    with open(temp_location, 'rb') as download:
+        with atomic_file(target_file, 'wb') as cached:
+            copyfileobj(download, cached)
+    # pip only trusts a cached download once its content-type file exists, so that goes last
+    with atomic_file(target_file + '.content-type') as content_type_file:
+        content_type_file.write(content_type)
+    verified_hashes([target_file], pipdir)
+
+
+@contextmanager
+def atomic_pip_download_cache(pipdir):
+    """Make pip's writes to its download cache atomic, so that a concurrent venv-update never reads a partial file."""
+    from functools import partial
+    import pip.download
+
+    unpatched = pip.download.cache_download
+    pip.download.cache_download = partial(atomic_cache_download, pipdir)
+    try:
+        yield
+    finally:
+        pip.download.cache_download = unpatched
+
+
+def hashes_path(pipdir):
+    """The verified-hash cache: the sha256 of each file in the download cache and wheelhouse, as last seen."""
+    return pipdir + '/hashes.json'
+
+
+def hashes_load(pipdir):
+    import json
+    try:
+        with open(hashes_path(pipdir)) as hashes:
+            return json.load(hashes)
+    except (IOError, ValueError):
+        return {}
+
+
+def file_identity(path):
+    """What we take to identify a file's content: its size, mtime and inode. Any rewrite or replacement changes these.
+    The mtime is in integer nanoseconds, which (unlike a float) survive hashes.json exactly, on any python.
+    """
+    from os import stat
+    stats = stat(path)
+    mtime_ns = getattr(stats, 'st_mtime_ns', None)  # python3.3+
+    if mtime_ns is None:
+        mtime_ns = int(stats.st_mtime * 10 ** 9)
+    return [stats.st_size, mtime_ns, stats.st_ino]
+
+
+def file_sha256(path):
+    """Hash a file, in chunks. Returns the hex sha256, and the file_identity of what was hashed (None if it changed)."""
+    from hashlib import sha256
+    identity = file_identity(path)
+    digest = sha256()
+    with open(path, 'rb') as hashed:
+        for chunk in iter(lambda: hashed.read(UNZIP_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest(), identity if file_identity(path) == identity else None
+
+
+def verified_hashes(paths, pipdir):
+    """The sha256 of each of these files, by path.
+
+    Hashes are remembered by path, size, mtime and inode: while those are unchanged, so is the hash, and looking it up
+    costs a stat. Anything not seen before is hashed in parallel (hashlib lets go of the GIL), then remembered.
+    """
+    from multiprocessing import cpu_count
+    from multiprocessing.dummy import Pool
+    from os.path import abspath, exists
+
+    paths = [abspath(path) for path in paths]
+    hashes = hashes_load(pipdir)
+    result = {}
+    unseen = []
+    for path in paths:
+        known = hashes.get(path)
+        if known and known[:3] == file_identity(path):
+            result[path] = known[3]
+        else:
+            unseen.append(path)
+    if not unseen:
+        return result
+
+    pool = Pool(cpu_count())
+    try:
+        digests = pool.map(file_sha256, unseen)
+    finally:
+        pool.close()
+        pool.join()
+    with file_lock(hashes_path(pipdir) + '.lock'):
+        hashes = hashes_load(pipdir)
+        for path, (digest, identity) in zip(unseen, digests):
+            result[path] = digest
+            if identity is not None:  # else, it changed while we read it: don't trust this hash for next time
+                hashes[path] = identity + [digest]
+        # forget whatever has been removed from the caches
+        write_json_atomic(hashes_path(pipdir), dict((path, known) for path, known in hashes.items() if exists(path)))
+    return result
+
+
+class VerifiedHash(object):
+    """Quacks enough like a hashlib object for pip to check it against a link's hash: see verified_pip_hashes"""
+    digest_size = 32
+
+    def __init__(self, digest):
+        self.digest = digest
+
+    def hexdigest(self):
+        return self.digest
+
+
+def verified_hash_from_file(pipdir, target_file, link):
+    """see verified_pip_hashes"""
+    from os.path import abspath
+    if link.hash_name == 'sha256':
+        return VerifiedHash(verified_hashes([target_file], pipdir)[abspath(target_file)])
+    return verified_hash_from_file.unpatched(target_file, link)
+
+
+@contextmanager
+def verified_pip_hashes(pipdir):
+    """When pip checks a cached file against a link's #sha256=, look the hash up in our verified_hashes.
+    pip would otherwise rehash the whole file, on every install.
+    """
+    from functools import partial
+    import pip.download
+
+    verified_hash_from_file.unpatched = pip.download._get_hash_from_file
+    pip.download._get_hash_from_file = partial(verified_hash_from_file, pipdir)
+    try:
+        yield
+    finally:
+        pip.download._get_hash_from_file = verified_hash_from_file.unpatched
+        del verified_hash_from_file.unpatched
+
+
+def costs_path(pipdir):
+    """The cost database: how long each package has taken to download, build and install, in seconds."""
+    return pipdir + '/costs.json'
+
+
+def costs_load(pipdir):
+    import json
+    try:
+        with open(costs_path(pipdir)) as costs:
+            return json.load(costs)
+    except (IOError, ValueError):
+        return {}
+
+
+def costs_record(measurements, pipdir):
+    """Merge (name, kind, seconds) measurements into the cost database.
+    Each cost is an exponential moving average: every new measurement counts for half, so a package's costs follow its
+    recent releases, rather than its whole history.
+    """
+    if not measurements:
+        return
+    with file_lock(costs_path(pipdir) + '.lock'):
+        costs = costs_load(pipdir)
+        for name, kind, seconds in measurements:
+            package = costs.setdefault(name, {})
+            previous = package.get(kind)
+            package[kind] = seconds if previous is None else (previous + seconds) / 2
+        write_json_atomic(costs_path(pipdir), costs)
+
+
+def costs_predict(costs, name, kinds):
+    """The predicted seconds for these kinds of work on a package, or None if we've no history for it."""
+    package = costs.get(name)
+    if package is None:
+        return None
+    return sum(package.get(kind, 0) for kind in kinds)
+
+
+def requirement_line_name(line):
+    """The (normalized) project name of a requirement line, or None for e.g. a url."""
+    from re import match
+    name = match(r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*($|[[<>=!~;])', line)
+    return name and name.group(1).replace('_', '-').lower()
+
+
+def requirements_cost(costs, reqs, wheelhouse=None):
+    """The predicted cost of installing everything in these requirements files, from scratch, in seconds.
+    Given the wheelhouse, anything which seems to have a wheel there is predicted to need no download or build.
+    This only needs our own requirements parser, so we can ask before any virtualenv is ready.
+    """
+    from glob import glob
+    total = 0
+    for _, line, _ in parse_requirements_tree(reqs)['requirements']:
+        name = requirement_line_name(line)
+        cached = wheelhouse and name and glob(wheelhouse + '/*/' + name.replace('-', '_') + '-*.whl')
+        total += costs_predict(costs, name, ('install',) if cached else ('download', 'build', 'install')) or 0
+    return total
+
+
+def format_seconds(seconds):
+    if seconds < 60:
+        return '%.1fs' % seconds
+    return '%im%02is' % divmod(seconds, 60)
+
+
+def link_name_version(link):
+    """The (normalized) project name, and the version (or None), of a pip Link to a wheel or an sdist."""
+    from re import match
+    from pip.wheel import Wheel
+    from pip._vendor.pkg_resources import safe_name
+    if link.filename.endswith('.whl'):
+        wheel = Wheel(link.filename)
+        name, version = wheel.name, wheel.version
+    else:
+        name, version = match(r'^(.+?)(?:-(\d.*))?$', link.splitext()[0]).groups()
+    return safe_name(name).lower(), version
+
+
+def link_name(link):
+    """The (normalized) project name of a pip Link to a wheel or an sdist."""
+    return link_name_version(link)[0]
+
+
+def timed(function, kind, name_of, measurements):
+    """Wrap a pip method so that its every call is measured (see recorded_costs)."""
+    from time import time
+
+    def timed_method(self, *args, **kwargs):
+        start = time()
+        result = function(self, *args, **kwargs)
+        name = name_of(self, *args)
+        if name is not None:
+            measurements.append((name, kind, time() - start))
+        return result
+    return timed_method
+
+
+@contextmanager
+def recorded_costs(pipdir):
+    """Time pip's downloads, builds and installs, per package, and record them in the cost database."""
+    from pip.req import InstallRequirement, RequirementSet
+    from pip.wheel import WheelBuilder
+    from pip._vendor.pkg_resources import safe_name
+
+    def downloaded(_, link, *args):
+        return None if url_is_local(link.url) else link_name(link)
+
+    def req_name(req, *args):
+        return safe_name(req.name).lower() if req.name else None
+
+    measurements = []
+    patches = (
+        (RequirementSet, 'unpack_url', 'download', downloaded),
+        (WheelBuilder, '_build_one', 'build', lambda _, req: req_name(req)),
+        (InstallRequirement, 'install', 'install', req_name),
+    )
+    unpatched = [(cls, attr, vars(cls)[attr]) for cls, attr, _, _ in patches if attr in vars(cls)]
+    for cls, attr, kind, name_of in patches:
+        if attr in vars(cls):
+            setattr(cls, attr, timed(vars(cls)[attr], kind, name_of, measurements))
+    try:
+        yield
+    finally:
+        for cls, attr, function in unpatched:
+            setattr(cls, attr, function)
+        costs_record(measurements, pipdir)
+
+
+def pip(args, pipdir):
+    """Run pip, in-process, with our caches in pipdir."""
     import pip as pipmodule
 
     # pip<1.6 needs its logging config reset on each invocation, or else we get duplicate outputs -.-
@@ -181,7 +628,11 @@ def pip(args):
     stdout.flush()
 
     with faster_pip_packagefinder():
-        result = pipmodule.main(list(args))
+        with atomic_pip_download_cache(pipdir):
+            with recorded_costs(pipdir):
+                with streaming_pip_unzip():
+                    with verified_pip_hashes(pipdir):
+                        result = pipmodule.main(list(args))
 
     if result != 0:
         # pip exited with failure, then we should too
@@ -201,9 +652,9 @@ def dist_to_req(dist):
     return result
 
 
-def pip_get_installed():
-    """Code extracted from the middle of the pip freeze command.
-    FIXME: does not list anything installed via -e
+def local_dists():
+    """The distributions installed in this virtualenv (as opposed to globally).
+    Anything installed via -e is listed too, since fresh_working_set honors egg-links.
     """
     if True:
         # pragma:no cover:pylint:disable=no-name-in-module,import-error
@@ -213,22 +664,218 @@ def pip_get_installed():
             # pip < 6.0
             from pip.util import dist_is_local
 
-    return tuple(
-        dist_to_req(dist)
-        for dist in fresh_working_set()
-        if dist_is_local(dist)
-    )
+    return [dist for dist in fresh_working_set() if dist_is_local(dist)]
 
 
-def pip_parse_requirements(requirement_files):
-    from pip.req import parse_requirements
+def pip_get_installed():
+    """Code extracted from the middle of the pip freeze command."""
+    return tuple(dist_to_req(dist) for dist in local_dists())
+
+
+# requirement-file options, by their prefixes, and the option we pass along to pip (None: ignored, as pip does)
+REQUIREMENT_FILE_OPTIONS = (
+    (('-Z', '--always-unzip'), None),
+    (('-f', '--find-links'), '--find-links'),
+    (('-i', '--index-url'), '--index-url'),
+    (('--extra-index-url',), '--extra-index-url'),
+    (('--use-wheel',), '--use-wheel'),
+    (('--no-index',), '--no-index'),
+    (('--allow-external',), '--allow-external'),
+    (('--allow-all-external',), '--allow-all-external'),
+    (('--no-allow-external', '--no-allow-insecure'), None),
+    (('--allow-insecure',), '--allow-insecure'),
+    (('--allow-unverified',), '--allow-unverified'),
+)
+REQUIREMENT_FILE_FLAGS = ('--use-wheel', '--no-index', '--allow-all-external')
 
-    # ordering matters =/
-    required = []
+
+def option_value(line, prefixes):
+    """If the line starts with one of these option prefixes, return the option's value ('' for none), else None."""
+    for prefix in prefixes:
+        if line.startswith(prefix):
+            return line[len(prefix):].strip().lstrip('=').strip()
+
+
+def read_requirement_file(filename):
+    """Get the contents of a requirements file, which (as in pip) may also be a url."""
+    from re import match
+    if match('^(https?|ftp)://', filename):
+        try:
+            from urllib2 import urlopen
+        except ImportError:  # python3
+            from urllib.request import urlopen  # pylint:disable=no-name-in-module,import-error
+        return urlopen(filename).read()
+    elif filename.startswith('file:'):
+        from pip.download import url_to_path
+        filename = url_to_path(filename)
+
+    with open(filename, 'rb') as reqfile:
+        return reqfile.read()
+
+
+def parse_requirement_line(line, reqfile, tree):
+    """Parse one (non-blank) line of a requirements file into the tree. See parse_requirements_tree."""
+    from os.path import dirname, exists, join
+
+    included = option_value(line, ('-r', '--requirement'))
+    if included is not None:
+        if '://' not in included and '://' not in reqfile:
+            included = join(dirname(reqfile), included)
+        parse_requirement_file(included, tree)
+        return
+
+    for prefixes, pip_option in REQUIREMENT_FILE_OPTIONS:
+        value = option_value(line, prefixes)
+        if value is None:
+            continue
+        elif pip_option == '--find-links':
+            # as in pip, a local find-links path may be relative to its requirements file
+            relative = join(dirname(reqfile), value)
+            if exists(relative):
+                value = relative
+        if pip_option in REQUIREMENT_FILE_FLAGS:
+            tree['options'].append(pip_option)
+        elif pip_option is not None:
+            tree['options'].append(pip_option + '=' + value)
+        return
+
+    editable = option_value(line, ('-e', '--editable'))
+    if editable is not None:
+        tree['requirements'].append((True, editable, tree['comes_from']))
+    else:
+        tree['requirements'].append((False, line, tree['comes_from']))
+
+
+def parse_requirement_file(reqfile, tree):
+    from hashlib import sha1
+    from re import sub
+
+    contents = read_requirement_file(reqfile)
+    tree['files'].append((reqfile, sha1(contents).hexdigest()))
+    for line_number, line in enumerate(contents.decode('UTF-8').splitlines(), 1):
+        # as in pip: strip comments and blank lines
+        line = sub(r'(^|\s)#.*$', '', line.strip()).strip()
+        if line:
+            tree['comes_from'] = '-r %s (line %s)' % (reqfile, line_number)
+            parse_requirement_line(line, reqfile, tree)
+
+
+def parse_requirements_tree(requirement_files):
+    """Parse requirements files, including any nested via -r, just as pip would.
+
+    The result is a plain (json-able) structure:
+        files: every requirements file that was read, with a hash of its contents
+        options: the pip options given in the requirements files, as command-line arguments
+        requirements: (editable, line, comes_from) for each requirement, in order
+    """
+    tree = dict(files=[], options=[], requirements=[])
     for reqfile in requirement_files:
-        for req in parse_requirements(reqfile):
-            required.append(req)
-    return required
+        parse_requirement_file(reqfile, tree)
+    tree.pop('comes_from', None)
+    return tree
+
+
+def requirements_tree_is_current(tree):
+    """Are all the files of this requirements tree unchanged?"""
+    from hashlib import sha1
+    for reqfile, digest in tree['files']:
+        try:
+            contents = read_requirement_file(reqfile)
+        except (IOError, OSError):
+            return False
+        if sha1(contents).hexdigest() != digest:
+            return False
+    return True
+
+
+@contextmanager
+def atomic_file(path, mode='w'):
+    """Write a file such that readers see either the old contents or the new, never a partial write.
+    The new file is renamed into place only once the block completes successfully.
+    """
+    from os import fdopen, rename, unlink
+    from os.path import dirname
+    from tempfile import mkstemp
+
+    directory = dirname(path) or '.'
+    mkdirp(directory)
+    fd, tmp = mkstemp(prefix='.tmp-', dir=directory)
+    try:
+        with fdopen(fd, mode) as tmpfile:
+            yield tmpfile
+        rename(tmp, path)
+    except BaseException:
+        unlink(tmp)
+        raise
+
+
+def write_json_atomic(path, value):
+    """Write a json file atomically: see atomic_file."""
+    import json
+    with atomic_file(path) as jsonfile:
+        json.dump(value, jsonfile)
+
+
+def cached_requirements_tree(requirement_files, cache_dir):
+    """parse_requirements_tree, cached by the contents of every requirements file involved.
+    The tree of -r includes is only re-parsed if one of its files has changed.
+    """
+    import json
+    from hashlib import sha1
+    from os import getcwd
+    from os.path import join
+
+    # relative paths in requirements are relative to the working directory
+    key = json.dumps([getcwd(), list(requirement_files)])
+    cache = join(cache_dir, sha1(key.encode('UTF-8')).hexdigest() + '.json')
+    try:
+        with open(cache) as cached:
+            tree = json.load(cached)
+    except (IOError, ValueError):
+        tree = None
+
+    if tree is None or not requirements_tree_is_current(tree):
+        tree = parse_requirements_tree(requirement_files)
+        write_json_atomic(cache, tree)
+    return tree
+
+
+def install_requirement(editable, line, comes_from):
+    """Make a pip InstallRequirement from one of the requirements of a parse_requirements_tree."""
+    from pip.req import InstallRequirement
+    if editable:
+        return InstallRequirement.from_editable(line, comes_from=comes_from)
+    else:
+        return InstallRequirement.from_line(line, comes_from)
+
+
+def pip_parse_requirements(requirement_files):
+    # ordering matters =/
+    return [
+        install_requirement(*requirement)
+        for requirement in parse_requirements_tree(requirement_files)['requirements']
+    ]
+
+
+def requirements_plan(tree, required, substitutions):
+    """For each requirement parsed from a requirements tree, give the command-line argument which gives it to pip,
+    the pip InstallRequirement, and whether it was given explicitly.
+
+    Any requirement whose url is in substitutions is replaced by the substituted requirement lines, which aren't
+    considered explicit. An empty substitution drops that requirement altogether.
+    """
+    from pip.req import InstallRequirement
+
+    plan = []
+    for (editable, line, comes_from), req in zip(tree['requirements'], required):
+        if req.url in substitutions:
+            for substitute in substitutions[req.url]:
+                plan.append((substitute, InstallRequirement.from_line(substitute, comes_from), False))
+        elif editable:
+            plan.append(('--editable=' + line, req, True))
+        else:
+            plan.append((line, req, True))
+    return plan
 
 
 def importlib_invalidate_caches():
@@ -243,7 +890,7 @@ def importlib_invalidate_caches():
     invalidate_caches()
 
 
-def pip_install(args):
+def pip_install(args, pipdir):
     """Run pip install, and return the set of packages installed.
     """
     from pip.commands.install import InstallCommand
@@ -262,7 +909,7 @@ def pip_install(args):
     # A poor man's dependency injection: monkeypatch :(
     InstallCommand.run = install
     try:
-        pip(('install',) + args)
+        pip(('install',) + args, pipdir)
     finally:
         InstallCommand.run = orig_installcommand['run']
 
@@ -344,141 +991,2333 @@ def trace_requirements(requirements):
     return result
 
 
-def reqnames(reqs):
-    return set(req.name for req in reqs)
+class WheelMetadata(object):
+    """A minimal pkg_resources metadata provider, serving a wheel's METADATA file from memory."""
 
+    def __init__(self, metadata):
+        self.metadata = metadata
 
-def path_is_within(path, within):
-    from os.path import relpath, join
-    path = join('.', path)  # eliminate empty-string edge case
-    return not relpath(path, within).startswith('..')
+    def has_metadata(self, name):
+        return name == 'METADATA'
 
+    def get_metadata(self, name):
+        if not self.has_metadata(name):
+            raise KeyError(name)
+        return self.metadata
 
-def validate_venv(venv_path, venv_args):
-    """Ensure we have a valid virtualenv."""
-    import json
-    from sys import executable, version
-    from virtualenv import __version__ as virtualenv_version
-    # we count any existing virtualenv invalidated if any of these relevant values changes
-    validation = (
-        version,  # includes e.g. pypy version
-        virtualenv_version,
-        venv_args,
-        venv_path,
-    )
-    # normalize types, via json round-trip
-    validation = json.loads(json.dumps(validation))
+    def get_metadata_lines(self, name):
+        from pip._vendor.pkg_resources import yield_lines
+        return yield_lines(self.get_metadata(name))
 
-    from os.path import join, abspath
-    venv_path = abspath(venv_path)  # this removes trailing slashes as well
-    state_path = join(venv_path, '.venv-update.state')
 
-    from os.path import isdir
-    if isdir(venv_path):
-        try:
-            with open(state_path) as state:
-                previous_state = json.load(state)
-        except IOError:
-            previous_state = {}
+def wheel_dist(path):
+    """Make a pkg_resources distribution object from a .whl file, without installing it.
+    This lets us ask a wheel for its requirements, just as we do for installed packages.
+    """
+    from contextlib import closing
+    from zipfile import ZipFile
+    from os.path import basename
+    from pip.wheel import Wheel
+    from pip._vendor import pkg_resources
 
-        if previous_state.get('validation') == validation:
-            info('Keeping virtualenv from previous run.')
-            return
+    wheel = Wheel(basename(path))
+    with closing(ZipFile(path)) as archive:
+        for name in archive.namelist():
+            dirname, _, filename = name.partition('/')
+            if dirname.endswith('.dist-info') and filename == 'METADATA':
+                metadata = archive.read(name)
+                if bytes is not str:  # python3; python2's email parser wants bytes
+                    metadata = metadata.decode('UTF-8')
+                break
         else:
-            info('Removing invalidated virtualenv.')
-            run(('rm', '-rf', venv_path))
+            metadata = ''
 
-            # run virtualenv using the same executable as last time
-            # this avoids running virtualenv against its own container
-            executable = previous_state.get('executable', executable)
+    return pkg_resources.DistInfoDistribution(
+        location=path,
+        metadata=WheelMetadata(metadata),
+        project_name=wheel.name,
+        version=wheel.version,
+    )
 
-    run((executable, '-m', 'virtualenv', venv_path) + venv_args)
 
-    if isdir(venv_path):
-        with open(state_path, 'w') as state:
-            json.dump(
-                dict(executable=executable, validation=validation),
-                state,
-            )
+def supported_tags():
+    """This interpreter's wheel tags, as a set of (python, abi, platform).
+    pip 1.5 makes a set of its list of these for every wheel it checks; we make one, once.
+    """
+    try:
+        return supported_tags.tags
+    except AttributeError:
+        from pip.pep425tags import supported_tags as tags
+        supported_tags.tags = frozenset(tags)
+        return supported_tags.tags
+
+
+def wheel_tag(filename):
+    """A wheel's tag, from its filename: python-abi-platform, where each part may be compressed (e.g. py2.py3)."""
+    return '-'.join(filename[:-len('.whl')].split('-')[-3:])
+
+
+def tag_supported(tag):
+    """Can this interpreter use wheels with this (possibly compressed) tag?"""
+    pythons, abis, platforms = tag.split('-')
+    tags = supported_tags()
+    return any(
+        (python, abi, platform) in tags
+        for python in pythons.split('.')
+        for abi in abis.split('.')
+        for platform in platforms.split('.')
+    )
 
 
-def do_install(reqs):
-    from os import environ
+def wheelhouse_partitions(wheelhouse):
+    """The wheelhouse keeps its wheels in a subdirectory per wheel_tag. Return those this interpreter can use.
 
-    previously_installed = pip_get_installed()
-    required = pip_parse_requirements(reqs)
+    Wheels for other interpreters, sharing the wheelhouse, then cost nothing to ignore: we needn't look at them.
+    Pure-python wheels (e.g. py2.py3-none-any) have a partition of their own, which every interpreter shares.
+    """
+    from os import listdir
+    from os.path import join
+    try:
+        names = listdir(wheelhouse)
+    except OSError:  # no wheelhouse yet
+        return []
+    # (a wheel's filename has more dashes than a tag does)
+    return [
+        join(wheelhouse, name) for name in sorted(names)
+        if not name.startswith('.') and name.count('-') == 2 and tag_supported(name)
+    ]
 
-    requirements_as_options = tuple(
-        '--requirement={0}'.format(requirement) for requirement in reqs
-    )
 
-    # We put the cache in the directory that pip already uses.
-    # This has better security characteristics than a machine-wide cache, and is a
-    #   pattern people can use for open-source projects
-    pipdir = environ['HOME'] + '/.pip'
-    # We could combine these caches to one directory, but pip would search everything twice, going slower.
-    pip_download_cache = pipdir + '/cache'
-    pip_wheels = pipdir + '/wheelhouse'
+def wheelhouse_find_links(find_links):
+    """Add the usable wheelhouse_partitions of any local find-links, for pip: it doesn't look in subdirectories."""
+    result = []
+    for find_link in find_links:
+        result.append(find_link)
+        if find_link.startswith('file://'):
+            result.extend('file://' + partition for partition in wheelhouse_partitions(find_link[len('file://'):]))
+    return result
 
-    environ.update(
-        PIP_DOWNLOAD_CACHE=pip_download_cache,
-    )
 
-    cache_opts = (
-        '--download-cache=' + pip_download_cache,
-        '--find-links=file://' + pip_wheels,
-    )
+def wheelhouse_add(wheel, wheelhouse):
+    """Move a wheel (atomically) into its partition of the wheelhouse. Returns its new path."""
+    from os import rename
+    from os.path import basename, join
+    partition = join(wheelhouse, wheel_tag(basename(wheel)))
+    mkdirp(partition)
+    added = join(partition, basename(wheel))
+    rename(wheel, added)
+    return added
 
-    # --use-wheel is somewhat redundant here, but it means we get an error if we have a bad version of pip/setuptools.
-    install_opts = ('--upgrade', '--use-wheel',) + cache_opts
-    recently_installed = []
 
-    # 1) Bootstrap the install system; setuptools and pip are already installed, just need wheel
-    recently_installed += pip_install(install_opts + BOOTSTRAP_VERSIONS)
+def wheelhouse_migrate(wheelhouse):
+    """Move the wheels of an unpartitioned wheelhouse, as earlier versions kept it, into their partitions."""
+    from glob import glob
+    for wheel in glob(wheelhouse + '/*.whl'):
+        try:
+            wheelhouse_add(wheel, wheelhouse)
+        except OSError:  # a concurrent venv-update moved it first
+            pass
 
-    # 2) Caching: Make sure everything we want is downloaded, cached, and has a wheel.
-    pip(
-        ('wheel', '--wheel-dir=' + pip_wheels) +
-        BOOTSTRAP_VERSIONS +
-        cache_opts +
-        requirements_as_options
-    )
 
-    # 3) Install: Use our well-populated cache, to do the installations.
-    install_opts += ('--no-index',)  # only use the cache
-    recently_installed += pip_install(install_opts + requirements_as_options)
+def wheelhouse_index(wheelhouse):
+    """Map each project (by lowercase key) to the wheels in the wheelhouse that this interpreter can use."""
+    from os import listdir
+    from os.path import join
+    from pip.wheel import Wheel
+    from pip._vendor.pkg_resources import safe_name
 
-    required_with_deps = trace_requirements(required)
+    index = {}
+    for partition in wheelhouse_partitions(wheelhouse):
+        for filename in sorted(listdir(partition)):
+            if filename.endswith('.whl'):
+                wheel = Wheel(filename)
+                key = safe_name(wheel.name).lower()
+                index.setdefault(key, []).append((wheel.version, join(partition, filename)))
+    return index
 
-    # TODO-TEST require A==1 then A==2
-    extraneous = (
-        reqnames(previously_installed) -
-        reqnames(required_with_deps) -
-        reqnames(recently_installed) -
-        set(['pip', 'setuptools', 'wheel'])  # the stage1 bootstrap packages
-    )
 
-    # 2) Uninstall any extraneous packages.
-    if extraneous:
-        pip(('uninstall', '--yes') + tuple(sorted(extraneous)))
+def url_is_local(url):
+    return url.startswith('file:') or '://' not in url
 
-    # Cleanup: remove stale values from the cache and wheelhouse that have not been accessed in a week.
-    run(['find', pip_download_cache, pip_wheels, '-not', '-atime', '-7', '-exec', 'rm', '-rf', '{}', '+'])
 
+def wheelhouse_match(req, wheels, pinned=False):
+    """Find the newest wheel in a wheelhouse_index satisfying this (by-name) pip InstallRequirement: see wheelhouse_find.
+    Returns its path (or url), or None.
+    """
+    if req.url is not None or pinned and not req_is_absolute(req.req):
+        return None
 
-def wait_for_all_subprocesses():
-    from os import wait
-    try:
-        while True:
-            wait()
-    except OSError as error:
-        if error.errno == 10:  # no child processes
-            return
-        else:
-            raise
+    from pip._vendor.pkg_resources import parse_version
+    # as pip would, take the newest
+    matches = [(parse_version(version), path) for version, path in wheels.get(req.req.key, ()) if version in req.req]
+    if matches:
+        return max(matches)[1]
 
 
-def backintime(reference, filename):
+def wheelhouse_find(req, wheels, pinned=False):
+    """Find a wheel satisfying this pip InstallRequirement, and return its distribution, or None.
+
+    With pinned, only a pinned (==) requirement can be satisfied: for anything else, pip would search for newer.
+    """
+    from pip.download import url_to_path
+
+    if req.url is not None:
+        if url_is_local(req.url) and req.url.endswith('.whl'):
+            return wheel_dist(url_to_path(req.url))
+        return None
+
+    path = wheelhouse_match(req, wheels, pinned)
+    return None if path is None else wheel_dist(path)
+
+
+def wheelhouse_resolve(plan, wheelhouse, pinned=True, union=False):
+    """Look up each requirement of a requirements_plan (and, transitively, its dependencies) in the wheelhouse.
+
+    Returns an (arg, InstallRequirement, dist) for each, where dist is None if it's missing from the wheelhouse.
+    The dependencies of a miss are unknown until pip finds them.
+    An explicit requirement must be pinned to be satisfied by the wheelhouse, but an unpinned dependency is satisfied
+    by any wheel that matches it, just as pip install will be. Without pinned, so is an unpinned explicit requirement:
+    that's what pip install will pick, once the wheelhouse is filled.
+    A union of several virtualenvs' requirements (see venv_update_many) may pin one project to several versions: in a
+    union, each distinct requirement of a project is resolved, rather than only the first.
+    """
+    from collections import deque
+    from pip.req import InstallRequirement
+
+    wheels = wheelhouse_index(wheelhouse)
+    queue = deque(plan)
+    seen = set()
+    result = []
+    while queue:
+        arg, req, explicit = queue.popleft()
+        if req.req is None:
+            key = req.url
+        elif union:
+            key = (req.req.key,) + tuple(sorted(req.req.specs))
+        else:
+            key = req.req.key
+        if key in seen:
+            continue
+        seen.add(key)
+
+        dist = wheelhouse_find(req, wheels, pinned=explicit and pinned)
+        result.append((arg, req, dist))
+        if dist is None:
+            continue
+
+        extras = req.req.extras if req.req else ()
+        for dist_req in sorted(dist.requires(extras), key=lambda req: req.key):
+            queue.append((str(dist_req), InstallRequirement(dist_req, str(req)), False))
+    return result
+
+
+def wheelhouse_misses(plan, wheelhouse, union=False):
+    """Find what pip wheel needs to build, given a requirements_plan: the arguments of what the wheelhouse lacks.
+    pip wheel takes only one requirement per project, so they come in rounds, each naming a project at most once.
+    Only a union (see wheelhouse_resolve) needs more than one.
+    """
+    rounds = []
+    for arg, req, dist in wheelhouse_resolve(plan, wheelhouse, union=union):
+        if dist is not None:
+            continue
+        key = req.req.key if req.req else req.url
+        for misses in rounds:
+            if key not in dict(misses):
+                break
+        else:
+            misses = []
+            rounds.append(misses)
+        misses.append((key, arg))
+    return [[arg for _, arg in misses] for misses in rounds]
+
+
+@contextmanager
+def file_locks(paths, waiting):
+    """Hold several file_locks at once. Take them in a consistent order, to avoid deadlock."""
+    if not paths:
+        yield
+        return
+    with file_lock(paths[0], waiting=waiting):
+        with file_locks(paths[1:], waiting):
+            yield
+
+
+BUILD_ENVIRONMENT = (
+    'CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LDSHARED', 'ARCHFLAGS',
+    'CPATH', 'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH', 'LIBRARY_PATH',
+)
+
+
+def compiler_environment():
+    """What a C extension's build depends on, besides its source and the interpreter: the compiler, the environment
+    given to it, and the system headers. A header is taken to have changed when its include directory has: package
+    managers replace files by renaming, which updates that.
+    """
+    from os import environ, pathsep
+    from os.path import exists, getmtime, join, realpath
+
+    compiler = (environ.get('CC') or 'cc').split()[0]
+    for directory in ('',) if '/' in compiler else environ.get('PATH', '').split(pathsep):
+        if exists(join(directory, compiler)):
+            compiler = realpath(join(directory, compiler))
+            compiler = [compiler] + file_identity(compiler)
+            break
+    includes = ['/usr/include', '/usr/local/include']
+    for variable in ('CPATH', 'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH'):
+        includes.extend(environ.get(variable, '').split(pathsep))
+    return [
+        compiler,
+        sorted((variable, environ[variable]) for variable in BUILD_ENVIRONMENT if variable in environ),
+        [(include, getmtime(include)) for include in includes if include and exists(include)],
+    ]
+
+
+def sdist_path(url):
+    """Where pip has the sdist at this url: the file itself, or its copy in the download cache. None if it has neither."""
+    from os import environ
+    from os.path import isfile, join
+    try:
+        from urllib import quote, url2pathname
+    except ImportError:  # python3
+        from urllib.parse import quote  # pylint:disable=no-name-in-module,import-error
+        from urllib.request import url2pathname  # pylint:disable=no-name-in-module,import-error
+
+    url = url.split('#', 1)[0]
+    if url.startswith('file:'):
+        path = url2pathname(url[len('file:'):])
+    else:
+        path = join(environ.get('PIP_DOWNLOAD_CACHE', ''), quote(url, ''))
+    return path if isfile(path) else None
+
+
+def build_failure_key(url, pipdir):
+    """What a failed wheel build of the sdist at this url is remembered by: the sdist's sha256, the interpreter and its
+    ABI, and the compiler_environment. None if we can't tell (e.g. the sdist isn't a file), so it's always built.
+    """
+    import json
+    from hashlib import sha1
+    from sys import version
+    path = url and sdist_path(url)
+    if path is None:
+        return None
+    inputs = [verified_hashes([path], pipdir).popitem()[1], version, sorted(supported_tags()), compiler_environment()]
+    return sha1(json.dumps(inputs).encode('UTF-8')).hexdigest()
+
+
+def build_failure_load(path):
+    import json
+    try:
+        with open(path) as failure:
+            return json.load(failure)
+    except (IOError, ValueError):
+        return None
+
+
+@contextmanager
+def remembered_build_failures(failures, pipdir):
+    """Monkeypatch pip wheel to remember each failed wheel build in the directory `failures`, with its log.
+
+    Until its inputs change (see build_failure_key), the build isn't tried again: pip is told straight away that it
+    failed, with the log from last time, and pip install falls back to installing from the sdist, as it would have.
+    """
+    from os.path import join
+    from sys import stdout
+    from pip.index import PackageFinder
+    from pip.log import logger
+    from pip.wheel import WheelBuilder
+
+    orig_find_requirement = vars(PackageFinder)['find_requirement']
+    orig_build_one = vars(WheelBuilder)['_build_one']
+    # pip only gives a requirement its url when it's a wheel: we need to know which sdist an index or --find-links gave
+    found = {}
+
+    class Log(list):
+        write = list.append
+
+    def find_requirement(self, req, upgrade):
+        link = orig_find_requirement(self, req, upgrade)
+        if link is not None:
+            found[req] = link.url
+        return link
+
+    def build_one(self, req):
+        url = req.url or found.get(req)
+        key = build_failure_key(url, pipdir)
+        if key is None:
+            return orig_build_one(self, req)
+        path = join(failures, key + '.json')
+        failure = build_failure_load(path)
+        if failure is not None:
+            # (this may well be too long for info's echo)
+            stdout.write(failure['log'])
+            stdout.flush()
+            info('Building a wheel for %s failed before, as above, and its inputs are unchanged: not trying again.' % (
+                req.name,
+            ))
+            info('(Remove %s to try anyway.)' % timid_relpath(path))
+            return False
+
+        log = Log()
+        logger.consumers.append((logger.DEBUG, log))
+        try:
+            built = orig_build_one(self, req)
+        finally:
+            logger.consumers.remove((logger.DEBUG, log))
+        if not built:
+            mkdirp(failures)
+            write_json_atomic(path, dict(name=req.name, url=url, log=''.join(log)))
+        return built
+
+    PackageFinder.find_requirement = find_requirement
+    WheelBuilder._build_one = build_one
+    try:
+        yield
+    finally:
+        PackageFinder.find_requirement = orig_find_requirement
+        WheelBuilder._build_one = orig_build_one
+
+
+def wheelhouse_build(args, wheelhouse, pip_opts, pipdir):
+    """Build wheels for these requirements (and their dependencies) into the wheelhouse.
+    The wheels are built in a private directory, and each only appears in the wheelhouse once it's complete.
+    """
+    from os import listdir
+    from os.path import join
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    mkdirp(wheelhouse)
+    tmp = mkdtemp(prefix='.build-', dir=wheelhouse)
+    try:
+        # pip wheel skips anything which is already a wheel in the wheelhouse, so only new wheels land in tmp
+        with remembered_build_failures(wheelhouse + '/.failures', pipdir):
+            pip(('wheel', '--wheel-dir=' + tmp) + pip_opts + tuple(args), pipdir)
+        built = [wheelhouse_add(join(tmp, wheel), wheelhouse) for wheel in listdir(tmp)]
+    finally:
+        rmtree(tmp)
+    # hash the new wheels now, while they're in the page cache
+    verified_hashes(built, pipdir)
+    return built
+
+
+def wheelhouse_tiers(options):
+    """The wheelhouse's slower tiers, in the order they're tried: a shared directory, then an HTTP server.
+    The local wheelhouse, under --cache-dir, is the first tier. Offline, there's no HTTP tier.
+    """
+    tiers = []
+    if options.get('shared_wheelhouse'):
+        tiers.append(options['shared_wheelhouse'])
+    if options.get('remote_wheelhouse') and not options.get('offline'):
+        tiers.append(options['remote_wheelhouse'].rstrip('/'))
+    return tiers
+
+
+def tier_is_remote(tier):
+    return tier.startswith(('http://', 'https://'))
+
+
+def http_request(url, data=None, method='GET', headers=()):
+    """Make an HTTP request, returning the response: a file-like object. Failures raise IOError."""
+    try:
+        from urllib.request import Request, urlopen
+    except ImportError:  # python2
+        from urllib2 import Request, urlopen
+    request = Request(url, data=data, headers=dict(headers))
+    request.get_method = lambda: method
+    return urlopen(request, timeout=60)
+
+
+def http_links(url):
+    """The (unquoted) hrefs of an HTML directory listing, as served by e.g. `python -m SimpleHTTPServer`."""
+    from contextlib import closing
+    from re import findall
+    try:
+        from urllib.parse import unquote
+    except ImportError:  # python2
+        from urllib import unquote
+    with closing(http_request(url + '/')) as response:
+        page = response.read().decode('UTF-8', 'replace')
+    return [unquote(href) for href in findall(r'href="([^"?]+)"', page)]
+
+
+def tier_index(tier):
+    """A wheelhouse_index of a tier: a (partitioned) wheelhouse directory, or the url of an HTTP server's listings of one.
+    A wheel's url may end with a #sha256= of its content, which tier_fetch will check.
+    """
+    if not tier_is_remote(tier):
+        return wheelhouse_index(tier)
+
+    from pip.wheel import Wheel
+    from pip._vendor.pkg_resources import safe_name
+    index = {}
+    for partition in http_links(tier):
+        partition = partition.strip('/')
+        if partition.count('-') != 2 or '/' in partition or not tag_supported(partition):
+            continue
+        for href in http_links(tier + '/' + partition):
+            if href.partition('#')[0].endswith('.whl'):
+                wheel = Wheel(href.partition('#')[0])
+                index.setdefault(safe_name(wheel.name).lower(), []).append((wheel.version, tier + '/' + partition + '/' + href))
+    return index
+
+
+def tier_fetch(location, wheelhouse, pipdir):
+    """Copy a wheel, from a tier_index location, into the local wheelhouse. Returns its path there, or None if its
+    content doesn't match the location's #sha256=.
+    """
+    from contextlib import closing
+    from os.path import basename, join
+    from shutil import copyfileobj, rmtree
+    from tempfile import mkdtemp
+
+    url, _, fragment = location.partition('#')
+    mkdirp(wheelhouse)
+    tmp = mkdtemp(prefix='.fetch-', dir=wheelhouse)
+    try:
+        path = join(tmp, basename(url))
+        with open(path, 'wb') as fetched:
+            with closing(http_request(url) if tier_is_remote(url) else open(url, 'rb')) as source:
+                copyfileobj(source, fetched)
+        if fragment.startswith('sha256=') and file_sha256(path)[0] != fragment[len('sha256='):]:
+            info('Not using %s: its content does not match its sha256.' % location)
+            return None
+        path = wheelhouse_add(path, wheelhouse)
+    finally:
+        rmtree(tmp)
+    verified_hashes([path], pipdir)
+    return path
+
+
+def tier_find(req, pinned, tiers, indexes):
+    """The location of a wheel satisfying this pip InstallRequirement in the first tier that has one, or None.
+    indexes are each tier's tier_index, filled as they're needed.
+    """
+    for tier in tiers:
+        if tier not in indexes:
+            try:
+                indexes[tier] = tier_index(tier)
+            except (IOError, OSError) as error:
+                info('Skipping wheelhouse %s: %s' % (tier, error))
+                indexes[tier] = {}
+        location = wheelhouse_match(req, indexes[tier], pinned)
+        if location is not None:
+            return location
+
+
+def wheelhouse_promote(plan, wheelhouse, tiers, pipdir, union=False):
+    """Copy what the local wheelhouse lacks, for a requirements_plan, from the slower tiers into it.
+    The dependencies of a fetched wheel are only known once we have it, so this goes round until nothing more is found.
+    """
+    from os.path import basename
+    explicit = set(arg for arg, _, is_explicit in plan if is_explicit)
+    indexes = {}
+    fetched = set()
+    while True:
+        found = False
+        for arg, req, dist in wheelhouse_resolve(plan, wheelhouse, union=union):
+            location = dist is None and tier_find(req, arg in explicit, tiers, indexes)
+            if location and location not in fetched:
+                fetched.add(location)
+                info('Fetching %s' % basename(location.partition('#')[0]))
+                found = tier_fetch(location, wheelhouse, pipdir) is not None or found
+        if not found:
+            return
+
+
+def tier_publish(wheel, tier):
+    """Copy a wheel to a tier (unless it's there already), into its partition."""
+    from os import fchmod, stat
+    from os.path import basename, exists, join
+    from shutil import copyfileobj
+    partition = wheel_tag(basename(wheel))
+    with open(wheel, 'rb') as content:
+        if tier_is_remote(tier):
+            try:
+                from urllib.parse import quote
+            except ImportError:  # python2
+                from urllib import quote
+            url = '%s/%s/%s' % (tier, partition, quote(basename(wheel)))
+            headers = (('Content-Length', str(stat(wheel).st_size)), ('Content-Type', 'application/octet-stream'))
+            http_request(url, data=content, method='PUT', headers=headers).close()
+        elif not exists(join(tier, partition, basename(wheel))):
+            with atomic_file(join(tier, partition, basename(wheel)), 'wb') as published:
+                fchmod(published.fileno(), 0o644)  # it's shared
+                copyfileobj(content, published)
+
+
+def wheelhouse_publish(wheels, tiers):
+    """Share wheels we've built with the slower tiers. This is best-effort: a tier we can't write to is skipped."""
+    from os.path import basename
+    for tier in tiers:
+        for wheel in wheels:
+            try:
+                tier_publish(wheel, tier)
+            except (IOError, OSError) as error:
+                info('Could not publish %s to %s: %s' % (basename(wheel), tier, error))
+                break
+
+
+def wheelhouse_fill(plan, wheelhouse, pip_opts, pipdir, tiers=(), union=False):
+    """Make sure everything in a requirements_plan has a wheel in the wheelhouse.
+
+    What's missing is first looked for in the slower tiers (see wheelhouse_tiers), and anything we must build is then
+    published to them. Builds are single-flight: each missing requirement is locked while it's built, so a concurrent
+    venv-update that needs it too waits for that build, then finds the wheel, rather than building it again.
+    Only the requirements in the plan are locked: a dependency that isn't listed there itself (i.e. one that isn't
+    pinned in the requirements) may still be built by two venv-updates at once. Each build is private until it's
+    complete (see wheelhouse_build), so that only costs time.
+    """
+    from hashlib import sha1
+    from os.path import join
+
+    missing = wheelhouse_misses(plan, wheelhouse, union)
+    if missing and tiers:
+        wheelhouse_promote(plan, wheelhouse, tiers, pipdir, union)
+        missing = wheelhouse_misses(plan, wheelhouse, union)
+    if missing:
+        locks = sorted(
+            join(wheelhouse, '.locks', sha1(arg.encode('UTF-8')).hexdigest())
+            for args in missing for arg in args
+        )
+        with file_locks(locks, waiting='Waiting for another venv-update to finish building wheels...'):
+            # anything built while we waited is no longer missing
+            missing = wheelhouse_misses(plan, wheelhouse, union)
+            for args in missing:
+                wheelhouse_publish(wheelhouse_build(args, wheelhouse, pip_opts, pipdir), tiers)
+
+    if not missing:
+        info('All requirements are already in the wheelhouse.')
+
+
+BUNDLE_INDEX = 'index.json'
+
+
+def bundle_write(bundle, index, open_wheel):
+    """Write a wheelhouse bundle: a tar of wheels, each at <wheel_tag>/<filename>, led by a central index of them all.
+    The tar isn't compressed: wheels are already.
+
+    index is a list of dicts of each wheel's path (in the bundle), name, version, size and sha256.
+    open_wheel(entry) opens the content of the wheel of one index entry.
+    """
+    import json
+    import tarfile
+    from contextlib import closing
+    from io import BytesIO
+
+    index_json = json.dumps(dict(wheels=index), indent=0, sort_keys=True).encode('UTF-8')
+    with atomic_file(bundle, 'wb') as archive:
+        with closing(tarfile.open(fileobj=archive, mode='w|')) as tar:
+            member = tarfile.TarInfo(BUNDLE_INDEX)
+            member.size = len(index_json)
+            tar.addfile(member, BytesIO(index_json))
+            for entry in index:
+                member = tarfile.TarInfo(entry['path'])
+                member.size = entry['size']
+                member.mode = 0o644
+                with closing(open_wheel(entry)) as wheel:
+                    tar.addfile(member, wheel)
+
+
+def bundle_index(tar):
+    """Read the central index of a bundle (see bundle_write). It's the first member: nothing else need be read."""
+    import json
+    from contextlib import closing
+    member = tar.next()
+    if member is None or member.name != BUNDLE_INDEX:
+        info('%s is not a wheelhouse bundle: it has no %s.' % (tar.name, BUNDLE_INDEX))
+        exit(1)
+    with closing(tar.extractfile(member)) as index:
+        return json.loads(index.read().decode('UTF-8'))['wheels']
+
+
+def bundle_export(resolved, bundle, pipdir):
+    """--export-bundle: write the wheels of a wheelhouse_resolve to a bundle, for bundle_import elsewhere."""
+    from os.path import abspath, basename, getsize
+    dists = dict((abspath(dist.location), dist) for _, _, dist in resolved if dist is not None)
+    hashes = verified_hashes(sorted(dists), pipdir)
+    index = []
+    sources = {}
+    for location, dist in sorted(dists.items()):
+        filename = basename(location)
+        path = wheel_tag(filename) + '/' + filename
+        sources[path] = location
+        index.append(dict(
+            path=path, name=dist.key, version=dist.version, size=getsize(location), sha256=hashes[location],
+        ))
+    info('Exporting %i wheels to %s' % (len(index), bundle))
+    bundle_write(bundle, index, lambda entry: open(sources[entry['path']], 'rb'))
+
+
+def bundle_merge(parts, bundle):
+    """Combine several bundles into one."""
+    import tarfile
+    index = {}
+    sources = {}
+    tars = [tarfile.open(part) for part in parts]
+    try:
+        for tar in tars:
+            for entry in bundle_index(tar):
+                if entry['path'] not in index:
+                    index[entry['path']] = entry
+                    sources[entry['path']] = tar
+        bundle_write(
+            bundle,
+            [index[path] for path in sorted(index)],
+            lambda entry: sources[entry['path']].extractfile(entry['path']),
+        )
+    finally:
+        for tar in tars:
+            tar.close()
+
+
+def bundle_import_wheel(tar, member, entry, tmp):
+    """Extract one wheel of a bundle, checking it against the index. Returns its path, under tmp."""
+    from os.path import basename, join
+    from shutil import copyfileobj
+    filename = basename(member.name)
+    if member.name != wheel_tag(filename) + '/' + filename:
+        info('%s is not a valid bundle member.' % member.name)
+        exit(1)
+    path = join(tmp, filename)
+    with open(path, 'wb') as wheel:
+        copyfileobj(tar.extractfile(member), wheel)
+    if file_sha256(path)[0] != entry['sha256']:
+        info('%s in %s does not match its sha256: the bundle is corrupt.' % (member.name, tar.name))
+        exit(1)
+    return path
+
+
+def bundle_import(bundle, wheelhouse, pipdir):
+    """--import-bundle: add the wheels of a bundle (see bundle_write) to the wheelhouse, unless they're already there.
+    The index says what's in the bundle, so the bundle is read in one pass, skipping whatever we have.
+    """
+    import tarfile
+    from contextlib import closing
+    from os.path import exists, join
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    with closing(tarfile.open(bundle, 'r|')) as tar:
+        index = dict((entry['path'], entry) for entry in bundle_index(tar))
+        missing = set(path for path in index if not exists(join(wheelhouse, path)))
+        if not missing:
+            info('Everything in %s is already in the wheelhouse.' % bundle)
+            return
+        info('Importing %i wheels from %s' % (len(missing), bundle))
+        mkdirp(wheelhouse)
+        tmp = mkdtemp(prefix='.import-', dir=wheelhouse)
+        imported = []
+        try:
+            for member in tar:
+                if member.name in missing:
+                    imported.append(wheelhouse_add(bundle_import_wheel(tar, member, index[member.name], tmp), wheelhouse))
+        finally:
+            rmtree(tmp)
+    verified_hashes(imported, pipdir)
+
+
+UNZIP_CHUNK = 1 << 20
+
+
+def zip_member_offset(archive_file, info):
+    """Where a zip member's data starts in the archive: just after its local header."""
+    from struct import unpack
+    archive_file.seek(info.header_offset)
+    name_length, extra_length = unpack(str('<HH'), archive_file.read(30)[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def copy_range(source, destination, offset, count):
+    """Copy count bytes, from offset in the source file descriptor, to the destination file descriptor.
+
+    The kernel does the copying (copy_file_range, else sendfile) where it can, so that the data needn't pass through
+    our memory at all. Otherwise, it's copied in chunks.
+    """
+    import os
+    for name in ('copy_file_range', 'sendfile'):
+        copy = getattr(os, name, None)
+        try:
+            while copy and count:
+                if name == 'sendfile':
+                    copied = copy(destination, source, offset, count)
+                else:
+                    copied = copy(source, destination, count, offset)
+                if not copied:
+                    break
+                offset += copied
+                count -= copied
+        except OSError:
+            pass  # not for these files: carry on from here, the next way
+    os.lseek(source, offset, os.SEEK_SET)
+    while count:
+        chunk = os.read(source, min(count, UNZIP_CHUNK))
+        if not chunk:
+            raise IOError('unexpected end of file')
+        count -= len(chunk)
+        while chunk:
+            chunk = chunk[os.write(destination, chunk):]
+
+
+def unzip_member(archive, archive_file, mapped, info, path):
+    """Stream one zip member to path, in chunks. Returns the sha256 of its content.
+
+    A stored (uncompressed) member is copied by the kernel, and hashed straight from the mapped archive.
+    """
+    import stat
+    from hashlib import sha256
+    from os import chmod
+    from zlib import crc32
+    from zipfile import ZIP_STORED
+    from pip.util import current_umask
+
+    digest = sha256()
+    with open(path, 'wb') as out:
+        if info.compress_type == ZIP_STORED:
+            start = zip_member_offset(archive_file, info)
+            end = start + info.file_size
+            crc = 0
+            for offset in range(start, end, UNZIP_CHUNK):
+                chunk = mapped[offset:min(offset + UNZIP_CHUNK, end)]
+                digest.update(chunk)
+                crc = crc32(chunk, crc)
+            if crc & 0xffffffff != info.CRC:
+                from pip.exceptions import InstallationError
+                raise InstallationError('Bad CRC-32 for %s in %s' % (info.filename, archive.filename))
+            out.flush()
+            copy_range(archive_file.fileno(), out.fileno(), start, info.file_size)
+        else:
+            from contextlib import closing
+            with closing(archive.open(info)) as member:  # zipfile checks the CRC
+                for chunk in iter(lambda: member.read(UNZIP_CHUNK), b''):
+                    digest.update(chunk)
+                    out.write(chunk)
+
+    # as pip does, make executables executable, within the umask
+    mode = info.external_attr >> 16
+    if mode and stat.S_ISREG(mode) and mode & 0o111:
+        chmod(path, 0o777 - current_umask() | 0o111)
+    return digest
+
+
+def record_hash(digest):
+    """A sha256 in the format of a wheel's RECORD."""
+    from base64 import urlsafe_b64encode
+    return 'sha256=' + urlsafe_b64encode(digest.digest()).decode('ascii').rstrip('=')
+
+
+def verify_record(location, digests):
+    """Check the files we unzipped against the hashes in a wheel's RECORD, if there is one.
+    digests are the sha256 of each file, by its path in the wheel, taken as it was unzipped.
+    """
+    import csv
+    from os.path import join
+
+    for record in [name for name in digests if name.count('/') == 1 and name.endswith('.dist-info/RECORD')]:
+        with open(join(location, record)) as record_file:
+            for row in csv.reader(record_file):
+                if len(row) < 2 or not row[1].startswith('sha256=') or row[0] not in digests:
+                    continue
+                if record_hash(digests[row[0]]) != row[1]:
+                    from pip.exceptions import InstallationError
+                    raise InstallationError('%s does not match the hash in its RECORD: %s' % (row[0], row[1]))
+
+
+def unzip_file(filename, location, flatten=True):
+    """A streaming replacement for pip.util.unzip_file, with the same interface.
+
+    Each member goes straight to its destination in fixed-size chunks (see unzip_member), rather than being read
+    whole into memory, so that memory use doesn't grow with the size of the archive. A wheel's files are also
+    checked against the hashes in its RECORD, computed as they're written.
+    """
+    import os
+    from contextlib import closing
+    from mmap import mmap, ACCESS_READ
+    from zipfile import ZipFile
+
+    with open(filename, 'rb') as archive_file:
+        with closing(ZipFile(archive_file)) as archive:
+            infos = archive.infolist()
+            if flatten:
+                from pip.util import has_leading_dir, split_leading_dir
+                flatten = has_leading_dir(info.filename for info in infos)
+            mapped = mmap(archive_file.fileno(), 0, access=ACCESS_READ)
+            digests = {}
+            try:
+                for info in infos:
+                    name = split_leading_dir(info.filename)[1] if flatten else info.filename
+                    path = os.path.join(location, name)
+                    is_directory = info.filename.endswith(('/', '\\'))
+                    directory = path if is_directory else os.path.dirname(path)
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    if not is_directory:
+                        digests[name] = unzip_member(archive, archive_file, mapped, info, path)
+            finally:
+                mapped.close()
+    verify_record(location, digests)
+
+
+@contextmanager
+def streaming_pip_unzip():
+    """Have pip unzip its archives (e.g. wheels, on install) with our streaming unzip_file."""
+    import pip.util
+
+    unpatched = pip.util.unzip_file
+    pip.util.unzip_file = unzip_file
+    try:
+        yield
+    finally:
+        pip.util.unzip_file = unpatched
+
+
+def console_scripts(entry_points):
+    """The names of the scripts which installing a wheel will generate, given its entry_points.txt."""
+    section = None
+    for line in entry_points.decode('UTF-8').splitlines():
+        line = line.strip()
+        if line.startswith('['):
+            section = line.strip('[]').strip()
+        elif '=' in line and section in ('console_scripts', 'gui_scripts'):
+            yield line.split('=', 1)[0].strip()
+
+
+def wheel_destinations(path):
+    """Where each of a wheel's files will be installed, relative to the install scheme.
+    purelib and platlib are counted as one: in a virtualenv, they are.
+    """
+    from contextlib import closing
+    from zipfile import ZipFile
+    with closing(ZipFile(path)) as archive:
+        for member in archive.namelist():
+            if member.endswith('/'):
+                continue
+            top, _, rest = member.partition('/')
+            if top.endswith('.data'):
+                scheme, _, rest = rest.partition('/')
+                yield ('lib' if scheme in ('purelib', 'platlib') else scheme) + '/' + rest
+            else:
+                yield 'lib/' + member
+                if top.endswith('.dist-info') and rest == 'entry_points.txt':
+                    for script in console_scripts(archive.read(member)):
+                        yield 'scripts/' + script
+
+
+def wheel_collisions(paths):
+    """Find the files which more than one of these wheels would install. Returns {destination: [wheel, ...]}."""
+    owners = {}
+    for path in paths:
+        for destination in set(wheel_destinations(path)):
+            owners.setdefault(destination, []).append(path)
+    return dict((destination, paths) for destination, paths in owners.items() if len(paths) > 1)
+
+
+def install_wheel(path):
+    """Install one wheel, just as pip install would. This runs in a worker process: see install_wheels.
+    Returns the wheel's (normalized) name and how long it took, for the cost database.
+    """
+    from os.path import basename
+    from shutil import rmtree
+    from sys import prefix
+    from tempfile import mkdtemp
+    from time import time
+    from pip.wheel import Wheel, move_wheel_files
+    from pip._vendor.pkg_resources import Requirement, safe_name
+
+    start = time()
+    wheel = Wheel(basename(path))
+    # unpack within the virtualenv, so that the files are moved into place by rename
+    tmp = mkdtemp(prefix='.venv-update-', dir=prefix)
+    try:
+        unzip_file(path, tmp, flatten=False)
+        move_wheel_files(wheel.name, Requirement.parse('%s==%s' % (wheel.name, wheel.version)), tmp)
+    finally:
+        rmtree(tmp)
+    return safe_name(wheel.name).lower(), time() - start
+
+
+def install_wheels(resolved, pipdir):
+    """Install the wheels of a wheelhouse_resolve, which aren't installed already, concurrently on a process pool.
+
+    This only goes ahead if no two of the wheels install the same file, so that the order is immaterial: each
+    wheel's files, scripts and RECORD are then exactly what a (serial) pip install would have written.
+    Anything left out (e.g. whatever is missing from the wheelhouse) is left for pip install.
+    """
+    from multiprocessing import cpu_count, Pool
+    from os.path import basename
+
+    installed = dict((dist.key, dist.version) for dist in local_dists())
+    dists = dict(
+        (dist.location, dist) for _, _, dist in resolved
+        if dist is not None and installed.get(dist.key) != dist.version
+    )
+    if len(dists) < 2:
+        return  # nothing to parallelize
+
+    wheels = sorted(dists)
+    collisions = wheel_collisions(wheels)
+    if collisions:
+        destination = min(collisions)
+        info('Not installing wheels concurrently, since %s would be installed by each of: %s' % (
+            destination, ', '.join(basename(wheel) for wheel in collisions[destination]),
+        ))
+        return
+
+    replaced = sorted(dists[wheel].key for wheel in wheels if dists[wheel].key in installed)
+    if replaced:
+        pip(('uninstall', '--yes') + tuple(replaced), pipdir)
+
+    info('Installing %i wheels, %i at a time.' % (len(wheels), cpu_count()))
+    pool = Pool(cpu_count())
+    try:
+        costs_record([(name, 'install', seconds) for name, seconds in pool.map(install_wheel, wheels)], pipdir)
+    finally:
+        pool.close()
+        pool.join()
+    importlib_invalidate_caches()
+
+
+def offline_find(req, working_set, wheels):
+    """Look for a pip InstallRequirement using only what's on disk.
+
+    Returns whether it's available, along with the distribution that satisfies it, if that's known up-front.
+    An installed package only counts when the requirement is pinned: pip won't need to look any further.
+    The dependencies of local (file:// and directory) requirements can't be known without building them, so
+    those are checked later, during the install itself.
+    """
+    from pip._vendor import pkg_resources
+
+    if req.url is not None:
+        if not url_is_local(req.url):
+            return False, None
+        return True, wheelhouse_find(req, wheels)
+
+    if req_is_absolute(req.req):
+        try:
+            dist = working_set.find(req.req)
+        except pkg_resources.VersionConflict:
+            dist = None
+        if dist is not None:
+            return True, dist
+
+    dist = wheelhouse_find(req, wheels)
+    return dist is not None, dist
+
+
+def offline_preflight(requirements, wheelhouse, installed=True):
+    """Before doing any work, ensure that every requirement (transitively) can be satisfied without the network.
+
+    All the misses are reported at once, and we exit with an error if there are any.
+    Unless installed, what's installed doesn't count: see rebuild_preflight.
+    """
+    from collections import deque
+    from pip._vendor import pkg_resources
+    from pip.req import InstallRequirement
+
+    working_set = fresh_working_set() if installed else pkg_resources.WorkingSet([])
+    wheels = wheelhouse_index(wheelhouse)
+
+    queue = deque(requirements)
+    seen = set()
+    misses = []
+    while queue:
+        req = queue.popleft()
+        key = str(req.req or req.url)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        available, dist = offline_find(req, working_set, wheels)
+        if not available:
+            misses.append(req)
+        elif dist is not None:
+            extras = req.req.extras if req.req else ()
+            for dist_req in sorted(dist.requires(extras), key=lambda req: req.key):
+                queue.append(InstallRequirement(dist_req, str(req)))
+
+    # (nothing has run pip yet, so pip's logger has nowhere to write)
+    for req in misses:
+        info('Error: not available offline: %s' % req)
+    if misses:
+        exit(1)
+
+
+def req_is_vcs(req):
+    """Is this a (non-editable) git+ or hg+ url requirement?"""
+    return not req.editable and req.url is not None and req.url.startswith(('git+', 'hg+'))
+
+
+def vcs_url_parts(url):
+    """Split a pip vcs url (e.g. git+https://host/repo.git@rev#egg=name) into its vcs, repository and revision.
+    The revision is None when unspecified.
+    """
+    vcs, _, url = url.partition('+')
+    url = url.split('#', 1)[0]
+    if url.startswith('file:/') and not url.startswith('file://'):
+        url = 'file://' + url[len('file:'):]  # pip 1.5 turns file:///path into file:/path
+    scp_style = '://' not in url  # e.g. git+git@github.com:Yelp/venv-update.git
+    if scp_style:
+        url = 'ssh://' + url
+
+    # as in pip.vcs, the revision is the last @ in the path, so a user@host is left alone
+    scheme, _, path = url.partition('://')
+    host, slash, path = path.partition('/')
+    if '@' in path:
+        path, rev = path.rsplit('@', 1)
+    else:
+        rev = None
+
+    repo = scheme + '://' + host + slash + path
+    if scp_style:
+        repo = repo[len('ssh://'):]
+    return vcs, repo, rev
+
+
+def cmd_output(cmd):
+    """Run a command, and return its stripped stdout, or None if it failed."""
+    from subprocess import Popen, PIPE
+    process = Popen(cmd, stdout=PIPE)
+    out, _ = process.communicate()
+    if process.returncode != 0:
+        return None
+    return out.decode('UTF-8').strip() or None
+
+
+def vcs_commit_id(rev):
+    """Is this revision already a full commit id? Then it can be used without any network lookup."""
+    from re import match
+    return rev is not None and match('^[0-9a-f]{40}$', rev) is not None
+
+
+def vcs_resolve_remote(vcs, repo, rev):
+    """Ask the remote repository which commit a revision points at, without fetching anything."""
+    if vcs == 'git':
+        rev = rev or 'HEAD'
+        out = cmd_output(('git', 'ls-remote', repo, rev, rev + '^{}'))
+        if out is None:
+            return None  # probably an abbreviated commit id
+        refs = [line.split() for line in out.splitlines()]
+        # annotated tags point at a tag object; the peeled ^{} entry is the commit it refers to
+        refs.sort(key=lambda ref: not ref[1].endswith('^{}'))
+        return refs[0][0]
+    else:
+        return cmd_output(('hg', 'identify', '--debug', '--id', '--rev', rev or 'default', repo))
+
+
+def vcs_resolve_local(vcs, mirror, rev):
+    """Find which commit a revision points at, in our local mirror."""
+    from os.path import isdir
+    if not isdir(mirror):
+        return None
+    elif vcs == 'git':
+        return cmd_output(('git', '--git-dir=' + mirror, 'rev-parse', '--verify', '--quiet', (rev or 'HEAD') + '^{commit}'))
+    else:
+        return cmd_output(('hg', '--repository', mirror, 'log', '--rev', rev or 'default', '--template', '{node}'))
+
+
+def vcs_clone_mirror(vcs, repo, mirror):
+    """Make a new bare mirror of the repository. It only appears at `mirror` once the clone is complete."""
+    from os import rename
+    from os.path import dirname, join
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    tmp = mkdtemp(prefix='.clone-', dir=dirname(mirror))
+    try:
+        if vcs == 'git':
+            run(('git', 'clone', '--quiet', '--mirror', repo, join(tmp, 'mirror')))
+        else:
+            run(('hg', 'clone', '--quiet', '--noupdate', repo, join(tmp, 'mirror')))
+        rename(join(tmp, 'mirror'), mirror)
+    finally:
+        rmtree(tmp)
+
+
+def vcs_update_mirror(vcs, repo, mirror):
+    """Create a bare mirror of the repository, or incrementally fetch into the one we have.
+    Only one venv-update at a time may do so, per mirror.
+    """
+    from os.path import isdir
+    with file_lock(mirror + '.lock', waiting='Waiting for another update of %s' % repo):
+        if not isdir(mirror):
+            vcs_clone_mirror(vcs, repo, mirror)
+        elif vcs == 'git':
+            run(('git', '--git-dir=' + mirror, 'fetch', '--quiet', '--prune', 'origin'))
+        else:
+            run(('hg', 'pull', '--quiet', '--repository', mirror, repo))
+
+
+def vcs_checkout(vcs, mirror, commit, dest):
+    """Check out a particular commit from our mirror. This is a local (hardlinked) clone, so it's cheap."""
+    from os.path import exists, join
+    if vcs == 'git':
+        run(('git', 'clone', '--quiet', '--shared', '--no-checkout', mirror, dest))
+        run(('git', '--git-dir=' + join(dest, '.git'), '--work-tree=' + dest, 'checkout', '--quiet', commit))
+        if exists(join(dest, '.gitmodules')):
+            run(('git', 'submodule', '--quiet', 'update', '--init', '--recursive'), cwd=dest)
+    else:
+        run(('hg', 'clone', '--quiet', '--updaterev', commit, mirror, dest))
+
+
+def vcs_resolve(vcs, repo, rev, mirror, offline):
+    """Find the commit id that a revision refers to. Offline, our (possibly stale) mirror is the best we can do."""
+    if vcs_commit_id(rev):
+        return rev
+
+    commit = None
+    if not offline:
+        commit = vcs_resolve_remote(vcs, repo, rev)
+    if commit is None:
+        if not offline:
+            vcs_update_mirror(vcs, repo, mirror)
+        commit = vcs_resolve_local(vcs, mirror, rev)
+    return commit
+
+
+def vcs_build_wheel(vcs, repo, commit, mirror, wheel_dir, pip_opts, pipdir):
+    """Build a wheel of this commit into wheel_dir, using our mirror of the repository."""
+    from os import listdir, rename
+    from os.path import dirname, join
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    mkdirp(dirname(mirror))
+    if vcs_resolve_local(vcs, mirror, commit) is None:
+        vcs_update_mirror(vcs, repo, mirror)
+
+    mkdirp(wheel_dir)
+    tmp = mkdtemp(prefix='.build-', dir=dirname(wheel_dir))
+    try:
+        checkout = join(tmp, 'checkout')
+        vcs_checkout(vcs, mirror, commit, checkout)
+        pip(('wheel', '--no-deps', '--wheel-dir=' + join(tmp, 'wheels')) + pip_opts + (checkout,), pipdir)
+        # the wheel only becomes visible once it's completely built
+        wheel, = listdir(join(tmp, 'wheels'))
+        rename(join(tmp, 'wheels', wheel), join(wheel_dir, wheel))
+    finally:
+        rmtree(tmp)
+
+
+def vcs_wheel(url, pipdir, pip_opts, offline):
+    """Return the path to a wheel for this vcs url requirement, building it if necessary.
+
+    Repositories are kept as bare mirrors, and wheels are cached under the (repository, commit) they were built from,
+    so an unchanged revision needs neither a clone nor a build. Other interpreters' wheels of the same commit are kept
+    alongside: each only uses those it supports, and builds its own if there are none.
+    Returns None if the revision can't be resolved.
+    """
+    from glob import glob
+    from hashlib import sha1
+    from os.path import basename, join
+
+    vcs_cache = join(pipdir, 'vcs')
+    vcs, repo, rev = vcs_url_parts(url)
+    mirror = join(vcs_cache, 'mirrors', sha1(repo.encode('UTF-8')).hexdigest())
+    commit = vcs_resolve(vcs, repo, rev, mirror, offline)
+    if commit is None:
+        return None
+
+    wheel_dir = join(vcs_cache, 'wheels', sha1((repo + '@' + commit).encode('UTF-8')).hexdigest())
+
+    def usable():
+        return [wheel for wheel in glob(join(wheel_dir, '*.whl')) if tag_supported(wheel_tag(basename(wheel)))]
+
+    wheels = usable()
+    if not wheels and not offline:
+        # single-flight: if another venv-update is already building this commit, we wait for its wheel instead
+        with file_lock(wheel_dir + '.lock', waiting='Waiting for another build of %s at %s' % (repo, commit)):
+            wheels = usable()
+            if not wheels:
+                info('Building %s at %s' % (repo, commit))
+                vcs_build_wheel(vcs, repo, commit, mirror, wheel_dir, pip_opts, pipdir)
+                wheels = usable()
+    return wheels[0] if wheels else None
+
+
+def vcs_requirements_as_wheels(requirements, pipdir, pip_opts, offline):
+    """Replace each vcs url requirement with a requirement on its cached wheel.
+
+    Returns the new list of requirements, and a mapping of each replaced url to its wheel (see requirements_plan).
+    """
+    from os.path import basename
+    from pip.download import path_to_url
+    from pip.req import InstallRequirement
+    from pip.wheel import Wheel
+
+    result = []
+    substitutions = {}
+    for req in requirements:
+        if req_is_vcs(req):
+            wheel = vcs_wheel(req.url, pipdir, pip_opts, offline)
+            if wheel is not None:
+                # named: pip 1.5 only replaces what's installed (on --upgrade) if it knows the name before unpacking
+                line = '%s#egg=%s' % (path_to_url(wheel), Wheel(basename(wheel)).name)
+                substitutions[req.url] = (line,)
+                req = InstallRequirement.from_line(line, req.comes_from)
+        result.append(req)
+    return result, substitutions
+
+
+def req_is_local_editable(req):
+    """Is this a `-e path` requirement (as opposed to e.g. `-e git+...`)?"""
+    return req.editable and url_is_local(req.url)
+
+
+def editable_installs(egg_links=None):
+    """Map the target directory of each egg-link (that is, each `setup.py develop`) in site-packages to its egg-link."""
+    from distutils.sysconfig import get_python_lib  # pylint:disable=import-error
+    from glob import glob
+    from os.path import join, realpath
+
+    if egg_links is None:
+        egg_links = glob(join(get_python_lib(), '*.egg-link'))
+    result = {}
+    for egg_link in egg_links:
+        with open(egg_link) as egg_link_file:
+            target = egg_link_file.readline().strip()
+        result[realpath(target)] = egg_link
+    return result
+
+
+def editable_target(src_dir, installs):
+    """Find where the `setup.py develop` of this directory points its egg-link, or None if it's not installed.
+    With e.g. a src/ layout the target is a subdirectory, so we take the nearest one.
+    """
+    targets = [target for target in installs if path_is_within(target, src_dir)]
+    if targets:
+        return min(targets, key=len)
+
+
+def editable_fingerprint(src_dir, installs):
+    """Fingerprint an editable install by the contents of its setup.py, setup.cfg, egg-info metadata and egg-link.
+    Returns None if it's not installed.
+    """
+    from glob import glob
+    from hashlib import sha1
+    from os.path import isfile, join
+
+    target = editable_target(src_dir, installs)
+    if target is None:
+        return None
+
+    fingerprint = sha1()
+    for filename in [
+            join(src_dir, 'setup.py'),
+            join(src_dir, 'setup.cfg'),
+            installs[target],
+    ] + sorted(glob(join(target, '*.egg-info', '*'))):
+        if isfile(filename):
+            fingerprint.update(filename.encode('UTF-8') + b'\0')
+            with open(filename, 'rb') as contents:
+                fingerprint.update(contents.read())
+    return fingerprint.hexdigest()
+
+
+def editable_dist(src_dir, installs):
+    """The pkg_resources distribution for an editable install, or None if it's not installed."""
+    from pip._vendor import pkg_resources
+
+    target = editable_target(src_dir, installs)
+    if target is not None:
+        for dist in pkg_resources.find_distributions(target, True):
+            return dist
+
+
+def editable_requirements(plan):
+    """The dependencies of the `-e path` requirements in a requirements_plan, as plan entries of their own.
+    pip wheel can't build an editable, but pip install --no-index will still need its dependencies from the wheelhouse.
+    They're read from the project's egg-info, just as pip install -e will write it.
+    """
+    from copy import copy
+    from os.path import realpath
+    from pip.download import url_to_path
+    from pip.req import InstallRequirement
+
+    result = []
+    for _, req, _ in plan:
+        if req_is_local_editable(req):
+            req = copy(req)
+            req.source_dir = realpath(url_to_path(req.url))
+            req.run_egg_info()
+            for dependency in req.requirements(req.extras):
+                result.append((dependency, InstallRequirement.from_line(dependency, str(req)), False))
+    return result
+
+
+def editables_state_path(venv_path):
+    from os.path import join
+    return join(venv_path, '.venv-update.editables')
+
+
+def unchanged_editables(requirements, venv_path, known_names):
+    """Find the `-e path` requirements whose fingerprint is unchanged since we last installed them.
+
+    There's no need to re-run their `setup.py develop`, so each is substituted by its dependencies (see
+    requirements_plan), excluding those already named in known_names.
+    """
+    import json
+    from os.path import realpath
+    from pip.download import url_to_path
+    from pip._vendor.pkg_resources import safe_name
+
+    try:
+        with open(editables_state_path(venv_path)) as state:
+            fingerprints = json.load(state)
+    except (IOError, ValueError):
+        fingerprints = {}
+
+    installs = editable_installs()
+    known_names = set(safe_name(name).lower() for name in known_names if name)
+    substitutions = {}
+    for req in requirements:
+        if not req_is_local_editable(req):
+            continue
+
+        src_dir = realpath(url_to_path(req.url))
+        fingerprint = editable_fingerprint(src_dir, installs)
+        if fingerprint is None or fingerprints.get(src_dir) != fingerprint:
+            continue
+
+        info('Editable requirement is unchanged: %s' % timid_relpath(src_dir))
+        dependencies = []
+        for dep in editable_dist(src_dir, installs).requires(req.extras):
+            if dep.key not in known_names:
+                known_names.add(dep.key)
+                dependencies.append(str(dep))
+        substitutions[req.url] = tuple(dependencies)
+    return substitutions
+
+
+def record_editables(requirements, venv_path):
+    """Store the fingerprint of each (just-installed) `-e path` requirement.
+
+    Returns the requirements, with each editable replaced by its project name, so that its dependencies can be traced.
+    """
+    import json
+    from os.path import realpath
+    from pip.download import url_to_path
+    from pip.req import InstallRequirement
+
+    installs = editable_installs()
+    fingerprints = {}
+    result = []
+    for req in requirements:
+        if req_is_local_editable(req):
+            src_dir = realpath(url_to_path(req.url))
+            fingerprint = editable_fingerprint(src_dir, installs)
+            if fingerprint is not None:
+                fingerprints[src_dir] = fingerprint
+                req = InstallRequirement.from_line(editable_dist(src_dir, installs).project_name, req.comes_from)
+        result.append(req)
+
+    with open(editables_state_path(venv_path), 'w') as state:
+        json.dump(fingerprints, state)
+    return result
+
+
+def reqnames(reqs):
+    return set(req.name for req in reqs)
+
+
+def path_is_within(path, within):
+    from os.path import relpath, join
+    path = join('.', path)  # eliminate empty-string edge case
+    return not relpath(path, within).startswith('..')
+
+
+def venv_validation(venv_path, venv_args):
+    """The values which, if any of them changes, invalidate an existing virtualenv."""
+    import json
+    from sys import version
+    from virtualenv import __version__ as virtualenv_version
+    validation = (
+        version,  # includes e.g. pypy version
+        virtualenv_version,
+        venv_args,
+        venv_path,
+    )
+    # normalize types, via json round-trip
+    return json.loads(json.dumps(validation))
+
+
+def venv_state(venv_path):
+    """The state recorded by validate_venv, if any."""
+    import json
+    from os.path import join
+    try:
+        with open(join(venv_path, '.venv-update.state')) as state:
+            return json.load(state)
+    except (IOError, ValueError):
+        return {}
+
+
+def venv_moved(previous_validation, validation):
+    """Is the only difference between these venv_validations the virtualenv's path?"""
+    return bool(previous_validation) and previous_validation[:-1] == validation[:-1] != previous_validation
+
+
+def relocate_file(path, old, new):
+    """Replace the old virtualenv path with the new one, in one (text) file."""
+    from re import escape, subn
+    with open(path, 'rb') as textfile:
+        contents = textfile.read()
+    if b'\0' in contents:
+        return  # a binary
+
+    # the old path, but not as a prefix of some other name (/old/venv vs. /old/venv2)
+    contents, count = subn(escape(old.encode('UTF-8')) + br'(?![\w.-])', new.encode('UTF-8'), contents)
+    if count:
+        from os import fchmod, stat
+        with atomic_file(path, 'wb') as textfile:
+            fchmod(textfile.fileno(), stat(path).st_mode)  # scripts stay executable
+            textfile.write(contents)
+
+
+def relocate_venv(venv_path, old, new):
+    """Make a virtualenv, created at the `old` path and now found at venv_path, work at the `new` path.
+    The absolute paths in its scripts (shebangs, activate), its .pth and .egg-link files and its symlinks are rewritten.
+    """
+    from os import readlink, symlink, unlink, walk
+    from os.path import basename, islink, join
+
+    for dirpath, dirnames, filenames in walk(venv_path):
+        for name in dirnames + filenames:
+            path = join(dirpath, name)
+            if islink(path):
+                target = readlink(path)
+                if target == old or target.startswith(old + '/'):
+                    unlink(path)
+                    symlink(new + target[len(old):], path)
+            elif name in filenames and (basename(dirpath) == 'bin' or name.endswith(('.pth', '.egg-link'))):
+                relocate_file(path, old, new)
+
+
+def venv_key(validation, reqs):
+    """Identify a virtualenv by its venv_validation (less the virtualenv's path) and the contents of its requirements.
+    Returns None if the requirements can't be read.
+    """
+    import json
+    from hashlib import sha1
+    try:
+        files = parse_requirements_tree(reqs)['files']
+    except (IOError, OSError):
+        return None
+    key = json.dumps([validation[:-1], [digest for _, digest in files]])
+    return sha1(key.encode('UTF-8')).hexdigest()
+
+
+def snapshot_path(snapshots, validation, reqs):
+    """Snapshots are named by their venv_key. Returns None if the requirements can't be read."""
+    from os.path import join
+    key = venv_key(validation, reqs)
+    if key is None:
+        return None
+    return join(snapshots, key + '.tar.gz')
+
+
+def snapshot_export(venv_path, snapshot):
+    """Save a (compressed) snapshot of the virtualenv. Its recorded venv_validation tells snapshot_import where from."""
+    import tarfile
+    from contextlib import closing
+    with atomic_file(snapshot, 'wb') as archive:
+        with closing(tarfile.open(fileobj=archive, mode='w:gz')) as tar:
+            tar.add(venv_path, arcname='venv')
+
+
+def snapshot_import(snapshot, venv_path):
+    """Restore a snapshot of a virtualenv to venv_path, which needn't be where it was taken."""
+    import tarfile
+    from contextlib import closing
+    from os import rename
+    from os.path import dirname, join
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    mkdirp(dirname(venv_path))
+    tmp = mkdtemp(prefix='.venv-update-', dir=dirname(venv_path))
+    try:
+        with closing(tarfile.open(snapshot)) as tar:
+            tar.extractall(tmp)
+        restored = join(tmp, 'venv')
+        relocate_venv(restored, venv_state(restored)['validation'][-1], venv_path)
+        forget_venv_inputs(restored)
+        rename(restored, venv_path)
+    finally:
+        rmtree(tmp)
+
+
+def snapshot_restore(venv_path, validation, reqs, options):
+    """Try to restore the virtualenv from a snapshot, rather than building it from scratch."""
+    from os.path import exists
+    if not options.get('snapshots'):
+        return False
+    snapshot = snapshot_path(options['snapshots'], validation, reqs)
+    if snapshot is None or not exists(snapshot):
+        return False
+
+    info('Restoring virtualenv from snapshot: %s' % timid_relpath(snapshot))
+    snapshot_import(snapshot, venv_path)
+    return True
+
+
+def snapshot_save(venv_path, reqs, options):
+    """Take a snapshot of a freshly-updated virtualenv, unless there's one already."""
+    from os.path import exists
+    snapshot = snapshot_path(options['snapshots'], venv_state(venv_path)['validation'], reqs)
+    if snapshot is not None and not exists(snapshot):
+        info('Saving snapshot of virtualenv: %s' % timid_relpath(snapshot))
+        snapshot_export(venv_path, snapshot)
+
+
+def python_abi(version):
+    """The part of a sys.version which matters to compiled extensions: python's major.minor, and pypy's version."""
+    from re import search
+    pypy = search(r'\[PyPy (\d+\.\d+)', version)
+    return ('.'.join(version.split('.', 2)[:2]), pypy.group(1) if pypy else None)
+
+
+def python_patched(previous_validation, validation):
+    """Is the only difference between these venv_validations a patch-level (ABI compatible) change of python?"""
+    return (
+        bool(previous_validation) and
+        previous_validation[1:] == validation[1:] and
+        previous_validation[0] != validation[0] and
+        python_abi(previous_validation[0]) == python_abi(validation[0])
+    )
+
+
+def dist_is_abi_specific(dist_info):
+    """Does this installed distribution (a .dist-info or .egg-info directory) include compiled code?"""
+    from os.path import join
+    from re import search
+    for metadata in ('WHEEL', 'RECORD', 'installed-files.txt'):
+        try:
+            with open(join(dist_info, metadata)) as metadata_file:
+                contents = metadata_file.read()
+        except IOError:
+            continue
+        if search(r'(?m)^Tag: [^-\s]+-(?!none-any\s)', contents) or search(r'\.(so|pyd)\b', contents):
+            return True
+    return False
+
+
+def venv_metadata(venv_path, patterns=('*.dist-info', '*.egg-info')):
+    """Find the packages' metadata in a virtualenv's site-packages, without asking its python."""
+    from glob import glob
+    result = []
+    for site_packages in ('/lib/*/site-packages', '/site-packages'):  # the latter: pypy
+        for pattern in patterns:
+            result.extend(glob(venv_path + site_packages + '/' + pattern))
+    return result
+
+
+def abi_specific_dists(venv_path):
+    """The names of the packages installed in a virtualenv which include compiled code."""
+    from os.path import basename
+    return sorted(set(
+        basename(dist_info).split('-', 1)[0]
+        for dist_info in venv_metadata(venv_path)
+        if dist_is_abi_specific(dist_info)
+    ))
+
+
+def update_venv_python(executable, venv_path, venv_args):
+    """Bring a virtualenv up to date with a patched python, keeping the pure-python packages in place.
+    virtualenv updates the interpreter and standard library; packages with compiled code are removed, and will be
+    reinstalled (by stage2) from the wheelhouse.
+    """
+    run((executable, '-m', 'virtualenv', venv_path) + venv_args)
+    abi_specific = abi_specific_dists(venv_path)
+    if abi_specific:
+        run((venv_python(venv_path), '-m', 'pip.__main__', 'uninstall', '--yes') + tuple(abi_specific))
+
+
+TRASH_PREFIX = '.venv-update-trash-'
+
+
+def trash_reap(directory):
+    """Delete everything in this directory's trash, in a detached background process.
+
+    This also reaps trash left behind by an earlier run which didn't get to finish deleting it (e.g. it crashed).
+    The shell exits straight away, leaving `rm` to the init process, so nobody waits for it.
+    """
+    from os import devnull, listdir
+    from os.path import isdir, join
+    from subprocess import call
+    if not isdir(directory):
+        return
+    trash = [join(directory, name) for name in listdir(directory) if name.startswith(TRASH_PREFIX)]
+    if trash:
+        with open(devnull, 'r+') as null:
+            # close_fds: the detached rm mustn't hold on to any of our locks
+            call(('sh', '-c', 'rm -rf "$@" &', 'sh') + tuple(trash), stdin=null, stdout=null, stderr=null, close_fds=True)
+
+
+def trash_directory(path):
+    """Remove a directory without waiting for it: it's moved (atomically) into the trash, then trash_reap deletes it.
+    The trash is alongside the directory, so that the move is always a rename.
+    """
+    from os import rename
+    from os.path import basename, dirname
+    from tempfile import mkdtemp
+    # renaming a directory over an empty one replaces it, so a unique name can be reserved this way
+    trash = mkdtemp(prefix=TRASH_PREFIX + basename(path) + '-', dir=dirname(path))
+    info(colorize(('mv', path, trash)))
+    rename(path, trash)
+    trash_reap(dirname(path))
+
+
+def rebuild_preflight(venv_path, validation, reqs, options):
+    """--offline: before validate_venv removes a virtualenv, check that its replacement can be installed, so that a miss
+    leaves the old one as it was. The check needs pip, so it's run by the old virtualenv, if it has a python at all.
+    A snapshot (see snapshot_restore) needs no check: it's restored whole.
+    """
+    from os.path import exists
+    if not options.get('offline') or not exists(venv_python(venv_path)):
+        return
+    snapshot = options.get('snapshots') and snapshot_path(options['snapshots'], validation, reqs)
+    if snapshot and exists(snapshot):
+        return
+    run(stage2_command(venv_path, reqs, dict(options, preflight=True)))
+
+
+def validate_venv(venv_path, venv_args, reqs, options):
+    """Ensure we have a valid virtualenv."""
+    import json
+    from sys import executable
+    validation = venv_validation(venv_path, venv_args)
+
+    from os.path import join, abspath
+    venv_path = abspath(venv_path)  # this removes trailing slashes as well
+    state_path = join(venv_path, '.venv-update.state')
+
+    from os.path import dirname, isdir
+    trash_reap(dirname(venv_path))
+    if isdir(venv_path):
+        previous_state = venv_state(venv_path)
+        previous_validation = previous_state.get('validation')
+
+        if previous_validation == validation:
+            info('Keeping virtualenv from previous run.')
+            return
+        elif venv_moved(previous_validation, validation):
+            info('Relocating virtualenv, which was moved from %s' % previous_validation[-1])
+            relocate_venv(venv_path, previous_validation[-1], venv_path)
+            executable = previous_state.get('executable', executable)
+        elif python_patched(previous_validation, validation):
+            executable = previous_state.get('executable', executable)
+            info('Python was patched; updating the virtualenv in place.')
+            update_venv_python(executable, venv_path, venv_args)
+        else:
+            rebuild_preflight(venv_path, validation, reqs, options)
+            info('Removing invalidated virtualenv.')
+            trash_directory(venv_path)
+
+            # run virtualenv using the same executable as last time
+            # this avoids running virtualenv against its own container
+            executable = previous_state.get('executable', executable)
+
+    if not isdir(venv_path) and not snapshot_restore(venv_path, validation, reqs, options):
+        run((executable, '-m', 'virtualenv', venv_path) + venv_args)
+
+    if isdir(venv_path):
+        with open(state_path, 'w') as state:
+            json.dump(
+                dict(executable=executable, validation=validation),
+                state,
+            )
+
+
+GC_LEGACY_DAYS = 7
+
+
+def gc_registry(pipdir):
+    """The registry of projects' roots (see gc_register). It records when it was started: what's older is legacy."""
+    from os.path import exists
+    registry = pipdir + '/roots'
+    if not exists(registry + '/.started'):
+        mkdirp(registry)
+        open(registry + '/.started', 'a').close()
+    return registry
+
+
+def gc_register(pipdir, reqs, resolved):
+    """Record what a project needs from the caches, given the wheelhouse_resolve of its requirements (and bootstrap).
+
+    A project's root is its requirements files, with the interpreter: each gets one file in the registry, rewritten
+    on each update, naming the wheels and the (name, version) of each package of its closure. A miss (e.g. a package
+    pip installs from an sdist) is named without a version.
+    """
+    import json
+    from hashlib import sha1
+    from os.path import abspath, exists
+    from sys import version
+
+    requirements = sorted(abspath(req) for req in reqs)
+    wheels = set()
+    projects = set()
+    for arg, req, dist in resolved:
+        if dist is not None:
+            wheels.add(abspath(dist.location))
+            projects.add((dist.key, dist.version))
+        elif req.req is not None:
+            projects.add((req.req.key, None))
+        if arg.endswith('.whl') and exists(arg):  # e.g. a vcs requirement's wheel
+            wheels.add(abspath(arg))
+    registry = gc_registry(pipdir)
+    key = sha1(json.dumps([requirements, version]).encode('UTF-8')).hexdigest()
+    write_json_atomic(registry + '/' + key + '.json', dict(
+        requirements=requirements,
+        python=version,
+        wheels=sorted(wheels),
+        projects=sorted(projects, key=lambda project: (project[0], project[1] or '')),
+    ))
+
+
+def gc_reachable(pipdir):
+    """Mark: everything reachable from the registered roots (see gc_register), as (wheel paths, projects).
+    A root whose requirements files are gone is dead: it's unregistered.
+    """
+    import json
+    from glob import glob
+    from os import unlink
+    from os.path import exists
+
+    wheels = set()
+    projects = set()
+    for root_path in glob(pipdir + '/roots/*.json'):
+        try:
+            with open(root_path) as root_file:
+                root = json.load(root_file)
+        except (IOError, ValueError):
+            continue
+        if not all(exists(requirements) for requirements in root['requirements']):
+            unlink(root_path)
+            continue
+        wheels.update(root['wheels'])
+        projects.update((name, version) for name, version in root['projects'])
+    return wheels, projects
+
+
+def cached_download_name_version(filename):
+    """The (normalized) project name and version of a file in pip's download cache, which is named by its quoted url.
+    This is link_name_version, without pip: see --gc.
+    """
+    from re import match, sub
+    try:
+        from urllib import unquote
+    except ImportError:  # python3
+        from urllib.parse import unquote  # pylint:disable=no-name-in-module,import-error
+
+    filename = unquote(filename).split('#')[0].rsplit('/', 1)[-1]
+    if filename.endswith('.whl'):
+        name, version = filename.split('-')[:2]
+    else:
+        for extension in ('.tar.gz', '.tar.bz2', '.tgz', '.zip', '.tar'):
+            if filename.endswith(extension):
+                filename = filename[:-len(extension)]
+                break
+        name, version = match(r'^(.+?)(?:-(\d.*))?$', filename).groups()
+    return sub('[^A-Za-z0-9.]+', '-', name).lower(), version
+
+
+def gc_remove(path, legacy):
+    """Sweep one unreachable file or directory.
+
+    What's older than the registry itself (see gc_register) may belong to a project that's yet to register: that's
+    kept for as long as it's used, as it always was, until it's gone unused for GC_LEGACY_DAYS.
+    Returns whether it was removed: what's already gone (say, to another collection) wasn't.
+    """
+    from errno import ENOENT
+    from os import stat, unlink
+    from os.path import isdir
+    from time import time
+    try:
+        stats = stat(path)
+    except OSError as error:
+        if error.errno == ENOENT:
+            return False
+        raise
+    if stats.st_mtime < legacy and stats.st_atime > time() - GC_LEGACY_DAYS * 24 * 60 * 60:
+        return False
+    try:
+        if isdir(path):
+            trash_directory(path)
+        else:
+            unlink(path)
+    except OSError as error:
+        if error.errno == ENOENT:
+            return False
+        raise
+    return True
+
+
+def gc_sweep_wheelhouse(wheelhouse, wheels, legacy):
+    """Sweep the wheelhouse of unreachable wheels, and of anything else but its partitions, locks and build failures."""
+    from os import listdir, rmdir
+    from os.path import isdir, join
+    removed = 0
+    for name in listdir(wheelhouse) if isdir(wheelhouse) else ():
+        path = join(wheelhouse, name)
+        if name in ('.locks', '.failures') or name.startswith(TRASH_PREFIX):
+            continue
+        elif name.count('-') == 2 and not name.startswith('.') and isdir(path):
+            for wheel in listdir(path):
+                if join(path, wheel) not in wheels:
+                    removed += gc_remove(join(path, wheel), legacy)
+            if not listdir(path):
+                rmdir(path)
+        else:
+            removed += gc_remove(path, legacy)
+    return removed
+
+
+def gc_sweep_download_cache(download_cache, projects, legacy):
+    """Sweep pip's download cache of the downloads of unreachable projects (see gc_register)."""
+    from os import listdir
+    from os.path import exists, isdir, join
+    removed = 0
+    for name in listdir(download_cache) if isdir(download_cache) else ():
+        if name.endswith('.content-type'):
+            continue
+        project, version = cached_download_name_version(name)
+        if (project, version) in projects or (project, None) in projects:
+            continue
+        if gc_remove(join(download_cache, name), legacy):
+            removed += 1
+            if exists(join(download_cache, name + '.content-type')):
+                gc_remove(join(download_cache, name + '.content-type'), legacy=0)
+    return removed
+
+
+def gc_sweep_build_failures(failures, projects, legacy):
+    """Forget the failed builds (see remembered_build_failures) of projects that nothing needs any more."""
+    from glob import glob
+    from re import sub
+    names = set(name for name, _ in projects)
+    removed = 0
+    for path in glob(failures + '/*.json'):
+        failure = build_failure_load(path)
+        if failure is None or sub('[^A-Za-z0-9.]+', '-', failure['name']).lower() not in names:
+            removed += gc_remove(path, legacy)
+    return removed
+
+
+def gc_sweep_vcs_wheels(vcs_wheels, wheels, legacy):
+    """Sweep the wheels built from vcs requirements (a directory per commit) which no project reaches."""
+    from os import listdir
+    from os.path import isdir, join
+    removed = 0
+    for name in listdir(vcs_wheels) if isdir(vcs_wheels) else ():
+        path = join(vcs_wheels, name)
+        if name.startswith(TRASH_PREFIX):
+            continue  # already swept: trash_reap is deleting it
+        elif isdir(path) and not any(join(path, wheel) in wheels for wheel in listdir(path)):
+            removed += gc_remove(path, legacy)
+    return removed
+
+
+def collect_garbage(pipdir):
+    """Remove whatever in the caches no registered project needs (see gc_register): mark, then sweep.
+    The vcs mirrors are kept: they're only ever fetched incrementally.
+    """
+    from os.path import getmtime
+    from time import time
+    wheels, projects = gc_reachable(pipdir)
+    try:
+        legacy = getmtime(pipdir + '/roots/.started')
+    except OSError:
+        legacy = time()
+    removed = (
+        gc_sweep_wheelhouse(pipdir + '/wheelhouse', wheels, legacy) +
+        gc_sweep_download_cache(pipdir + '/cache', projects, legacy) +
+        gc_sweep_build_failures(pipdir + '/wheelhouse/.failures', projects, legacy) +
+        gc_sweep_vcs_wheels(pipdir + '/vcs/wheels', wheels, legacy)
+    )
+    info('Garbage collection: removed %i wheels and downloads that no project needs.' % removed)
+
+
+def cache_cleanup(pipdir):
+    """Remove whatever in the caches is no longer needed: see collect_garbage.
+
+    Every venv-update holds a shared lock on the caches while it uses them, and this needs that lock exclusively,
+    so nothing is ever removed from under a concurrent venv-update: if there is one, cleanup is left for later.
+    """
+    with file_lock(pipdir + '/.venv-update.lock', blocking=False) as locked:
+        if not locked:
+            info('The cache is in use by another venv-update; skipping cleanup.')
+            return
+        collect_garbage(pipdir)
+
+
+def gc(options):
+    """venv-update --gc: collect_garbage, waiting for any other venv-updates to finish with the caches first."""
+    pipdir = cache_dir(options)
+    with file_lock(pipdir + '/.venv-update.lock', waiting='Waiting for other venv-updates to finish with the cache...'):
+        collect_garbage(pipdir)
+    return 0
+
+
+def cache_dir(options):
+    """Where we keep our download cache and wheelhouse: see --cache-dir.
+
+    By default, that's the directory that pip already uses. This has better security characteristics than a
+    machine-wide cache, and is a pattern people can use for open-source projects.
+    """
+    from os import environ
+    from os.path import abspath
+    return abspath(options['cache_dir']) if options.get('cache_dir') else environ['HOME'] + '/.pip'
+
+
+# the frames of the build forkserver's replies: a length, then that much output; a negative length is the exit status
+FORKSERVER_FRAME = '!i'
+
+
+def forkserver_fingerprint():
+    """What a fresh python's sys.path and pkg_resources.working_set come from: the directories on sys.path, and the
+    .pth files in them. While this is unchanged, a fork of the forkserver is as good as a fresh python.
+    """
+    from glob import glob
+    from os.path import getmtime, isdir
+    from sys import path
+    return [
+        (entry, getmtime(entry), sorted((pth, getmtime(pth)) for pth in glob(entry + '/*.pth')))
+        for entry in path if entry and isdir(entry)
+    ]
+
+
+def forkserver_exit_code(code):
+    """The exit status of a python that raised SystemExit(code)."""
+    from sys import stderr
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+    else:
+        stderr.write('%s\n' % (code,))
+        return 1
+
+
+def native_str(value):
+    """json gives us unicode; python2's argv and environment are bytes."""
+    return value.encode('UTF-8') if bytes is str else value
+
+
+def forkserver_child(request, output):
+    """In a new fork of the forkserver, become `python -c script args...`, as requested: with its own argv, cwd,
+    environment and output, and nothing left over from the server or any other build. Never returns.
+    """
+    import atexit
+    import sys
+    from os import chdir, close, devnull, dup2, environ, getcwd, open as os_open, O_RDONLY, _exit
+    from traceback import print_exc
+    from types import ModuleType
+
+    code = 1
+    try:
+        dup2(os_open(devnull, O_RDONLY), 0)
+        dup2(output, 1)
+        dup2(output, 2)
+        close(output)
+        chdir(request['cwd'])
+        environ.clear()
+        environ.update((native_str(name), native_str(value)) for name, value in request['environ'].items())
+        sys.argv = [native_str(arg) for arg in request['argv'][:1] + request['argv'][2:]]
+        sys.modules['__main__'] = main = ModuleType(str('__main__'))
+        if 'random' in sys.modules:
+            sys.modules['random'].seed()
+        # a fresh python would have found the distributions in its cwd (e.g. the project's own .egg-info)
+        import pkg_resources
+        for dist in pkg_resources.find_distributions(getcwd(), True):
+            pkg_resources.working_set.add(dist, '')
+
+        try:
+            # dont_inherit: the script mustn't get our __future__ imports
+            exec(compile(request['argv'][1], '<string>', 'exec', 0, True), vars(main))
+            code = 0
+        except SystemExit as error:
+            code = forkserver_exit_code(error.code)
+        atexit._run_exitfuncs()  # pylint:disable=protected-access
+    except BaseException:
+        print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _exit(code)
+
+
+def forkserver_run(server, conn, request):
+    """Run one request in a fork (see forkserver_child), relaying its output and then its exit status in frames."""
+    from os import close, fork, kill, pipe, read, waitpid, WEXITSTATUS, WIFSIGNALED, WTERMSIG
+    from signal import SIGKILL
+    from socket import error as socket_error
+    from struct import pack
+
+    output, child_output = pipe()
+    pid = fork()
+    if pid == 0:
+        server.close()
+        conn.close()
+        close(output)
+        forkserver_child(request, child_output)  # never returns
+    close(child_output)
+    try:
+        for chunk in iter(lambda: read(output, UNZIP_CHUNK), b''):
+            conn.sendall(pack(FORKSERVER_FRAME, len(chunk)) + chunk)
+    except socket_error:  # the client is gone: so is its build
+        kill(pid, SIGKILL)
+    finally:
+        close(output)
+    _, status = waitpid(pid, 0)
+    returncode = 128 + WTERMSIG(status) if WIFSIGNALED(status) else WEXITSTATUS(status)
+    try:
+        conn.sendall(pack(FORKSERVER_FRAME, -1 - returncode))
+    except socket_error:
+        pass
+
+
+def forkserver_serve(path):
+    """The build forkserver (see build_forkserver): import setuptools and pkg_resources once, then listen at `path`,
+    forking a child for each setup.py script we're sent. When what we imported goes stale, we stop; until then, a
+    request gets no reply, and the client runs its script itself.
+    """
+    import json
+    import socket
+    from os import chdir, rename, unlink
+    from os.path import dirname
+    from sys import path as sys_path
+
+    # like `python -c`: the script's cwd comes first on sys.path. Ours is empty, so there's nothing to find there.
+    sys_path.insert(0, '')
+    chdir(dirname(path))
+    import setuptools  # noqa pylint:disable=unused-variable
+    import pkg_resources  # noqa pylint:disable=unused-variable
+    fingerprint = forkserver_fingerprint()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path + '.tmp')
+    server.listen(16)
+    rename(path + '.tmp', path)  # only now that we're listening: until then, clients run their scripts themselves
+    while True:
+        conn = server.accept()[0]
+        request = conn.makefile('rb').readline()
+        if forkserver_fingerprint() != fingerprint:
+            conn.close()
+            unlink(path)
+            return 0
+        forkserver_run(server, conn, json.loads(request.decode('UTF-8')))
+        conn.close()
+
+
+def forkserver_client(path, argv):
+    """Stand in for `python -c script args...` (see build_forkserver): have the forkserver at `path` run it, and
+    relay its output and exit status. If the forkserver can't, run it ourselves after all.
+    """
+    import json
+    import socket
+    from os import environ, execv, getcwd, write, _exit
+    from struct import calcsize, unpack
+    from sys import executable
+
+    request = json.dumps(dict(argv=argv, cwd=getcwd(), environ=dict(environ)))
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(path)
+        conn.sendall(request.encode('UTF-8') + b'\n')
+    except socket.error:
+        execv(executable, [executable] + argv)  # never returns
+
+    replies = conn.makefile('rb')
+    relayed = False
+    while True:
+        frame = replies.read(calcsize(FORKSERVER_FRAME))
+        if len(frame) < calcsize(FORKSERVER_FRAME):
+            if relayed:
+                write(2, b'venv-update: the build forkserver died\n')
+                _exit(1)
+            execv(executable, [executable] + argv)  # never returns
+        length, = unpack(FORKSERVER_FRAME, frame)
+        if length < 0:
+            _exit(-1 - length)
+        write(1, replies.read(length))
+        relayed = True
+
+
+def forkserver_command(argv):
+    """The internal commands of build_forkserver, if argv is one of them."""
+    if argv[:1] == ['--forkserver']:
+        return forkserver_serve(argv[1])
+    elif argv[:1] == ['--forkserver-client']:
+        return forkserver_client(argv[1], argv[2:])
+
+
+@contextmanager
+def build_forkserver(enabled):
+    """--build-forkserver: each `python -c <setup.py script>` that pip runs (egg_info, bdist_wheel, develop, install)
+    imports setuptools, and pkg_resources scans the whole virtualenv, from scratch: that's up to a second, per package.
+
+    Instead, a server imports those once, and runs each script in a fork of itself, isolated as a fresh python would
+    be (see forkserver_child). pip runs a small client in its place, which relays the output and exit status.
+    When anything is installed that a fresh python would see (see forkserver_fingerprint), the server is replaced.
+    """
+    if not enabled:
+        yield
+        return
+
+    from os.path import join
+    from shutil import rmtree
+    from subprocess import Popen
+    from sys import executable
+    from tempfile import mkdtemp
+    import pip.req
+    import pip.wheel
+
+    orig_call_subprocess = vars(pip.req)['call_subprocess']
+    tmp = mkdtemp(prefix='venv-update-forkserver-')
+    path = join(tmp, 'socket')
+
+    class _nonlocal(object):
+        server = None
+
+    def call_subprocess(cmd, *args, **kwargs):
+        cmd = list(cmd)
+        if cmd[:2] == [executable, '-c'] and 'setuptools' in cmd[2]:
+            if _nonlocal.server is None or _nonlocal.server.poll() is not None:
+                _nonlocal.server = Popen((executable, dotpy(__file__), '--forkserver', path), close_fds=True)
+            cmd = [executable, dotpy(__file__), '--forkserver-client', path] + cmd[1:]
+        return orig_call_subprocess(cmd, *args, **kwargs)
+
+    pip.req.call_subprocess = pip.wheel.call_subprocess = call_subprocess
+    try:
+        yield
+    finally:
+        pip.req.call_subprocess = pip.wheel.call_subprocess = orig_call_subprocess
+        if _nonlocal.server is not None and _nonlocal.server.poll() is None:
+            _nonlocal.server.terminate()
+            _nonlocal.server.wait()
+        rmtree(tmp)
+
+
+def do_install(venv_path, reqs, options):
+    pipdir = cache_dir(options)
+
+    with file_lock(pipdir + '/.venv-update.lock', shared=True):
+        if options.get('import_bundle'):
+            bundle_import(options['import_bundle'], pipdir + '/wheelhouse', pipdir)
+        with build_forkserver(options.get('build_forkserver')):
+            do_update(venv_path, reqs, options, pipdir)
+
+    if not options.get('wheels_only'):
+        cache_cleanup(pipdir)
+
+
+def do_update(venv_path, reqs, options, pipdir):
+    from os import environ
+
+    previously_installed = pip_get_installed()
+    # the requirements files are only read here: every pip invocation below is given the parsed requirements
+    requirements_tree = cached_requirements_tree(reqs, pipdir + '/requirements')
+    parsed = [install_requirement(*requirement) for requirement in requirements_tree['requirements']]
+
+    # We could combine these caches to one directory, but pip would search everything twice, going slower.
+    pip_download_cache = pipdir + '/cache'
+    pip_wheels = pipdir + '/wheelhouse'
+    wheelhouse_migrate(pip_wheels)
+    gc_registry(pipdir)
+
+    environ.update(
+        PIP_DOWNLOAD_CACHE=pip_download_cache,
+    )
+
+    cache_opts = (
+        '--download-cache=' + pip_download_cache,
+        '--find-links=file://' + pip_wheels,
+    )
+
+    from pip.req import InstallRequirement
+    if options.get('offline'):
+        # offline, a git+ or hg+ requirement can only be the wheel already built for its commit: see below
+        required, vcs_substitutions = vcs_requirements_as_wheels(parsed, pipdir, cache_opts, offline=True)
+        offline_preflight(
+            [InstallRequirement.from_line(req) for req in BOOTSTRAP_VERSIONS] + required,
+            pip_wheels,
+        )
+        cache_opts += ('--no-index',)
+
+    # --use-wheel is somewhat redundant here, but it means we get an error if we have a bad version of pip/setuptools.
+    install_opts = ('--upgrade', '--use-wheel',) + cache_opts
+    recently_installed = []
+
+    # 1) Bootstrap the install system; setuptools and pip are already installed, just need wheel
+    recently_installed += pip_install(install_opts + BOOTSTRAP_VERSIONS, pipdir)
+
+    if not options.get('offline'):
+        # git+ and hg+ requirements are built once per commit, and installed from that wheel thereafter.
+        #   They're built by pip wheel, so this comes after the bootstrap.
+        required, vcs_substitutions = vcs_requirements_as_wheels(parsed, pipdir, cache_opts, offline=False)
+
+    # `-e path` requirements whose setup.py, metadata and egg-link are unchanged don't need another `setup.py develop`
+    substitutions = unchanged_editables(required, venv_path, reqnames(required))
+    substitutions.update(vcs_substitutions)
+    plan = requirements_plan(requirements_tree, parsed, substitutions)
+    requirements = tuple(requirements_tree['options']) + tuple(arg for arg, _, _ in plan)
+
+    # 2) Caching: Make sure everything we want is downloaded, cached, and has a wheel.
+    #   We only ask pip to build what's missing from the wheelhouse, if anything.
+    #   Offline, there's nothing to download, and the preflight showed that the wheels are already here.
+    #   pip wheel has no --editable: an editable is left to pip install, and only its dependencies are built.
+    bootstrap_plan = [(req, InstallRequirement.from_line(req), True) for req in BOOTSTRAP_VERSIONS]
+    wheel_plan = bootstrap_plan + [(arg, req, explicit) for arg, req, explicit in plan if not req.editable]
+    wheel_plan += editable_requirements(plan)
+    # only wheels for the union of several virtualenvs' (or --prefetch's) requirements: see wheelhouse_resolve
+    union = bool(options.get('wheels_only'))
+    if not options.get('offline'):
+        wheelhouse_fill(
+            wheel_plan, pip_wheels, cache_opts + tuple(requirements_tree['options']), pipdir,
+            wheelhouse_tiers(options), union,
+        )
+    # what pip install will use, pinned or not, is what must survive garbage collection
+    gc_register(pipdir, reqs, wheelhouse_resolve(wheel_plan, pip_wheels, pinned=False, union=union))
+    if options.get('export_bundle'):
+        bundle_export(wheelhouse_resolve(wheel_plan, pip_wheels, union=union), options['export_bundle'], pipdir)
+
+    if options.get('wheels_only'):
+        return
+
+    # 3) Install: Use our well-populated cache, to do the installations.
+    #   The wheels which are already in the wheelhouse are installed concurrently, then pip install does the rest.
+    install_wheels(wheelhouse_resolve(plan, pip_wheels), pipdir)
+    if '--no-index' not in install_opts:
+        install_opts += ('--no-index',)  # only use the cache
+    recently_installed += pip_install(install_opts + requirements, pipdir)
+
+    required_with_deps = trace_requirements(record_editables(required, venv_path))
+
+    # TODO-TEST require A==1 then A==2
+    extraneous = (
+        reqnames(previously_installed) -
+        reqnames(required_with_deps) -
+        reqnames(recently_installed) -
+        set(['pip', 'setuptools', 'wheel'])  # the stage1 bootstrap packages
+    )
+
+    # 2) Uninstall any extraneous packages.
+    if extraneous:
+        pip(('uninstall', '--yes') + tuple(sorted(extraneous)), pipdir)
+
+
+def wait_for_all_subprocesses():
+    from os import wait
+    try:
+        while True:
+            wait()
+    except OSError as error:
+        if error.errno == 10:  # no child processes
+            return
+        else:
+            raise
+
+
+def backintime(reference, filename):
     info(colorize(('touch', filename, '--reference', reference, '--date', '1 day ago')))
     from os.path import getmtime
     mtime = getmtime(reference)
@@ -529,7 +3368,24 @@ def exec_(argv):
     execv(argv[0], argv)  # never returns
 
 
-def stage1(venv_path, reqs):
+def ensure_pip_command(python, options):
+    pip_install_args = ('install',)
+    if options.get('offline'):
+        pip_install_args += ('--no-index',)
+    return (python, '-m', 'pip.__main__') + pip_install_args + ('pip>=1.5.0,<6.0.0',)
+
+
+def ensure_pip(python, options):
+    """ensure that a compatible version of pip is installed"""
+    run(('pip', '--version'))
+    run(ensure_pip_command(python, options))
+
+
+def stage2_command(venv_path, reqs, options):
+    return (venv_python(venv_path), dotpy(__file__), '--stage2') + unparseopts(options) + (venv_path,) + reqs
+
+
+def stage1(venv_path, reqs, options):
     """we have an arbitrary python interpreter active, (possibly) outside the virtualenv we want.
 
     make a fresh venv at the right spot, and use it to perform stage 2
@@ -539,42 +3395,664 @@ def stage1(venv_path, reqs):
     if not exists(python):
         return 'virtualenv executable not found: %s' % python
 
-    # ensure that a compatible version of pip is installed
-    run(('pip', '--version'))
-    run((python, '-m', 'pip.__main__', 'install', 'pip>=1.5.0,<6.0.0'))
+    ensure_pip(python, options)
+    exec_(stage2_command(venv_path, reqs, options))  # never returns
+
+
+def download_cache_index(download_cache):
+    """Which (name, version) have an sdist in pip's download cache? Its files are named by their quoted urls."""
+    from os import listdir
+    from pip.index import Link
+    try:
+        from urllib import unquote
+    except ImportError:  # python3
+        from urllib.parse import unquote  # pylint:disable=no-name-in-module,import-error
+
+    try:
+        filenames = listdir(download_cache)
+    except OSError:
+        return set()
+    return set(
+        link_name_version(Link(unquote(filename)))
+        for filename in filenames
+        if not filename.endswith('.content-type')
+    )
+
+
+def dry_run_finder(tree, pipdir, offline):
+    """A pip PackageFinder, configured as our pip invocations would be."""
+    from os import environ
+    from pip.download import PipSession
+    from pip.index import PackageFinder
+
+    find_links = wheelhouse_find_links(['file://' + pipdir + '/wheelhouse'])
+    index_urls = [] if offline else [environ.get('PIP_INDEX_URL', 'https://pypi.python.org/simple/')]
+    for option in tree['options']:
+        name, _, value = option.partition('=')
+        if name == '--find-links':
+            find_links.append(value)
+        elif name == '--index-url':
+            index_urls[:1] = [value]
+        elif name == '--extra-index-url':
+            index_urls.append(value)
+        elif name == '--no-index':
+            index_urls = []
+    return PackageFinder(find_links, index_urls, session=PipSession())
+
+
+def dry_run_find(finder, req):
+    """Which version would pip choose for this requirement, and from where? Returns (version, source).
+
+    The finder is given the same short-circuit as in a real run (see faster_find_requirement), so for a pinned
+    requirement, this is as quick as a no-op update.
+    """
+    from pip.exceptions import DistributionNotFound
+    from pip.index import BestVersionAlreadyInstalled
+
+    try:
+        with faster_pip_packagefinder():
+            link = finder.find_requirement(req, False)
+    except (DistributionNotFound, BestVersionAlreadyInstalled):
+        return None, 'not found'
+    if link is None:
+        return None, 'not found'
+    _, version = link_name_version(link)
+    return version, 'wheelhouse' if link.filename.endswith('.whl') and url_is_local(link.url) else 'index'
+
+
+def dry_run_action(installed, version):
+    from pip._vendor.pkg_resources import parse_version
+    if installed is None:
+        return 'install'
+    elif version is None or installed == version:
+        return None
+    elif parse_version(version) > parse_version(installed):
+        return 'upgrade'
+    else:
+        return 'downgrade'
+
+
+def dry_run_miss(req, finder, download_cache):
+    """Plan a requirement that's missing from the wheelhouse: which version, and from where? Returns (version, source)."""
+    if req.req is None:
+        return None, 'build'  # e.g. `-e path`
+    version, source = dry_run_find(finder, req)
+    if source == 'wheelhouse':
+        return version, source
+    elif (req.req.key, version) in download_cache:
+        return version, 'download cache, build'
+    else:
+        return version, 'network, build'
+
+
+def dry_run_plan(venv_path, reqs, options):
+    """--dry-run, in stage2: show the planned installs, upgrades, downgrades and removals, whether each wheel would come
+    from the wheelhouse, the download cache or the network, and how long it should all take.
+    Nothing is changed: not even our own caches.
+    """
+    pipdir = cache_dir(options)
+
+    tree = parse_requirements_tree(reqs)
+    parsed = [install_requirement(*requirement) for requirement in tree['requirements']]
+    _, vcs_substitutions = vcs_requirements_as_wheels(parsed, pipdir, (), offline=True)
+    substitutions = unchanged_editables(parsed, venv_path, reqnames(parsed))
+    substitutions.update(vcs_substitutions)
+    plan = requirements_plan(tree, parsed, substitutions)
+
+    from os.path import realpath
+    dists = local_dists()
+    installed = dict((dist.key, dist.version) for dist in dists)
+    # `-e path` projects stay: they're either unchanged, or re-installed from their path
+    editables = editable_installs()
+    required = set(dist.key for dist in dists if realpath(dist.location) in editables)
+    required.update(('pip', 'setuptools', 'wheel'))
+
+    finder = dry_run_finder(tree, pipdir, options.get('offline'))
+    download_cache = download_cache_index(pipdir + '/cache')
+    costs = costs_load(pipdir)
+
+    info('Plan for %s:' % timid_relpath(venv_path))
+    total = 0
+    misses = False
+    for arg, req, dist in wheelhouse_resolve(plan, pipdir + '/wheelhouse'):
+        if dist is not None:
+            name, version, source = dist.key, dist.version, 'wheelhouse'
+        else:
+            misses = True
+            name = req.req and req.req.key
+            version, source = dry_run_miss(req, finder, download_cache)
+        required.add(name)
+
+        action = dry_run_action(installed.get(name), version)
+        if action is None:
+            continue
+        kinds = {
+            'wheelhouse': ('install',),
+            'download cache, build': ('build', 'install'),
+        }.get(source, ('download', 'build', 'install'))
+        cost = costs_predict(costs, name, kinds)
+        total += cost or 0
+        info('  %-9s %s %s (%s) %s' % (
+            action,
+            name or arg,
+            '%s -> %s' % (installed[name], version) if action in ('upgrade', 'downgrade') else version or '',
+            source,
+            '~' + format_seconds(cost) if cost is not None else 'no history',
+        ))
+
+    for name in sorted(set(installed) - required):
+        info('  %-9s %s %s%s' % ('remove', name, installed[name], ' (unless it is a dependency of a build)' if misses else ''))
+    info('Predicted time: %s' % format_seconds(total))
+
+
+def dry_run(targets, venv_args, options):
+    """venv-update --dry-run: show what an update would do, and how long it would take, without changing anything."""
+    from os.path import abspath, exists, islink, realpath
+
+    for venv_path, reqs in targets:
+        venv_path = abspath(venv_path)
+        if islink(venv_path):
+            venv_path = realpath(venv_path)  # see --pool
+        if venv_state(venv_path).get('validation') == venv_validation(venv_path, venv_args) and \
+                exists(venv_python(venv_path)):
+            run(stage2_command(venv_path, reqs, options))
+            continue
 
-    exec_((python, dotpy(__file__), '--stage2', venv_path) + reqs)  # never returns
+        # without a virtualenv, there's no pip to ask: this is our best guess
+        info('%s would be built from scratch.' % timid_relpath(venv_path))
+        pipdir = cache_dir(options)
+        total = requirements_cost(costs_load(pipdir), reqs, pipdir + '/wheelhouse')
+        info('Predicted time: %s' % format_seconds(total))
+    return 0
 
 
-def stage2(venv_path, reqs):
+def preflight(reqs, options):
+    """--preflight, in stage2 of the virtualenv that rebuild_preflight is about to replace: nothing installed here will
+    be there, so the wheelhouse alone must have everything.
+    """
+    from pip.req import InstallRequirement
+    pipdir = cache_dir(options)
+
+    with file_lock(pipdir + '/.venv-update.lock', shared=True):
+        if options.get('import_bundle'):
+            bundle_import(options['import_bundle'], pipdir + '/wheelhouse', pipdir)
+        tree = cached_requirements_tree(reqs, pipdir + '/requirements')
+        parsed = [install_requirement(*requirement) for requirement in tree['requirements']]
+        required, _ = vcs_requirements_as_wheels(parsed, pipdir, (), offline=True)
+        offline_preflight(
+            [InstallRequirement.from_line(req) for req in BOOTSTRAP_VERSIONS] + required,
+            pipdir + '/wheelhouse',
+            installed=False,
+        )
+    return 0
+
+
+def stage2(venv_path, reqs, options):
     """we're activated into the venv we want, and there should be nothing but pip and setuptools installed.
     """
     python = venv_python(venv_path)
     import sys
     assert sys.executable == python, 'Executable not in venv: %s != %s' % (sys.executable, python)
-    return do_install(reqs)
+    if options.get('dry_run'):
+        return dry_run_plan(venv_path, reqs, options)
+    elif options.get('preflight'):
+        return preflight(reqs, options)
+    result = do_install(venv_path, reqs, options)
+    if not options.get('wheels_only'):
+        write_json_atomic(venv_applied_path(venv_path), dict(
+            inputs=venv_inputs(venv_path, reqs, options),
+            installed=venv_installed(venv_path),
+        ))
+        if options.get('snapshots'):
+            snapshot_save(venv_path, reqs, options)
+    return result
+
+
+def venv_home(venv_path, options):
+    """Where we keep things for a virtualenv outside of it, since it may be removed and re-created."""
+    from hashlib import sha1
+    return '%s/venvs/%s' % (cache_dir(options), sha1(venv_path.encode('UTF-8')).hexdigest())
+
+
+def venv_lock_path(venv_path, options):
+    """The lock which serializes updates of a virtualenv."""
+    return venv_home(venv_path, options) + '.lock'
+
+
+def venv_applied_path(venv_path):
+    from os.path import join
+    return join(venv_path, '.venv-update.applied')
+
+
+def venv_inputs(venv_path, reqs, options):
+    """Everything, besides the venv_validation, that what an update of this virtualenv installs depends on: its
+    requirements files, and any INSTALL_OPTIONS. Returns None if the requirements can't be read.
+    """
+    import json
+    try:
+        files = parse_requirements_tree(reqs)['files']
+    except (IOError, OSError):
+        return None
+    options = sorted((name, value) for name, value in options.items() if name in INSTALL_OPTIONS)
+    # normalize types, via json round-trip
+    return json.loads(json.dumps((venv_path, files, options)))
+
+
+def venv_installed(venv_path):
+    """A quick fingerprint of what's installed in a virtualenv: the names of its packages' metadata (which include
+    their versions) and of its egg-links.
+    """
+    from os.path import basename
+    return sorted(basename(metadata) for metadata in venv_metadata(venv_path, ('*.dist-info', '*.egg-info', '*.egg-link')))
+
+
+def venv_applied(venv_path):
+    """What the last successful stage2 recorded, or None."""
+    import json
+    try:
+        with open(venv_applied_path(venv_path)) as applied:
+            applied = json.load(applied)
+    except (IOError, ValueError):
+        return None
+    return applied if isinstance(applied, dict) else None
+
+
+def venv_just_updated(venv_path, reqs, venv_args, options):
+    """Was this virtualenv last updated, successfully, from these very same inputs?"""
+    applied = venv_applied(venv_path)
+    return (
+        applied is not None and
+        applied['inputs'] is not None and
+        venv_state(venv_path).get('validation') == venv_validation(venv_path, venv_args) and
+        applied['inputs'] == venv_inputs(venv_path, reqs, options)
+    )
+
+
+def editables_changed(venv_path):
+    """Has any of the virtualenv's `-e path` requirements changed since it was installed? See editable_fingerprint."""
+    import json
+    try:
+        with open(editables_state_path(venv_path)) as state:
+            fingerprints = json.load(state)
+    except (IOError, ValueError):
+        return False
+
+    installs = editable_installs(venv_metadata(venv_path, ('*.egg-link',)))
+    for src_dir, fingerprint in fingerprints.items():
+        if editable_fingerprint(src_dir, installs) != fingerprint:
+            return True
+    return False
+
+
+def venv_check(venv_path, reqs, venv_args, options):
+    """Is this virtualenv exactly in sync with its requirements? Returns the reason it isn't, or None.
+
+    This only consults our recorded state and the virtualenv's metadata: there's no pip import and no subprocess,
+    so it's cheap enough to run before every make or test run.
+    """
+    from os.path import isdir, islink, realpath
+    if islink(venv_path):
+        venv_path = realpath(venv_path)  # see --pool
+
+    applied = venv_applied(venv_path)
+    if not isdir(venv_path):
+        return 'it does not exist'
+    elif venv_state(venv_path).get('validation') != venv_validation(venv_path, venv_args):
+        return 'it needs to be rebuilt'
+    elif applied is None:
+        return 'its last update did not complete'
+    elif applied['inputs'] is None or applied['inputs'] != venv_inputs(venv_path, reqs, options):
+        return 'its requirements have changed'
+    elif applied['installed'] != venv_installed(venv_path):
+        return 'its installed packages have changed'
+    elif editables_changed(venv_path):
+        return 'an editable requirement has changed'
+    else:
+        return None
+
+
+def check(targets, venv_args, options):
+    """venv-update --check: exit with OUT_OF_SYNC unless every virtualenv is in sync."""
+    from os.path import abspath
+    exit_code = 0
+    for venv_path, reqs in targets:
+        reason = venv_check(abspath(venv_path), reqs, venv_args, options)
+        # no info(): we don't run any subprocess here
+        if reason is None:
+            print('%s is in sync.' % timid_relpath(venv_path))
+        else:
+            print('%s is out of sync: %s.' % (timid_relpath(venv_path), reason))
+            exit_code = OUT_OF_SYNC
+    return exit_code
+
+
+def forget_venv_inputs(venv_path):
+    """Until stage2 succeeds, the virtualenv's inputs are not applied."""
+    from os import unlink
+    try:
+        unlink(venv_applied_path(venv_path))
+    except OSError:
+        pass
+
+
+def pool_requirements(reqs):
+    """The requirement lines of a requirements tree, by which we find the nearest pooled virtualenv."""
+    return sorted(set(line for _, line, _ in parse_requirements_tree(reqs)['requirements']))
+
+
+def pool_entries(pool):
+    """The (key, metadata) of each virtualenv in the pool, most recently used first."""
+    import json
+    from glob import glob
+    from os.path import basename, getmtime, isdir
+
+    entries = []
+    for metadata_path in sorted(glob(pool + '/*.json'), key=getmtime, reverse=True):
+        key = basename(metadata_path)[:-len('.json')]
+        if not isdir(pool + '/' + key):
+            continue
+        try:
+            with open(metadata_path) as metadata:
+                entries.append((key, json.load(metadata)))
+        except (IOError, ValueError):
+            continue
+    return entries
 
 
-def venv_update(stage, venv_path, reqs, venv_args):
+def pool_nearest(pool, validation, requirements):
+    """Find the pooled virtualenv whose requirements have the most in common with these, if any is compatible."""
+    requirements = set(requirements)
+    best, best_overlap = None, -1
+    for key, metadata in pool_entries(pool):
+        if metadata['validation'] != validation[:-1]:
+            continue
+        pooled = set(metadata['requirements'])
+        overlap = len(requirements & pooled) / float(len(requirements | pooled) or 1)
+        if overlap > best_overlap:  # ties go to the most recently used
+            best, best_overlap = key, overlap
+    return best
+
+
+def pool_evict(pool, size, keep):
+    """Remove the least recently used virtualenvs, so that at most `size` remain in the pool."""
+    from os import unlink
+    entries = [key for key, _ in pool_entries(pool) if key != keep]
+    for key in entries[max(size - 1, 0):]:
+        info('Removing least-recently used virtualenv from the pool: %s' % key)
+        trash_directory(pool + '/' + key)
+        unlink(pool + '/' + key + '.json')
+
+
+def symlink_atomic(target, link):
+    """Point a symlink at target, such that it never fails to exist along the way."""
+    from os import getpid, rename, symlink
+    tmp = '%s.tmp-%i' % (link, getpid())
+    symlink(target, tmp)
+    rename(tmp, link)
+
+
+def pool_clone(source, target):
+    """Copy a pooled virtualenv. validate_venv will see that it has moved, and relocate it."""
+    from os import rename
+    from os.path import dirname, join
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    tmp = mkdtemp(prefix='.clone-', dir=dirname(target))
+    try:
+        run(('cp', '-a', source, join(tmp, 'venv')))
+        rename(join(tmp, 'venv'), target)
+    finally:
+        rmtree(tmp)
+
+
+def pool_checkout(venv_path, venv_args, reqs, options):
+    """Make venv_path a symlink to the pooled virtualenv for these requirements, and return that virtualenv's path.
+
+    If there's no such virtualenv yet, the nearest one is cloned, so that only the difference needs installing.
+    """
+    from os.path import exists, isdir, islink, join
+
+    validation = venv_validation(venv_path, venv_args)
+    key = venv_key(validation, reqs)
+    if key is None:
+        return venv_path  # the missing requirements will be reported as usual
+
+    pool = venv_home(venv_path, options)
+    target = join(pool, key)
+    mkdirp(pool)
+    trash_reap(pool)
+    if isdir(venv_path) and not islink(venv_path):
+        if not exists(target):
+            info('Moving virtualenv into the pool.')
+            pool_clone(venv_path, target)
+        trash_directory(venv_path)
+
+    requirements = pool_requirements(reqs)
+    if exists(target):
+        info('Using pooled virtualenv: %s' % key)
+    else:
+        nearest = pool_nearest(pool, validation, requirements)
+        if nearest is not None:
+            info('Cloning the nearest pooled virtualenv: %s' % nearest)
+            pool_clone(join(pool, nearest), target)
+
+    # (re)writing the metadata marks the virtualenv as most recently used
+    write_json_atomic(target + '.json', dict(validation=validation[:-1], requirements=requirements))
+    symlink_atomic(target, venv_path)
+    pool_evict(pool, int(options['pool']) if options['pool'] is not True else POOL_SIZE, keep=key)
+    return target
+
+
+def venv_update_stage1(venv_path, reqs, venv_args, options):
+    if options.get('pool'):
+        venv_path = pool_checkout(venv_path, venv_args, reqs, options)
+    forget_venv_inputs(venv_path)
+    validate_venv(venv_path, venv_args, reqs, options)
+    return stage1(venv_path, reqs, options)
+
+
+def venv_update(stage, venv_path, reqs, venv_args, options):
     from os.path import abspath
     venv_path = abspath(venv_path)
     if stage == 1:
-        validate_venv(venv_path, venv_args)
-        return stage1(venv_path, reqs)
+        # Concurrent updates of one virtualenv are serialized. The lock is held through stage2: it's inheritable.
+        lock = venv_lock_path(venv_path, options)
+        with file_lock(lock, blocking=False, inheritable=True) as uncontended:
+            if uncontended:
+                return venv_update_stage1(venv_path, reqs, venv_args, options)
+
+        with file_lock(
+                lock, waiting='Waiting for another venv-update of %s...' % timid_relpath(venv_path), inheritable=True,
+        ):
+            # whoever we waited for may have just done exactly what we were going to do
+            if venv_just_updated(venv_path, reqs, venv_args, options):
+                info('The virtualenv was just updated by another venv-update, from the same inputs.')
+                return 0
+            return venv_update_stage1(venv_path, reqs, venv_args, options)
     elif stage == 2:
-        return stage2(venv_path, reqs)
+        return stage2(venv_path, reqs, options)
     else:
         raise AssertionError('impossible stage value: %r' % stage)
 
 
+def venv_interpreter(venv_path):
+    """Identify the interpreter of a virtualenv. Virtualenvs whose interpreters match can share their wheels."""
+    return cmd_output((
+        venv_python(venv_path), '-c',
+        'import sys; print(sys.version); print(sys.platform); print(sys.maxunicode)',
+    ))
+
+
+def run_captured(cmd):
+    """Run a command to completion, returning its exit code and (combined) output."""
+    from subprocess import Popen, PIPE, STDOUT
+    process = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+    output, _ = process.communicate()
+    return process.returncode, output
+
+
+def venv_update_many(targets, venv_args, options):
+    """Update several virtualenvs in one go.
+
+    The virtualenvs are grouped by interpreter. For each group, the union of their requirements is built into the
+    wheelhouse once, by the first virtualenv. Then every virtualenv is updated concurrently, at most --jobs at a time,
+    each finding everything it needs already in the wheelhouse.
+    """
+    from os.path import abspath
+    targets = [(abspath(venv_path), reqs) for venv_path, reqs in targets]
+    locks = sorted(set(venv_lock_path(venv_path, options) for venv_path, _ in targets))
+    with file_locks(locks, waiting='Waiting for another venv-update of these virtualenvs...'):
+        return venv_update_many_locked(targets, venv_args, options)
+
+
+def venv_update_many_locked(targets, venv_args, options):
+    from multiprocessing import cpu_count
+    from multiprocessing.dummy import Pool  # threads are plenty: the work is done by subprocesses
+    from os.path import exists
+    from sys import stdout
+
+    groups = {}
+    for venv_path, reqs in targets:
+        forget_venv_inputs(venv_path)
+        validate_venv(venv_path, venv_args, reqs, options)
+        python = venv_python(venv_path)
+        if not exists(python):
+            return 'virtualenv executable not found: %s' % python
+        ensure_pip(python, options)
+        groups.setdefault(venv_interpreter(venv_path), []).append((venv_path, reqs))
+
+    for group in sorted(groups.values()):
+        union = []
+        for _, reqs in group:
+            union.extend(req for req in reqs if req not in union)
+        run(stage2_command(group[0][0], tuple(union), dict(options, wheels_only=True)))
+
+    # longest first: the long poles start straight away, and the short updates fill in around them
+    # (this orders only the installs: the union's wheels were all built above, in one pass)
+    costs = costs_load(cache_dir(options))
+    targets = sorted(targets, key=lambda target: -requirements_cost(costs, target[1]))
+    pool = Pool(int(options.get('jobs') or cpu_count()))
+    results = pool.imap(run_captured, [stage2_command(venv_path, reqs, options) for venv_path, reqs in targets])
+
+    exit_code = 0
+    for (venv_path, reqs), (returncode, output) in zip(targets, results):
+        info('')
+        info('venv-update %s: %s' % (timid_relpath(venv_path), 'done' if returncode == 0 else 'FAILED'))
+        stdout.write(output.decode('UTF-8'))
+        stdout.flush()
+        if returncode != 0:
+            mark_venv_invalid(venv_path, reqs)
+            exit_code = returncode
+    pool.close()
+    return exit_code
+
+
+def prefetch_interpreter(python, reqs, options):
+    """Fill the wheelhouse for these requirements, for one interpreter, using a scratch virtualenv.
+    Returns the exit code and (combined) output, as run_captured.
+    """
+    from sys import executable
+    from tempfile import mkdtemp
+
+    scratch = cache_dir(options) + '/prefetch'
+    mkdirp(scratch)
+    scratch = mkdtemp(prefix='venv-', dir=scratch)
+    stage2_options = dict(options, wheels_only=True)
+    del stage2_options['prefetch']
+    if options.get('export_bundle'):
+        stage2_options['export_bundle'] = prefetch_bundle_part(options, python)
+    output = b''
+    try:
+        for cmd in (
+                (executable, '-m', 'virtualenv', '--python=' + python, scratch),
+                ensure_pip_command(venv_python(scratch), options),
+                stage2_command(scratch, reqs, stage2_options),
+        ):
+            returncode, cmd_output = run_captured(cmd)
+            output += (colorize(cmd) + '\n').encode('UTF-8') + cmd_output
+            if returncode != 0:
+                return returncode, output
+        return 0, output
+    finally:
+        trash_directory(scratch)
+
+
+def prefetch_bundle_part(options, python):
+    """With --prefetch, each interpreter exports its part of the --export-bundle here."""
+    from hashlib import sha1
+    from os.path import abspath
+    return '%s.%s.part' % (abspath(options['export_bundle']), sha1(python.encode('UTF-8')).hexdigest()[:8])
+
+
+def prefetch(reqs, options):
+    """venv-update --prefetch: download and build wheels for these requirements, for each interpreter, concurrently.
+    No virtualenv is touched: each interpreter gets a scratch virtualenv, which is removed afterward.
+    """
+    from multiprocessing.dummy import Pool  # threads are plenty: the work is done by subprocesses
+    from os.path import exists
+    from sys import executable, stdout
+
+    pythons = [executable] if options['prefetch'] is True else options['prefetch'].split(',')
+    pool = Pool(len(pythons))
+    results = pool.map(lambda python: prefetch_interpreter(python, reqs, options), pythons)
+    pool.close()
+
+    if options.get('export_bundle'):
+        # each interpreter exported its own part of the bundle
+        from os import unlink
+        parts = [prefetch_bundle_part(options, python) for python in pythons]
+        if all(returncode == 0 for returncode, _ in results):
+            bundle_merge(parts, options['export_bundle'])
+        for part in parts:
+            if exists(part):
+                unlink(part)
+
+    exit_code = 0
+    for python, (returncode, output) in zip(pythons, results):
+        info('')
+        info('venv-update --prefetch %s: %s' % (python, 'done' if returncode == 0 else 'FAILED'))
+        stdout.write(output.decode('UTF-8'))
+        stdout.flush()
+        exit_code = exit_code or returncode
+    return exit_code
+
+
+def no_update(args, options):
+    """--check, --dry-run, --gc and --prefetch touch no virtualenv: there's nothing to lock, and nothing to mark invalid."""
+    from os.path import abspath
+    stage, venv_path, reqs, venv_args = parseargs(args)
+    targets = parse_targets(args) or ((venv_path, reqs),)
+    if stage == 2:  # --dry-run or --preflight, inside the virtualenv
+        return stage2(abspath(venv_path), reqs, options)
+    elif options.get('check'):
+        return check(targets, venv_args, options)
+    elif options.get('dry_run'):
+        return dry_run(targets, venv_args, options)
+    elif options.get('gc'):
+        return gc(options)
+    else:
+        # there's no virtualenv_dir: every argument is a requirements file
+        return prefetch(tuple(arg for arg in args if not arg.startswith('-')) or ('requirements.txt',), options)
+
+
 def main():
     from sys import argv, path
     del path[:1]  # we don't (want to) import anything from pwd or the script's directory
-    stage, venv_path, reqs, venv_args = parseargs(argv[1:])
+    if argv[1:2] in (['--forkserver'], ['--forkserver-client']):  # internal: see build_forkserver
+        return forkserver_command(argv[1:])
+    options, args = parseopts(argv[1:])
+    stage, venv_path, reqs, venv_args = parseargs(args)
+    targets = parse_targets(args)
+
+    if set(options) & set(('check', 'dry_run', 'gc', 'prefetch') if stage == 1 else ('dry_run', 'preflight')):
+        return no_update(args, options)
 
     from subprocess import CalledProcessError
     try:
-        return venv_update(stage, venv_path, reqs, venv_args)
+        if stage == 1 and targets:
+            return venv_update_many(targets, venv_args, options)
+        return venv_update(stage, venv_path, reqs, venv_args, options)
     except SystemExit as error:
         exit_code = error.code
     except CalledProcessError as error: